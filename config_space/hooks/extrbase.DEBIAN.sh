@@ -0,0 +1,7 @@
+#!/bin/sh
+# Use cached base file instead of debootstrap, provided by build.basefile
+if [ -n "$CLOUD_BUILD_BASEFILE" ] && [ -f "$CLOUD_BUILD_BASEFILE" ]; then
+  echo "Extracting base file $CLOUD_BUILD_BASEFILE"
+  tar --extract --numeric-owner --use-compress-program 'xz -T0' --directory "$FAI_ROOT" --file "$CLOUD_BUILD_BASEFILE"
+  skiptask extrbase
+fi
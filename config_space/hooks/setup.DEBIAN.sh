@@ -2,3 +2,7 @@
 skiptask chboot
 skiptask savelog
 skiptask faiend
+if [ -n "$CLOUD_BUILD_LAYER" ]; then
+  # Shared layer of a vendor build, see build.basefile.RunBaseLayer
+  skiptask tests
+fi
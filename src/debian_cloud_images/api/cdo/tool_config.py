@@ -34,6 +34,17 @@ class v1alpha1_ToolConfigAzureSchema(Schema):
     storage = fields.Nested(v1alpha1_ToolConfigAzureStorageSchema)
 
 
+class v1alpha1_ToolConfigCacheSchema(Schema):
+    path = fields.Str()
+    size = fields.Str()
+
+
+class v1alpha1_ToolConfigConvertSchema(Schema):
+    coroutines = fields.Int()
+    unordered = fields.Bool()
+    workers = fields.Int()
+
+
 class v1alpha1_ToolConfigEc2AuthSchema(Schema):
     key = fields.Str()
     secret = fields.Str()
@@ -41,12 +52,16 @@ class v1alpha1_ToolConfigEc2AuthSchema(Schema):
 
 
 class v1alpha1_ToolConfigEc2ImageSchema(Schema):
+    copies = fields.Int()
     regions = fields.List(fields.Str())
     tags = fields.List(fields.Str())
+    workers = fields.Int()
 
 
 class v1alpha1_ToolConfigEc2StorageSchema(Schema):
     name = fields.Str()
+    part_size = fields.Str()
+    workers = fields.Int()
 
 
 class v1alpha1_ToolConfigEc2SSMSchema(Schema):
@@ -84,6 +99,8 @@ class v1alpha1_ToolConfigSchema(v1_TypeMetaSchema):
 
     metadata = fields.Nested(v1_ObjectMetaSchema)
     azure = fields.Nested(v1alpha1_ToolConfigAzureSchema)
+    cache = fields.Nested(v1alpha1_ToolConfigCacheSchema)
+    convert = fields.Nested(v1alpha1_ToolConfigConvertSchema)
     ec2 = fields.Nested(v1alpha1_ToolConfigEc2Schema)
     gce = fields.Nested(v1alpha1_ToolConfigGceSchema)
 
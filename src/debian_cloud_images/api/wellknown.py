@@ -1,4 +1,8 @@
 annotation_cdo_digest = "cloud.debian.org/digest"
+annotation_bcdo_cache = "build.cloud.debian.org/cache"
+annotation_bcdo_cache_key = "build.cloud.debian.org/cache-key"
+annotation_bcdo_time_prefix = "build.cloud.debian.org/time-"
+annotation_ucdo_unchanged_from = "upload.cloud.debian.org/unchanged-from"
 
 label_cdo_vendor = "cloud.debian.org/vendor"
 label_cdo_version = "cloud.debian.org/version"
@@ -0,0 +1,201 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import logging
+import pathlib
+import shlex
+import shutil
+import subprocess
+import tempfile
+import urllib.request
+
+from typing import Dict, List, Optional
+
+from .buildcache import BuildCache, release_digest
+from .fai import dci_path, fai_config_path
+from ..utils.cache import FileCache
+
+
+logger = logging.getLogger(__name__)
+
+
+class RunBasefile:
+    """
+    Provide a cached debootstrap base tarball for FAI.
+
+    Base files are cached per release, architecture, mirror, the digest of
+    the InRelease file of the release on the mirror and the debootstrap
+    options from FAI_DEBOOTSTRAP_OPTS in class/DEBIAN.var, so all vendors of
+    a release and architecture share one base file until the mirror changes.
+    The hook extrbase.DEBIAN.sh extracts the base file given in
+    CLOUD_BUILD_BASEFILE instead of running debootstrap.
+    """
+
+    cache: FileCache
+    suite: str
+    arch: str
+    mirror: str
+
+    def __init__(
+            self, *,
+            cache: FileCache,
+            suite: str,
+            arch: str,
+            mirror: str,
+            urlopen=urllib.request.urlopen,
+    ):
+        self.cache = cache
+        self.suite = suite
+        self.arch = arch
+        self.mirror = mirror
+        self.urlopen = urlopen
+
+    def __call__(self, run: bool, *, popen=subprocess.Popen, fai_config_path=fai_config_path) -> Optional[pathlib.Path]:
+        """ Returns path of base file, the cache entry stays in place until the next eviction """
+        if run:
+            key = self.key(fai_config_path)
+            with self.cache.open(key, lambda name: self.create(pathlib.Path(name), popen, fai_config_path)) as f:
+                logger.info(f'Using base file {f.name}')
+                return pathlib.Path(f.name)
+
+        else:
+            cmd = self.commands('TARGET', 'OUTPUT', fai_config_path)[0]
+            logger.info(f'Would use cached base file or run: {" ".join(cmd)}')
+            return None
+
+    def key(self, fai_config_path: str) -> str:
+        """ Cache key of the base file, fails with OSError if the state of the mirror is not available """
+        return self.cache.key(
+            'basefile', self.suite, self.arch, self.mirror,
+            release_digest(self.mirror, self.suite, urlopen=self.urlopen),
+            *self.debootstrap_options(fai_config_path),
+        )
+
+    def debootstrap_options(self, fai_config_path: str) -> List[str]:
+        """ Options from FAI_DEBOOTSTRAP_OPTS in class/DEBIAN.var, the architecture is passed separately """
+        path = pathlib.Path(fai_config_path) / 'class' / 'DEBIAN.var'
+        ret: List[str] = []
+        if path.exists():
+            for line in path.read_text().splitlines():
+                name, sep, value = line.partition('=')
+                if sep and name.strip() == 'FAI_DEBOOTSTRAP_OPTS':
+                    # Unquote the assignment, then split words like the shell
+                    ret = ' '.join(shlex.split(value)).split()
+        return ret
+
+    def commands(self, target: str, output: str, fai_config_path: str) -> List[tuple]:
+        return [self.command_debootstrap(target, fai_config_path), self.command_tar(target, output)]
+
+    def command_debootstrap(self, target: str, fai_config_path: str) -> tuple:
+        return (
+            'sudo',
+            'debootstrap',
+            *self.debootstrap_options(fai_config_path),
+            '--arch', self.arch,
+            self.suite,
+            target,
+            self.mirror,
+        )
+
+    def command_tar(self, target: str, output: str) -> tuple:
+        return (
+            'sudo',
+            'tar',
+            '--create',
+            '--numeric-owner',
+            '--use-compress-program', 'xz -T0',
+            '--directory', target,
+            '--file', output,
+            '.',
+        )
+
+    def create(self, output: pathlib.Path, popen=subprocess.Popen, fai_config_path=fai_config_path) -> None:
+        target = tempfile.mkdtemp(prefix='.basefile_', dir=output.parent)
+        try:
+            for cmd in self.commands(target, output.as_posix(), fai_config_path):
+                logger.info(f'Running: {" ".join(cmd)}')
+                process = popen(cmd)
+                retcode = process.wait()
+                if retcode:
+                    raise subprocess.CalledProcessError(retcode, cmd)
+
+        finally:
+            retcode = popen(('sudo', 'rm', '-rf', '--one-file-system', target)).wait()
+            if retcode:
+                logger.warning(f'Unable to remove {target}')
+            shutil.rmtree(target, ignore_errors=True)
+
+
+class RunBaseLayer(RunBasefile):
+    """
+    Provide a cached root filesystem with the FAI classes shared by vendors.
+
+    The layer is installed with fai dirinstall, on top of the base file in
+    CLOUD_BUILD_BASEFILE if set, and passed to the vendor build the same way
+    as a base file.  The vendor build still runs FAI with all classes, as
+    fcopy picks files by class priority and package lists of the release and
+    arch classes depend on vendor and kernel classes.  For the layer classes
+    this is idempotent: their packages are already installed and their
+    files are copied again unchanged.  Entries are keyed by all config space
+    files of the classes and the InRelease digests of the base suite and of
+    the apt sources of the classes, so any change to them or to the archives
+    creates a new layer.
+    """
+
+    classes: List[str]
+    env: Dict[str, str]
+    fai_filename: str
+
+    def __init__(
+            self, *,
+            classes: List[str],
+            env: Dict[str, str],
+            fai_filename: str='fai',  # noqa:E252
+            **kw,
+    ):
+        super().__init__(**kw)
+        self.classes = classes
+        self.env = env
+        self.fai_filename = fai_filename
+
+    def key(self, fai_config_path: str) -> str:
+        """ Cache key of the layer, fails with OSError if the state of an apt source is not available """
+        parts = ['layer', self.suite, self.arch, self.mirror, ','.join(self.classes)]
+        for path in self.config_files(fai_config_path):
+            parts.append(path.relative_to(fai_config_path).as_posix())
+            parts.append(path.read_bytes().hex())
+        parts.append('apt')
+        sources = [(self.mirror, self.suite)] + BuildCache.apt_sources(self.classes, fai_config_path)
+        for uri, suite in dict.fromkeys(sources):
+            parts.extend((uri, suite, release_digest(uri, suite, urlopen=self.urlopen)))
+        return self.cache.key(*parts)
+
+    def config_files(self, fai_config_path: str) -> List[pathlib.Path]:
+        """ All files of the config space used by the classes, like class/C.var, scripts/C/* or hooks/task.C.sh """
+        classes = set(self.classes)
+        ret = []
+        for path in sorted(pathlib.Path(fai_config_path).rglob('*')):
+            if not path.is_file():
+                continue
+            parts = path.relative_to(fai_config_path).parts
+            if classes.intersection(parts[:-1]) or classes.intersection(parts[-1].split('.')):
+                ret.append(path)
+        return ret
+
+    def commands(self, target: str, output: str, fai_config_path: str) -> List[tuple]:
+        return [self.command_fai(target, fai_config_path), self.command_tar(target, output)]
+
+    def command_fai(self, target: str, fai_config_path: str) -> tuple:
+        return (
+            'sudo',
+            'env',
+            f'PYTHONPATH={dci_path}',
+        ) + tuple(f'{k}={v}' for k, v in sorted(self.env.items())) + (
+            self.fai_filename,
+            '--verbose',
+            '--new',
+            '--hostname', 'debian',
+            '--class', ','.join(self.classes),
+            '--cspace', str(fai_config_path),
+            'dirinstall',
+            target,
+        )
@@ -0,0 +1,179 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import contextlib
+import hashlib
+import logging
+import os
+import pathlib
+import re
+import shlex
+import shutil
+import urllib.error
+import urllib.request
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .fai import fai_config_path
+from ..utils.cache import FileCache
+from ..utils.files import copy_sparse
+
+
+logger = logging.getLogger(__name__)
+
+
+def release_digest(uri: str, suite: str, *, urlopen=urllib.request.urlopen) -> str:
+    """ Digest of InRelease, or Release, of a suite """
+    if suite.endswith('/'):
+        base = f'{uri.rstrip("/")}/{suite}'
+    else:
+        base = f'{uri.rstrip("/")}/dists/{suite}/'
+    try:
+        r = urlopen(base + 'InRelease')
+    except urllib.error.HTTPError as e:
+        if e.code != 404:
+            raise
+        r = urlopen(base + 'Release')
+    with r:
+        return hashlib.sha256(r.read()).hexdigest()
+
+
+class BuildCache:
+    """
+    Cache of raw images and build-fai manifests, keyed by all inputs of a build.
+
+    The key covers the FAI classes, the environment, the content of the
+    config space and of localdebs, the mirror and the state of the archives:
+    the digest of InRelease of every apt source the image is built from.  A
+    new archive state, like a daily build after a mirror push, misses the
+    cache.  The version of the build is not part of the key, it is written
+    into the restored image again, see RunCloudRelease.  The tar is created
+    from the restored image and the build manifest from the cached build-fai
+    manifest, both with the info of the current build.
+    """
+
+    cache: FileCache
+
+    env_ignore = frozenset((
+        'CLOUD_BUILD_APT_PROXY',
+        'CLOUD_BUILD_BASEFILE',
+        'CLOUD_BUILD_DATA',
+        'CLOUD_BUILD_INFO',
+        'CLOUD_BUILD_NAME',
+        'CLOUD_BUILD_OUTPUT_DIR',
+        # Written into the image again on restore
+        'CLOUD_RELEASE_VERSION',
+        'CLOUD_RELEASE_VERSION_AZURE',
+    ))
+
+    def __init__(self, cache: FileCache, *, urlopen=urllib.request.urlopen) -> None:
+        self.cache = cache
+        self.urlopen = urlopen
+
+    @staticmethod
+    def _tree(path: pathlib.Path) -> Iterable[str]:
+        for i in sorted(path.rglob('*')):
+            if i.is_file():
+                h = hashlib.sha256()
+                with i.open('rb') as f:
+                    for b in iter(lambda: f.read(1024 * 1024), b''):
+                        h.update(b)
+                yield i.relative_to(path).as_posix()
+                yield h.hexdigest()
+
+    @staticmethod
+    def class_variables(classes: Iterable[str], fai_config_path: str) -> Dict[str, str]:
+        """ Variables set by the class/C.var files of the classes, later classes override earlier ones like in FAI """
+        ret: Dict[str, str] = {}
+        for c in classes:
+            path = pathlib.Path(fai_config_path) / 'class' / f'{c}.var'
+            if not path.exists():
+                continue
+            for line in path.read_text().splitlines():
+                r = re.match(r'^([A-Za-z_]\w*)=(.*)$', line.strip())
+                if r:
+                    value = ' '.join(shlex.split(r.group(2)))
+                    ret[r.group(1)] = re.sub(r'\$\{?(\w+)\}?', lambda m: ret.get(m.group(1), ''), value)
+        return ret
+
+    @classmethod
+    def apt_sources(cls, classes: Iterable[str], fai_config_path: str) -> List[Tuple[str, str]]:
+        """ URI and suite of all apt sources installed by the repository hooks, except local ones """
+        classes = list(classes)
+        variables = cls.class_variables(classes, fai_config_path)
+        path_apt = pathlib.Path(fai_config_path) / 'files' / 'etc' / 'apt'
+
+        files = []
+        if 'CLASS_BUILD' in variables:
+            files.append(path_apt / 'sources.list' / variables['CLASS_BUILD'])
+        for path in sorted((path_apt / 'sources.list.d').glob('*')):
+            # fcopy uses the file of the last matching class
+            files.extend([path / c for c in classes if (path / c).is_file()][-1:])
+
+        ret = []
+        for path in files:
+            if not path.is_file():
+                continue
+            text = re.sub(r'{%(\w+)%}', lambda m: variables.get(m.group(1), ''), path.read_text())
+            for line in text.splitlines():
+                words = re.sub(r'\[[^]]*\]', '', line.partition('#')[0]).split()
+                if len(words) >= 3 and words[0] == 'deb' and words[1].startswith(('http:', 'https:')):
+                    ret.append((words[1], words[2]))
+        return list(dict.fromkeys(ret))
+
+    def release_digest(self, uri: str, suite: str) -> str:
+        return release_digest(uri, suite, urlopen=self.urlopen)
+
+    def key(
+            self, *,
+            classes: Iterable[str],
+            env: Dict[str, str],
+            mirror: str,
+            discard_unallocated: bool = False,
+            localdebs: Optional[pathlib.Path] = None,
+            fai_config_path: str = fai_config_path,
+    ) -> str:
+        """ Cache key of a build, fails with OSError if the state of an apt source is not available """
+        classes = list(classes)
+        parts = ['build', ','.join(classes), mirror]
+        if discard_unallocated:
+            parts.append('discard-unallocated')
+        parts.extend(f'{k}={v}' for k, v in sorted(env.items()) if k not in self.env_ignore)
+        parts.append('config_space')
+        parts.extend(self._tree(pathlib.Path(fai_config_path)))
+        if localdebs:
+            parts.append('localdebs')
+            parts.extend(self._tree(localdebs))
+        parts.append('apt')
+        for uri, suite in self.apt_sources(classes, fai_config_path):
+            parts.extend((uri, suite, self.release_digest(uri, suite)))
+        return self.cache.key(*parts)
+
+    def get(self, key: str, image_filename: pathlib.Path, manifest_filename: pathlib.Path) -> bool:
+        """ Copy cached raw image and build-fai manifest into place, returns False if not cached """
+        with contextlib.ExitStack() as stack:
+            files = []
+            for part in ('image', 'manifest'):
+                f = self.cache.get(self.cache.key(key, part))
+                if f is None:
+                    return False
+                files.append(stack.enter_context(f))
+
+            f_image, f_manifest = files
+            logger.info(f'Using cached build {key}')
+            with image_filename.open('wb') as f_out:
+                copy_sparse(f_image, f_out, os.fstat(f_image.fileno()).st_size)
+            with manifest_filename.open('wb') as f_out:
+                shutil.copyfileobj(f_manifest, f_out)
+            return True
+
+    def put(self, key: str, image_filename: pathlib.Path, manifest_filename: pathlib.Path) -> None:
+        def copy_image(name):
+            with image_filename.open('rb') as f_in, open(name, 'wb') as f_out:
+                copy_sparse(f_in, f_out, os.fstat(f_in.fileno()).st_size)
+
+        for part, create in (
+                ('image', copy_image),
+                ('manifest', lambda name: shutil.copyfile(manifest_filename, name)),
+        ):
+            with self.cache.open(self.cache.key(key, part), create):
+                pass
@@ -0,0 +1,112 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import collections
+import logging
+import os
+import pathlib
+import subprocess
+import tempfile
+import typing
+
+from ..utils.diskmap import ext4_filesystems
+
+
+logger = logging.getLogger(__name__)
+
+
+class CloudRelease(collections.OrderedDict):
+    """ Release of an image as written to /etc/cloud-release, read from the build environment """
+
+    env = [
+        ('id', 'CLOUD_RELEASE_ID'),
+        ('version', 'CLOUD_RELEASE_VERSION'),
+        ('azure_version', 'CLOUD_RELEASE_VERSION_AZURE'),
+        ('build_info_url', 'CI_JOB_URL'),
+    ]
+
+    def __init__(self, env: typing.Mapping[str, str] = os.environ):
+        super().__init__()
+        for name, key in self.env:
+            v = env.get(key)
+            if v:
+                self[name] = v
+
+    def write(self, f):
+        for k, v in self.items():
+            print('{}="{}"'.format(k.upper(), v), file=f)
+
+
+class RunCloudRelease:
+    """
+    Rewrite /etc/cloud-release in a raw image.
+
+    Images restored from the build cache still contain the release of the
+    build that was cached.  The file is replaced with debugfs in every ext4
+    filesystem of the image that contains it, without mounting the image.
+    """
+
+    filename: pathlib.Path
+    env: typing.Mapping[str, str]
+    path: str = '/etc/cloud-release'
+    debugfs_filename: str = '/sbin/debugfs'
+
+    def __init__(
+            self, *,
+            filename: pathlib.Path,
+            env: typing.Mapping[str, str],
+    ):
+        self.filename = filename
+        self.env = env
+
+    def __call__(self, run: bool, *, popen=subprocess.Popen) -> None:
+        if not run:
+            logger.info(f'Would write {self.path} into {self.filename}')
+            return
+
+        devices = [i for i in self.devices() if self.exists(i, popen)]
+        if not devices:
+            raise RuntimeError(f'No filesystem with {self.path} found in {self.filename}')
+
+        with tempfile.TemporaryDirectory() as tmp:
+            directory = pathlib.Path(tmp)
+            with (directory / 'cloud-release').open('w') as f:
+                CloudRelease(self.env).write(f)
+            (directory / 'commands').write_text(''.join(f'{i}\n' for i in self.commands(directory)))
+
+            for device in devices:
+                cmd = self.command(device, directory)
+                logger.info(f'Running: {" ".join(cmd)}')
+                retcode = popen(cmd, stdout=subprocess.DEVNULL).wait()
+                if retcode:
+                    raise subprocess.CalledProcessError(retcode, cmd)
+
+    def devices(self) -> typing.List[str]:
+        """ debugfs devices of all ext4 filesystems in the image """
+        with self.filename.open('rb') as f:
+            parts = ext4_filesystems(f, os.fstat(f.fileno()).st_size)
+        return [f'{self.filename.as_posix()}?offset={i.offset}' for i in parts]
+
+    def exists(self, device: str, popen) -> bool:
+        with popen(
+                (self.debugfs_filename, '-R', f'cat {self.path}', device),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+        ) as process:
+            return bool(process.stdout.read())
+
+    def commands(self, directory: pathlib.Path) -> typing.List[str]:
+        return [
+            f'rm {self.path}',
+            f'write {(directory / "cloud-release").as_posix()} {self.path}',
+            f'sif {self.path} uid 0',
+            f'sif {self.path} gid 0',
+            f'sif {self.path} mode 0100644',
+        ]
+
+    def command(self, device: str, directory: pathlib.Path) -> tuple:
+        return (
+            self.debugfs_filename,
+            '-w',
+            '-f', (directory / 'commands').as_posix(),
+            device,
+        )
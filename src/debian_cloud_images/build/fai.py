@@ -1,11 +1,15 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import json
 import logging
 import pathlib
 import os.path
+import re
 import subprocess
+import sys
+import time
 
-from typing import Dict, List
+from typing import Callable, Dict, List, Optional
 
 
 dci_path = os.path.join(os.path.dirname(__file__), '../..')
@@ -13,12 +17,78 @@ fai_config_path = os.path.join(os.path.dirname(__file__), 'fai_config')
 logger = logging.getLogger(__name__)
 
 
+class FaiTimings:
+    """
+    Wall time of FAI tasks, hooks and scripts, parsed from verbose output.
+
+    FAI only logs when a task, hook or script starts, so each of them is
+    considered done once the next one starts.  Tasks include the time of the
+    hooks and scripts running in them.
+    """
+
+    re_task = re.compile(r'^Calling task_(\S+)')
+    re_hook = re.compile(r'^Calling hook: (\S+)')
+    re_script = re.compile(r'^Executing\s+\S+: (\S+)')
+
+    tasks: Dict[str, float]
+    hooks: Dict[str, float]
+    scripts: Dict[str, float]
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic) -> None:
+        self.clock = clock
+        self.start = clock()
+        self.end: Optional[float] = None
+        self.tasks = {}
+        self.hooks = {}
+        self.scripts = {}
+        self.__task: Optional[tuple] = None
+        self.__step: Optional[tuple] = None
+
+    def _stop(self, current: Optional[tuple], now: float) -> None:
+        if current is not None:
+            d, name, start = current
+            d[name] = d.get(name, 0) + now - start
+
+    def feed(self, line: str) -> None:
+        now = self.clock()
+        for r, d in ((self.re_task, self.tasks), (self.re_hook, self.hooks), (self.re_script, self.scripts)):
+            m = r.match(line)
+            if m:
+                self._stop(self.__step, now)
+                self.__step = None
+                if d is self.tasks:
+                    self._stop(self.__task, now)
+                    self.__task = (d, m.group(1), now)
+                else:
+                    self.__step = (d, m.group(1), now)
+                return
+
+    def finish(self) -> None:
+        self.end = self.clock()
+        self._stop(self.__task, self.end)
+        self._stop(self.__step, self.end)
+        self.__task = self.__step = None
+
+    @property
+    def total(self) -> float:
+        return (self.end if self.end is not None else self.clock()) - self.start
+
+    def dump(self) -> Dict:
+        return {
+            'total': round(self.total, 3),
+            'tasks': {k: round(v, 3) for k, v in self.tasks.items()},
+            'hooks': {k: round(v, 3) for k, v in self.hooks.items()},
+            'scripts': {k: round(v, 3) for k, v in self.scripts.items()},
+        }
+
+
 class RunFAI:
     output_filenam: pathlib.Path
     classes: List[str]
     size_gb: int
     env: Dict[str, str]
     fai_filename: str
+    timings_filename: Optional[pathlib.Path]
 
     def __init__(
             self, *,
@@ -27,30 +97,47 @@ class RunFAI:
             size_gb: int,
             env: Dict[str, str],
             fai_filename: str='fai-diskimage',  # noqa:E252
+            timings_filename: Optional[pathlib.Path]=None,  # noqa:E252
     ):
         self.output_filename = output_filename
         self.classes = classes
         self.size_gb = size_gb
         self.env = env
         self.fai_filename = fai_filename
+        self.timings_filename = timings_filename
 
-    def __call__(self, run: bool, *, popen=subprocess.Popen, dci_path=dci_path) -> None:
+    def __call__(self, run: bool, *, popen=subprocess.Popen, dci_path=dci_path) -> Optional[FaiTimings]:
         cmd = self.command(dci_path)
 
         if run:
             logger.info(f'Running FAI: {" ".join(cmd)}')
 
+            timings = FaiTimings()
             try:
-                process = popen(cmd)
+                process = popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                # Pass output on unchanged, while recording task boundaries
+                for line in process.stdout:
+                    sys.stdout.buffer.write(line)
+                    sys.stdout.flush()
+                    timings.feed(line.decode('utf-8', errors='replace'))
                 retcode = process.wait()
+                timings.finish()
                 if retcode:
                     raise subprocess.CalledProcessError(retcode, cmd)
 
             finally:
                 process.kill()
 
+            logger.info('FAI tasks took: %s', ', '.join(f'{k} {v:.1f}s' for k, v in timings.tasks.items()))
+            if self.timings_filename:
+                with self.timings_filename.open('w') as f:
+                    json.dump(timings.dump(), f, indent=4, separators=(',', ': '))
+
+            return timings
+
         else:
             logger.info(f'Would run FAI: {" ".join(cmd)}')
+            return None
 
     def command(self, dci_path: str) -> tuple:
         return (
@@ -4,7 +4,7 @@ import json
 import logging
 import pathlib
 
-from typing import Dict, Iterable
+from typing import Dict, Iterable, Optional
 
 from ..api.registry import registry as api_registry
 from ..api import wellknown
@@ -28,7 +28,11 @@ class CreateManifest:
         self.output_filename = output_filename
         self.info = info
 
-    def __call__(self, run: bool, digest: Iterable[str]) -> None:
+    def __call__(
+            self, run: bool, digest: Iterable[str],
+            timings: Optional[Dict[str, float]] = None,
+            annotations: Optional[Dict[str, str]] = None,
+    ) -> None:
         if not run:
             return
 
@@ -47,6 +51,9 @@ class CreateManifest:
             manifest.metadata.labels[wellknown.label_bcdo_type] = self.info['type']
 
         manifest.metadata.annotations[wellknown.annotation_cdo_digest] = ','.join(digest)
+        for task, seconds in (timings or {}).items():
+            manifest.metadata.annotations[wellknown.annotation_bcdo_time_prefix + task] = f'{seconds:.1f}'
+        manifest.metadata.annotations.update(annotations or {})
 
         with self.output_filename.open('w') as f:
             json.dump(api_registry.dump(manifest), f, indent=4, separators=(',', ': '), sort_keys=True)
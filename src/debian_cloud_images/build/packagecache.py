@@ -0,0 +1,125 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import http.server
+import logging
+import os
+import shutil
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from ..utils.cache import FileCache
+
+
+logger = logging.getLogger(__name__)
+
+
+class PackageCache:
+    """
+    HTTP proxy for apt in FAI builds, keeping packages in a shared cache.
+
+    Packages are addressed by their path below the pool, which never
+    changes content within the Debian archive, so builds using different
+    mirrors share entries.  apt checks every package against the hash of
+    the index anyway.  Concurrent builds wait for each other while the same
+    package is downloaded and the cache persists, so each build of a matrix
+    pre-warms the cache for the next one.  The size of the cache is limited
+    by the FileCache.  Everything else, like indices, is passed through.
+    """
+
+    cache: FileCache
+    address: str
+    cache_suffixes = ('.deb', '.udeb')
+
+    def __init__(self, cache: FileCache, *, address: str='127.0.0.1', urlopen=urllib.request.urlopen):  # noqa:E252
+        self.cache = cache
+        self.address = address
+        self.urlopen = urlopen
+        self.server = None
+        self.thread = None
+
+    def __enter__(self):
+        self.server = http.server.ThreadingHTTPServer((self.address, 0), self._handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='package-cache', daemon=True)
+        self.thread.start()
+        logger.info(f'Serving package cache {self.cache.path} on {self.url}')
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        stats = self.cache.stats()
+        logger.info(f'Package cache: {stats["hits"]} hits, {stats["misses"]} misses')
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def key(self, url: str) -> str:
+        path = urllib.parse.urlsplit(url).path
+        pool = path.find('/pool/')
+        return self.cache.key('package', path[pool + 1:] if pool >= 0 else path)
+
+    def cacheable(self, url: str) -> bool:
+        return urllib.parse.urlsplit(url).path.endswith(self.cache_suffixes)
+
+    def fetch(self, url: str, filename: str) -> None:
+        with self.urlopen(url) as r, open(filename, 'wb') as f:
+            shutil.copyfileobj(r, f)
+            # Never cache truncated downloads
+            length = r.headers.get('Content-Length')
+            if length is not None and f.tell() != int(length):
+                raise OSError(f'Got {f.tell()} bytes instead of {length} from {url}')
+
+    def _handler(self):
+        package_cache = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            forward_headers = ('If-Modified-Since', 'If-None-Match', 'Range', 'User-Agent')
+            return_headers = ('Content-Type', 'Content-Length', 'Content-Range', 'Last-Modified', 'ETag')
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+            def do_GET(self):
+                try:
+                    if package_cache.cacheable(self.path):
+                        self.send_cached()
+                    else:
+                        self.send_upstream()
+                except urllib.error.HTTPError as e:
+                    self.send_response(e.code)
+                    self.send_headers(e.headers)
+                    shutil.copyfileobj(e, self.wfile)
+                except (urllib.error.URLError, OSError) as e:
+                    logger.warning(f'Unable to fetch {self.path}: {e}')
+                    self.send_error(502)
+
+            def send_headers(self, headers):
+                for name in self.return_headers:
+                    if name in headers:
+                        self.send_header(name, headers[name])
+                self.end_headers()
+
+            def send_cached(self):
+                key = package_cache.key(self.path)
+                with package_cache.cache.open(key, lambda name: package_cache.fetch(self.path, name)) as f:
+                    # Ranges of partial downloads are ignored, a complete response is always valid
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/vnd.debian.binary-package')
+                    self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+                    self.end_headers()
+                    shutil.copyfileobj(f, self.wfile)
+
+            def send_upstream(self):
+                headers = {k: self.headers[k] for k in self.forward_headers if k in self.headers}
+                with package_cache.urlopen(urllib.request.Request(self.path, headers=headers)) as r:
+                    self.send_response(r.status)
+                    self.send_headers(r.headers)
+                    shutil.copyfileobj(r, self.wfile)
+
+        return Handler
@@ -0,0 +1,98 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import concurrent.futures
+import logging
+import time
+
+from typing import Callable, Dict, Iterable, List, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    name: str
+    resources: Dict[str, int]
+    func: Callable[[], None]
+    start: Optional[float]
+    end: Optional[float]
+    error: Optional[BaseException]
+
+    def __init__(self, name: str, func: Callable[[], None], resources: Optional[Dict[str, int]] = None) -> None:
+        self.name = name
+        self.func = func
+        self.resources = resources if resources is not None else {}
+        self.start = self.end = None
+        self.error = None
+
+    @property
+    def duration(self) -> Optional[float]:
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+
+class ResourceScheduler:
+    """
+    Run jobs in parallel while the sum of their resources stays within capacity.
+
+    Jobs are started in the given order; if the next job does not fit, later
+    jobs that do fit are started first.  Resources not listed in capacity are
+    not limited.  A failing job does not stop the others, its exception is
+    recorded in Job.error.  Jobs needing more than the capacity fail without
+    being started.
+    """
+
+    capacity: Dict[str, int]
+
+    def __init__(self, capacity: Dict[str, int]) -> None:
+        self.capacity = capacity
+
+    def _fits(self, job: Job, available: Dict[str, int]) -> bool:
+        return all(available[k] >= v for k, v in job.resources.items() if k in available)
+
+    def _acquire(self, job: Job, available: Dict[str, int], sign: int) -> None:
+        for k, v in job.resources.items():
+            if k in available:
+                available[k] -= sign * v
+
+    def _run_job(self, job: Job) -> None:
+        logger.info('Starting job %s', job.name)
+        job.start = time.monotonic()
+        try:
+            job.func()
+        except Exception as e:
+            job.error = e
+            logger.error('Job %s failed: %s', job.name, e)
+        else:
+            logger.info('Finished job %s', job.name)
+        finally:
+            job.end = time.monotonic()
+
+    def run(self, jobs: Iterable[Job]) -> List[Job]:
+        jobs = list(jobs)
+        pending = []
+        for job in jobs:
+            if self._fits(job, self.capacity):
+                pending.append(job)
+            else:
+                job.error = ValueError(f'Job {job.name} needs more resources than available: {job.resources}')
+                logger.error('Job %s failed: %s', job.name, job.error)
+
+        available = dict(self.capacity)
+        running: Dict[concurrent.futures.Future, Job] = {}
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(pending), 1)) as executor:
+            while pending or running:
+                for job in list(pending):
+                    if self._fits(job, available):
+                        pending.remove(job)
+                        self._acquire(job, available, 1)
+                        running[executor.submit(self._run_job, job)] = job
+
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                    self._acquire(running.pop(future), available, -1)
+
+        return jobs
@@ -0,0 +1,110 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import logging
+import os
+import pathlib
+import subprocess
+import typing
+
+from ..utils.diskmap import unallocated_extents
+from ..utils.files import data_extents, punch_hole, zero_extents
+
+
+logger = logging.getLogger(__name__)
+
+
+class RunSparse:
+    """
+    Turn blocks of zeros in the raw image into holes.
+
+    With unallocated set, blocks not allocated by the ext4 filesystems of the
+    image are turned into holes as well, even if they still contain stale
+    data.  This changes the image content and so its digest; the manifest
+    digest is taken from the tar afterwards and matches the uploaded data.
+
+    Images written by FAI as root can't be changed by the build user, for
+    them fallocate is run via sudo instead.
+    """
+
+    filename: pathlib.Path
+    unallocated: bool
+    block_size: int = 4096
+
+    def __init__(
+            self, *,
+            filename: pathlib.Path,
+            unallocated: bool=False,  # noqa:E252
+    ):
+        self.filename = filename
+        self.unallocated = unallocated
+
+    def __call__(self, run: bool, *, popen=subprocess.Popen) -> int:
+        """ Returns number of bytes reclaimed """
+        if not run:
+            logger.info(f'Would punch holes into {self.filename}')
+            return 0
+
+        allocated = self.allocated()
+
+        try:
+            with self.filename.open('r+b', buffering=0) as f:
+                self.punch(f)
+        except PermissionError:
+            for cmd in self.commands():
+                logger.info(f'Running: {" ".join(cmd)}')
+                retcode = popen(cmd).wait()
+                if retcode:
+                    raise subprocess.CalledProcessError(retcode, cmd)
+
+        reclaimed = allocated - self.allocated()
+        logger.info(f'Punched holes into {self.filename}, reclaimed {reclaimed} bytes')
+        return reclaimed
+
+    def allocated(self) -> int:
+        return self.filename.stat().st_blocks * 512
+
+    def punch(self, f) -> None:
+        size = os.fstat(f.fileno()).st_size
+        # Collect extents first, punching holes changes the data extents
+        extents = list(zero_extents(f, size, self.block_size))
+        if self.unallocated:
+            extents.extend(self.unallocated_extents(f, size))
+        for offset, size in extents:
+            punch_hole(f, offset, size)
+
+    def unallocated_extents(self, f, size: int):
+        """ Iterate over (offset, size) of aligned unallocated blocks still containing data """
+        data = list(data_extents(f, size))
+        for offset, length in unallocated_extents(f, size):
+            begin = -(-offset // self.block_size) * self.block_size
+            end = (offset + length) // self.block_size * self.block_size
+            for data_offset, data_size in data:
+                b, e = max(begin, data_offset), min(end, data_offset + data_size)
+                if b < e:
+                    yield b, e - b
+
+    def commands(self) -> typing.List[tuple]:
+        ret = [self.command()]
+        if self.unallocated:
+            with self.filename.open('rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                ret.extend(self.command_punch(offset, length) for offset, length in self.unallocated_extents(f, size))
+        return ret
+
+    def command(self) -> tuple:
+        return (
+            'sudo',
+            'fallocate',
+            '--dig-holes',
+            self.filename.as_posix(),
+        )
+
+    def command_punch(self, offset: int, length: int) -> tuple:
+        return (
+            'sudo',
+            'fallocate',
+            '--punch-hole',
+            '--offset', str(offset),
+            '--length', str(length),
+            self.filename.as_posix(),
+        )
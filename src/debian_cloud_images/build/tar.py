@@ -1,10 +1,17 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
-import base64
-import hashlib
+import grp
 import logging
+import os
 import pathlib
-import subprocess
+import pwd
+import tarfile
+
+from typing import List, Optional, Tuple, Union
+
+from ..utils.digest import DigestPipeline, format_digest
+from ..utils.files import data_extents, pread_into
+from ..utils.xz import XzBlockCompressor
 
 
 logger = logging.getLogger(__name__)
@@ -14,59 +21,116 @@ class RunTar:
     input_filename: pathlib.Path
     output_filename: pathlib.Path
     inner_filename: str
+    compress: Optional[str]
+    buffer_size: int = 4 * 1024 * 1024
+
+    compress_formats = ('xz', )
 
     def __init__(
             self, *,
             input_filename: pathlib.Path,
             output_filename: pathlib.Path,
             inner_filename: str='disk.raw',  # noqa:E252
+            compress: Optional[str]=None,  # noqa:E252
     ):
+        if compress not in (None, ) + self.compress_formats:
+            raise ValueError(f'Unsupported compression format: {compress}')
+
         self.input_filename = input_filename
         self.output_filename = output_filename
         self.inner_filename = inner_filename
+        self.compress = compress
 
-    def __call__(self, run: bool, *, popen=subprocess.Popen) -> str:
-        cmd = self.command
-        output_hash = hashlib.sha512()
-
+    def __call__(self, run: bool) -> List[str]:
         if run:
-            logger.info(f'Running tar: {" ".join(cmd)}')
-
-            with self.output_filename.open('wb') as output:
-                try:
-                    process = popen(cmd, bufsize=0, stdout=subprocess.PIPE)
-
-                    while True:
-                        o = process.stdout.read()
-                        if len(o) == 0:
-                            break
-                        output.write(o)
-                        output_hash.update(o)
-
-                    retcode = process.wait()
-                    if retcode:
-                        raise subprocess.CalledProcessError(retcode, cmd)
-
-                finally:
-                    process.kill()
+            logger.info(f'Writing tar {self.output_filename} from {self.input_filename}')
+
+            with self.input_filename.open('rb') as f_in, self.output_filename.open('wb') as output:
+                with DigestPipeline(lambda data, offset: output.write(data), buffer_size=self.buffer_size) as pipeline:
+                    if self.compress == 'xz':
+                        # The digest covers the compressed output, as this is the file stored
+                        with XzBlockCompressor(pipeline.put, buffer_size=self.buffer_size) as compressor:
+                            self.write(f_in, compressor)
+                    else:
+                        self.write(f_in, pipeline)
+                hashes = pipeline.hashes.values()
 
         else:
-            logger.info(f'Would run tar: {" ".join(cmd)}')
-
-        output_digest = base64.b64encode(output_hash.digest()).decode().rstrip('=')
-        digest = f'{output_hash.name}:{output_digest}'
-
-        logger.info(f'Image tar digest: {digest}')
-
-        return digest
-
-    @property
-    def command(self) -> tuple:
-        return (
-            'tar',
-            '--create',
-            '--absolute-names',
-            '--sparse',
-            '--transform', r's/.*/' + self.inner_filename + '/',
-            self.input_filename.as_posix(),
-        )
+            logger.info(f'Would write tar {self.output_filename} from {self.input_filename}')
+            hashes = DigestPipeline(buffers=0).hashes.values()
+
+        digests = [format_digest(h) for h in hashes]
+
+        logger.info(f'Image tar digests: {", ".join(digests)}')
+
+        return digests
+
+    def write(self, f_in, pipeline: Union[DigestPipeline, XzBlockCompressor]) -> None:
+        """
+        Write tar file with a single PAX sparse 1.0 member, as written by
+        GNU tar --sparse --format=posix.
+
+        Data extents are read with pread into buffers of the pipeline, which
+        writes and hashes them while the next buffer is read.
+        """
+        stat = os.fstat(f_in.fileno())
+        extents = list(data_extents(f_in, stat.st_size))
+
+        sparse_map = self.sparse_map(stat.st_size, extents)
+        data_size = sum(size for offset, size in extents)
+        header = self.header(stat, len(sparse_map) + data_size)
+        pipeline.put(header)
+        pipeline.put(sparse_map)
+
+        for offset, size in extents:
+            end = offset + size
+            while offset < end:
+                buf = pipeline.get_buffer()
+                length = min(end - offset, len(buf))
+                with memoryview(buf) as mv, mv[:length] as smv:
+                    n = pread_into(f_in, smv, offset)
+                if n < length:
+                    raise EOFError(f'Unexpected end of file {self.input_filename}')
+                pipeline.put_buffer(buf, n)
+                offset += n
+
+        # Pad last member, add end of archive marker and pad to full record
+        written = len(header) + len(sparse_map) + data_size
+        written += -written % tarfile.BLOCKSIZE + 2 * tarfile.BLOCKSIZE
+        pipeline.put(bytes(-data_size % tarfile.BLOCKSIZE + 2 * tarfile.BLOCKSIZE + -written % tarfile.RECORDSIZE))
+
+    def header(self, stat: os.stat_result, size: int) -> bytes:
+        info = tarfile.TarInfo(f'GNUSparseFile.0/{self.inner_filename}')
+        info.size = size
+        info.mode = stat.st_mode & 0o7777
+        info.uid = stat.st_uid
+        info.gid = stat.st_gid
+        info.mtime = int(stat.st_mtime)
+        try:
+            info.uname = pwd.getpwuid(stat.st_uid).pw_name
+        except KeyError:
+            pass
+        try:
+            info.gname = grp.getgrgid(stat.st_gid).gr_name
+        except KeyError:
+            pass
+        info.pax_headers = {
+            'GNU.sparse.major': '1',
+            'GNU.sparse.minor': '0',
+            'GNU.sparse.name': self.inner_filename,
+            'GNU.sparse.realsize': str(stat.st_size),
+        }
+        return info.tobuf(format=tarfile.PAX_FORMAT, encoding='utf-8', errors='surrogateescape')
+
+    @staticmethod
+    def sparse_map(size: int, extents: List[Tuple[int, int]]) -> bytes:
+        """ Sparse map, padded to full blocks; a trailing hole is marked by an empty extent """
+        if not extents or sum(extents[-1]) < size:
+            extents = extents + [(size, 0)]
+
+        numbers = [len(extents)]
+        for offset, length in extents:
+            numbers.extend((offset, length))
+
+        ret = ''.join(f'{i}\n' for i in numbers).encode('ascii')
+        return ret + bytes(-len(ret) % tarfile.BLOCKSIZE)
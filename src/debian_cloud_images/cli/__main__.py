@@ -1,6 +1,7 @@
 import argparse
 
 from .build import BuildCommand
+from .build_matrix import BuildMatrixCommand
 from .cleanup import CleanupCommand
 from .cleanup_ec2 import CleanupEc2Command
 from .cleanup_azure_cloudpartner import CleanupAzureCloudpartnerCommand
@@ -25,6 +26,7 @@ def main():
     )
 
     BuildCommand._argparse_init_sub(subparsers)
+    BuildMatrixCommand._argparse_init_sub(subparsers)
     CleanupCommand._argparse_init_sub(subparsers)
     CleanupEc2Command._argparse_init_sub(subparsers)
     CleanupAzureCloudpartnerCommand._argparse_init_sub(subparsers)
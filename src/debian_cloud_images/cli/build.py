@@ -2,6 +2,7 @@
 
 import argparse
 import collections.abc
+import contextlib
 import enum
 import json
 import logging
@@ -12,11 +13,18 @@ from datetime import datetime
 
 from .base import BaseCommand
 
+from ..api import wellknown
+from ..build.basefile import RunBaseLayer, RunBasefile
+from ..build.buildcache import BuildCache
+from ..build.cloudrelease import RunCloudRelease
 from ..build.fai import RunFAI
 from ..build.manifest import CreateManifest
+from ..build.packagecache import PackageCache
+from ..build.sparse import RunSparse
 from ..build.tar import RunTar
 from ..data import data_path
 from ..utils import argparse_ext
+from ..utils.cache import FileCache, parse_size
 
 
 logger = logging.getLogger()
@@ -24,8 +32,9 @@ logger = logging.getLogger()
 
 class Arch:
     def __init__(self, kw):
-        def init(*, fai_classes):
+        def init(*, fai_classes, fai_classes_disk):
             self.fai_classes = fai_classes
+            self.fai_classes_disk = fai_classes_disk
         init(**kw)
 
 
@@ -69,13 +78,16 @@ ArchEnum = enum.Enum(  # type:ignore
     'ArchEnum',
     {
         'amd64': {
-            'fai_classes': ('AMD64', 'GRUB_CLOUD_AMD64'),
+            'fai_classes': ('AMD64', ),
+            'fai_classes_disk': ('GRUB_CLOUD_AMD64', ),
         },
         'arm64': {
-            'fai_classes': ('ARM64', 'GRUB_EFI_ARM64'),
+            'fai_classes': ('ARM64', ),
+            'fai_classes_disk': ('GRUB_EFI_ARM64', ),
         },
         'ppc64el': {
-            'fai_classes': ('PPC64EL', 'GRUB_IEEE1275'),
+            'fai_classes': ('PPC64EL', ),
+            'fai_classes_disk': ('GRUB_IEEE1275', ),
         },
     },
     type=Arch,
@@ -210,6 +222,23 @@ BuildTypeEnum = enum.Enum(  # type:ignore
 )
 
 
+def build_supported(release_name, vendor_name, arch_name):
+    """ Check if images of vendor are built for release and arch """
+    # XXX: Better selection
+    if vendor_name == 'gce' and release_name == 'bullseye':
+        return False
+
+    # XXX: Better arch selection
+    if vendor_name in ('azure', 'ec2', 'gce'):
+        if arch_name == 'amd64':
+            return True
+        elif arch_name == 'arm64':
+            return vendor_name in ('ec2', )
+        return False
+
+    return True
+
+
 class BuildId:
     re = re.compile(r"^[a-z][a-z0-9-]+$")
 
@@ -273,6 +302,7 @@ class Check:
         self.arch = arch
         self.info['arch'] = self.arch.name
         self.classes |= self.arch.fai_classes
+        self.classes |= self.arch.fai_classes_disk
 
     def set_version(self, version, version_date, build_id):
         self.build_id = self.info['build_id'] = build_id.id
@@ -297,6 +327,13 @@ class Check:
             self.classes.add('LINUX_IMAGE_BASE')
         self.classes.add('LAST')
 
+    @property
+    def classes_layer(self):
+        """ Classes shared by all vendors of release and arch, that don't need a disk """
+        exclude = set(self.vendor.fai_classes) | set(self.arch.fai_classes_disk)
+        exclude |= {'LINUX_IMAGE_CLOUD', 'LINUX_IMAGE_BASE', 'LOCALDEBS', 'LAST'}
+        return [c for c in self.classes if c not in exclude]
+
 
 class BuildCommand(BaseCommand):
     argparser_name = 'build'
@@ -328,6 +365,15 @@ class BuildCommand(BaseCommand):
             help='Architecture or sub-architecture to build image for',
             metavar='ARCH',
         )
+        cls._argparse_register_options(parser)
+        parser.add_argument(
+            '--override-name',
+            help='override name of output',
+        )
+
+    @classmethod
+    def _argparse_register_options(cls, parser, *, defaults=True):
+        """ Options shared with build-matrix, which passes them on only if given """
         parser.add_argument(
             '--build-id',
             metavar='ID',
@@ -347,6 +393,67 @@ class BuildCommand(BaseCommand):
             action='store_true',
             help='print the commands which would be executed, but do not run them'
         )
+        parser.add_argument(
+            '--compress',
+            choices=RunTar.compress_formats,
+            help='compress image tar, using independent blocks compressed on all cores',
+            metavar='FORMAT',
+        )
+        parser.add_argument(
+            '--discard-unallocated',
+            action='store_true',
+            help='turn blocks not allocated by ext4 filesystems into holes, dropping stale data from the image',
+        )
+        parser.add_argument(
+            '--basefile-cache',
+            help='use and maintain cache of debootstrap base files in DIR, shared by all builds',
+            metavar='DIR',
+            type=pathlib.Path,
+        )
+        parser.add_argument(
+            '--basefile-cache-size',
+            default='10G' if defaults else None,
+            help='evict least recently used base files and layers once base file cache exceeds SIZE (default: 10G)',
+            metavar='SIZE',
+            type=parse_size,
+        )
+        parser.add_argument(
+            '--basefile-mirror',
+            default='http://deb.debian.org/debian/' if defaults else None,
+            help='mirror to create base files from, e.g. a snapshot (default: http://deb.debian.org/debian/)',
+            metavar='URL',
+        )
+        parser.add_argument(
+            '--build-cache',
+            help='reuse image and manifest of builds with identical inputs from cache in DIR',
+            metavar='DIR',
+            type=pathlib.Path,
+        )
+        parser.add_argument(
+            '--build-cache-size',
+            default='50G' if defaults else None,
+            help='evict least recently used builds once build cache exceeds SIZE (default: 50G)',
+            metavar='SIZE',
+            type=parse_size,
+        )
+        parser.add_argument(
+            '--package-cache',
+            help='download packages through a proxy caching them in DIR, shared by all builds',
+            metavar='DIR',
+            type=pathlib.Path,
+        )
+        parser.add_argument(
+            '--package-cache-size',
+            default='20G' if defaults else None,
+            help='evict least recently used packages once package cache exceeds SIZE (default: 20G)',
+            metavar='SIZE',
+            type=parse_size,
+        )
+        parser.add_argument(
+            '--layered',
+            action='store_true',
+            help='build classes shared by all vendors once as cached layer, needs --basefile-cache',
+        )
         parser.add_argument(
             '--localdebs',
             action='store_true',
@@ -355,14 +462,10 @@ class BuildCommand(BaseCommand):
         parser.add_argument(
             '--output',
             default='.',
-            help='write manifests and images to (default: .)',
+            help='write manifests, images and logs to (default: .)',
             metavar='DIR',
             type=pathlib.Path
         )
-        parser.add_argument(
-            '--override-name',
-            help='override name of output',
-        )
         parser.add_argument(
             '--version',
             action=argparse_ext.ActionEnv,
@@ -373,7 +476,7 @@ class BuildCommand(BaseCommand):
         )
         parser.add_argument(
             '--version-date',
-            default=datetime.now(),
+            default=datetime.now() if defaults else None,
             help='date part of version (default: today)',
             type=cls._argparse_type_date,
         )
@@ -386,7 +489,7 @@ class BuildCommand(BaseCommand):
             msg = "Given date ({0}) is not valid. Expected format: 'YYYY-MM-DD'".format(s)
             raise argparse.ArgumentTypeError(msg)
 
-    def __init__(self, *, release=None, vendor=None, arch=None, version=None, build_id=None, build_type=None, localdebs=False, output=None, noop=False, override_name=None, version_date=None, **kw):
+    def __init__(self, *, release=None, vendor=None, arch=None, version=None, build_id=None, build_type=None, localdebs=False, output=None, noop=False, override_name=None, version_date=None, compress=None, basefile_cache=None, basefile_cache_size='10G', basefile_mirror='http://deb.debian.org/debian/', layered=False, build_cache=None, build_cache_size='50G', discard_unallocated=False, package_cache=None, package_cache_size='20G', **kw):
         super().__init__(**kw)
 
         self.noop = noop
@@ -419,20 +522,28 @@ class BuildCommand(BaseCommand):
         output.mkdir(parents=True, exist_ok=True)
 
         image_raw = output / '{}.raw'.format(name)
-        image_tar = output / '{}.tar'.format(name)
+        image_tar = output / '{}.tar{}'.format(name, f'.{compress}' if compress else '')
         manifest_fai = output / '{}.build-fai.json'.format(name)
         manifest_final = output / '{}.build.json'.format(name)
+        timings_fai = output / '{}.build-timings.json'.format(name)
 
         self.fai = RunFAI(
             output_filename=image_raw,
             classes=self.c.classes,
             size_gb=self.c.vendor.fai_size,
             env=self.env,
+            timings_filename=timings_fai,
+        )
+
+        self.sparse = RunSparse(
+            filename=image_raw,
+            unallocated=discard_unallocated,
         )
 
         self.tar = RunTar(
             input_filename=image_raw,
             output_filename=image_tar,
+            compress=compress,
         )
 
         self.manifest = CreateManifest(
@@ -441,10 +552,99 @@ class BuildCommand(BaseCommand):
             info=self.c.info,
         )
 
+        self.basefile = self.layer = None
+        if basefile_cache:
+            basefile_kw = dict(
+                cache=FileCache(basefile_cache, max_size=parse_size(basefile_cache_size)),
+                # Backports and point release classes build on top of the base suite
+                suite=self.c.release.basename.split('-')[0],
+                arch=self.c.arch.name,
+                mirror=basefile_mirror,
+            )
+            self.basefile = RunBasefile(**basefile_kw)
+            if layered:
+                self.layer = RunBaseLayer(
+                    classes=self.c.classes_layer,
+                    env={
+                        'CLOUD_BUILD_DATA': data_path,
+                        'CLOUD_BUILD_LAYER': '1',
+                    },
+                    **basefile_kw,
+                )
+        elif layered:
+            self.argparser.error('--layered needs --basefile-cache')
+
+        self.package_cache = None
+        if package_cache:
+            self.package_cache = PackageCache(FileCache(package_cache, max_size=parse_size(package_cache_size)))
+
+        self.cloud_release = RunCloudRelease(
+            filename=image_raw,
+            env=self.env,
+        )
+
+        self.build_cache = None
+        if build_cache:
+            self.build_cache = BuildCache(FileCache(build_cache, max_size=parse_size(build_cache_size)))
+            try:
+                self.build_cache_key = self.build_cache.key(
+                    classes=self.c.classes,
+                    env=self.env,
+                    mirror=basefile_mirror,
+                    discard_unallocated=discard_unallocated,
+                    localdebs=pathlib.Path('localdebs') if localdebs else None,
+                )
+            except OSError as e:
+                # Without the state of the archives a cached build may be outdated
+                logger.warning(f'Not using build cache, unable to get state of apt sources: {e}')
+                self.build_cache = None
+
     def __call__(self):
-        self.fai(not self.noop)
-        digest = self.tar(not self.noop)
-        self.manifest(not self.noop, (digest,))
+        annotations = {}
+        cached = False
+        if self.build_cache:
+            annotations[wellknown.annotation_bcdo_cache_key] = self.build_cache_key
+            if not self.noop:
+                cached = self.build_cache.get(self.build_cache_key, self.sparse.filename, self.manifest.input_filename)
+            annotations[wellknown.annotation_bcdo_cache] = 'hit' if cached else 'miss'
+
+        timings = None
+        if cached:
+            # The cached image still contains the release of the cached build
+            self.cloud_release(True)
+        else:
+            with contextlib.ExitStack() as stack:
+                if self.package_cache and not self.noop:
+                    proxy = stack.enter_context(self.package_cache).url
+                    self.env['CLOUD_BUILD_APT_PROXY'] = proxy
+                    if self.layer:
+                        self.layer.env['CLOUD_BUILD_APT_PROXY'] = proxy
+                timings = self.install()
+
+            self.sparse(not self.noop)
+
+            if self.build_cache and not self.noop:
+                self.build_cache.put(self.build_cache_key, self.sparse.filename, self.manifest.input_filename)
+
+        # Tar and build manifest are created with the info of this build, even from a cached image
+        digests = self.tar(not self.noop)
+        self.manifest(not self.noop, digests, timings.tasks if timings else None, annotations)
+
+    def install(self):
+        """ Install the image with FAI, on top of base file and layer, returns timings """
+        if self.basefile:
+            basefile = self.basefile(not self.noop)
+            if basefile:
+                self.env['CLOUD_BUILD_BASEFILE'] = basefile.as_posix()
+        if self.layer:
+            # The shared layer is installed on top of the base file, the image on top of the layer
+            if 'CLOUD_BUILD_BASEFILE' in self.env:
+                self.layer.env['CLOUD_BUILD_BASEFILE'] = self.env['CLOUD_BUILD_BASEFILE']
+            layer = self.layer(not self.noop)
+            if layer:
+                self.env['CLOUD_BUILD_BASEFILE'] = layer.as_posix()
+        # Runs with all classes even on top of a layer, see RunBaseLayer
+        return self.fai(not self.noop)
 
 
 if __name__ == '__main__':
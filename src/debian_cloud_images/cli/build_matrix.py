@@ -0,0 +1,197 @@
+import logging
+import os
+import shutil
+import subprocess
+import sys
+
+from datetime import datetime
+
+from .base import BaseCommand
+from .build import ArchEnum, BuildCommand, ReleaseEnum, VendorEnum, build_supported
+from ..build.scheduler import Job, ResourceScheduler
+from ..utils.cache import parse_size
+
+
+logger = logging.getLogger()
+
+
+class BuildMatrixCommand(BaseCommand):
+    argparser_name = 'build-matrix'
+    argparser_help = 'build Debian images for several releases, vendors and architectures in parallel'
+    argparser_usage = '%(prog)s'
+
+    @classmethod
+    def _argparse_register(cls, parser):
+        super()._argparse_register(parser)
+
+        parser.add_argument(
+            '--release',
+            action='append',
+            choices=ReleaseEnum.__members__.keys(),
+            dest='releases',
+            help='Debian release to build, may be given multiple times (default: all)',
+            metavar='RELEASE',
+        )
+        parser.add_argument(
+            '--vendor',
+            action='append',
+            choices=VendorEnum.__members__.keys(),
+            dest='vendors',
+            help='Vendor to build image for, may be given multiple times (default: all)',
+            metavar='VENDOR',
+        )
+        parser.add_argument(
+            '--arch',
+            action='append',
+            choices=ArchEnum.__members__.keys(),
+            dest='archs',
+            help='Architecture to build image for, may be given multiple times (default: all)',
+            metavar='ARCH',
+        )
+        BuildCommand._argparse_register_options(parser, defaults=False)
+        parser.add_argument(
+            '--jobs',
+            help='maximum number of parallel builds (default: number of CPUs)',
+            metavar='N',
+            type=int,
+        )
+        parser.add_argument(
+            '--max-disk',
+            help='maximum disk space used by parallel builds (default: free space in output directory)',
+            metavar='SIZE',
+            type=parse_size,
+        )
+        parser.add_argument(
+            '--loop-devices',
+            default=8,
+            help='maximum number of loop devices used by parallel builds (default: 8)',
+            metavar='N',
+            type=int,
+        )
+
+    def __init__(
+            self, *,
+            releases=None, vendors=None, archs=None,
+            build_id=None, build_type=None, noop=False, compress=None, discard_unallocated=False, basefile_cache=None, basefile_cache_size=None, basefile_mirror=None, build_cache=None, build_cache_size=None, package_cache=None, package_cache_size=None, layered=False, localdebs=False, output=None,
+            version=None, version_date=None, jobs=None, max_disk=None, loop_devices=8,
+            **kw,
+    ):
+        super().__init__(**kw)
+
+        self.releases = releases or list(ReleaseEnum.__members__)
+        self.vendors = vendors or list(VendorEnum.__members__)
+        self.archs = archs or list(ArchEnum.__members__)
+        self.build_id = build_id
+        self.build_type = build_type
+        self.noop = noop
+        self.compress = compress
+        self.discard_unallocated = discard_unallocated
+        self.basefile_cache = basefile_cache
+        self.basefile_cache_size = basefile_cache_size
+        self.basefile_mirror = basefile_mirror
+        self.layered = layered
+        self.build_cache = build_cache
+        self.build_cache_size = build_cache_size
+        self.package_cache = package_cache
+        self.package_cache_size = package_cache_size
+        self.localdebs = localdebs
+        self.output = output
+        self.version = version
+        self.version_date = version_date or datetime.now()
+        self.log_path = output / 'build-matrix'
+
+        output.mkdir(parents=True, exist_ok=True)
+
+        self.scheduler = ResourceScheduler({
+            'jobs': jobs or os.cpu_count() or 1,
+            'disk': max_disk or shutil.disk_usage(output).free,
+            'loop_devices': loop_devices,
+        })
+
+    def jobs(self):
+        """ All supported builds of the matrix, largest images first, as they usually take longest """
+        jobs = []
+        for release in self.releases:
+            for vendor in self.vendors:
+                for arch in self.archs:
+                    if not build_supported(release, vendor, arch):
+                        logger.info(f'Skipping unsupported build {release}-{vendor}-{arch}')
+                        continue
+                    jobs.append(Job(
+                        '-'.join((release, vendor, arch)),
+                        self.build_func(release, vendor, arch),
+                        {
+                            'jobs': 1,
+                            'disk': parse_size(VendorEnum[vendor].fai_size),
+                            'loop_devices': 1,
+                        },
+                    ))
+        return sorted(jobs, key=lambda job: job.resources['disk'], reverse=True)
+
+    def build_command(self, release, vendor, arch):
+        cmd = [
+            sys.executable, '-m', 'debian_cloud_images.cli.build',
+            release, vendor, arch,
+            '--build-id', self.build_id.id,
+            '--build-type', self.build_type.name,
+            '--output', self.output.as_posix(),
+            '--version-date', self.version_date.strftime('%Y-%m-%d'),
+        ]
+        if self.version is not None:
+            cmd += ['--version', str(self.version)]
+        if self.compress:
+            cmd += ['--compress', self.compress]
+        if self.discard_unallocated:
+            cmd.append('--discard-unallocated')
+        if self.basefile_cache:
+            cmd += ['--basefile-cache', self.basefile_cache.as_posix()]
+            if self.basefile_cache_size:
+                cmd += ['--basefile-cache-size', str(self.basefile_cache_size)]
+        if self.basefile_mirror:
+            cmd += ['--basefile-mirror', self.basefile_mirror]
+        if self.build_cache:
+            cmd += ['--build-cache', self.build_cache.as_posix()]
+            if self.build_cache_size:
+                cmd += ['--build-cache-size', str(self.build_cache_size)]
+        if self.package_cache:
+            cmd += ['--package-cache', self.package_cache.as_posix()]
+            if self.package_cache_size:
+                cmd += ['--package-cache-size', str(self.package_cache_size)]
+        if self.layered:
+            cmd.append('--layered')
+        if self.localdebs:
+            cmd.append('--localdebs')
+        if self.noop:
+            cmd.append('--noop')
+        return cmd
+
+    def build_func(self, release, vendor, arch):
+        def run():
+            cmd = self.build_command(release, vendor, arch)
+            log = self.log_path / f'{release}-{vendor}-{arch}.log'
+            log.parent.mkdir(parents=True, exist_ok=True)
+            with log.open('w') as f:
+                try:
+                    subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=f, stderr=subprocess.STDOUT, check=True)
+                except subprocess.CalledProcessError as e:
+                    raise RuntimeError(f'build exited with status {e.returncode}, see {log}')
+        return run
+
+    def __call__(self):
+        start = datetime.now()
+        jobs = self.scheduler.run(self.jobs())
+        wall = (datetime.now() - start).total_seconds()
+
+        logger.info('Build matrix summary:')
+        for job in jobs:
+            status = 'failed' if job.error else 'ok'
+            logger.info(f'  {job.name:40} {status:6} {job.duration or 0:8.1f}s')
+        logger.info('Total: %.1fs wall time, %.1fs build time', wall, sum(job.duration or 0 for job in jobs))
+
+        failed = [job.name for job in jobs if job.error]
+        if failed:
+            raise RuntimeError(f'Failed builds: {", ".join(failed)}')
+
+
+if __name__ == '__main__':
+    BuildMatrixCommand._main()
@@ -3,7 +3,7 @@ import logging
 import sys
 
 from .base import BaseCommand
-from .build import ArchEnum, ReleaseEnum, VendorEnum
+from .build import ArchEnum, ReleaseEnum, VendorEnum, build_supported
 
 
 logger = logging.getLogger()
@@ -21,20 +21,9 @@ class GenerateCiCommand(BaseCommand):
             builds = []
 
             for release_name, release in ReleaseEnum.__members__.items():
-                # XXX: Better selection
-                if vendor_name == 'gce' and release_name == 'bullseye':
-                    continue
-
                 for arch_name, arch in ArchEnum.__members__.items():
-                    # XXX: Better arch selection
-                    if vendor_name in ('azure', 'ec2', 'gce'):
-                        if arch_name == 'amd64':
-                            pass
-                        elif arch_name == 'arm64':
-                            if vendor_name not in ('ec2', ):
-                                continue
-                        else:
-                            continue
+                    if not build_supported(release_name, vendor_name, arch_name):
+                        continue
 
                     name = ' '.join((vendor_name, release_name, arch_name, 'build'))
                     extends = '.' + ' '.join((vendor_name, 'build'))
@@ -47,6 +47,8 @@ class UploadCommand(UploadBaseCommand):
         self.storage = storage
 
     def __call__(self):
+        self.skip_unchanged()
+
         PublicImages(
             self.no_op,
             self.image_public_info,
@@ -125,7 +125,8 @@ class ImageUploaderAzure:
         logging.info('Uploading file to %s', path)
 
         with image.open_image('vhd') as f:
-            chunked = ChunkedFile(f, 4 * 1024 * 1024)
+            chunked = ChunkedFile(f, 4 * 1024 * 1024, zero_block_size=64 * 1024)
+            logging.info('Image has %s bytes of data in %s extents', chunked.data_size, len(chunked.extents))
 
             with AzureBlobLease(self.storage_obj, path, True) as lease:
                 headers = {
@@ -285,7 +285,8 @@ class ImageUploaderAzureCloudpartner:
         logging.info('Uploading file to %s', path)
 
         with image.open_image('vhd') as f:
-            chunked = ChunkedFile(f, 4 * 1024 * 1024)
+            chunked = ChunkedFile(f, 4 * 1024 * 1024, zero_block_size=64 * 1024)
+            logging.info('Image has %s bytes of data in %s extents', chunked.data_size, len(chunked.extents))
 
             with AzureBlobLease(self.storage_obj, path, True) as lease:
                 headers = {
@@ -440,6 +441,8 @@ config options:
         )
 
     def __call__(self):
+        self.skip_unchanged()
+
         self.uploader(self.images, self.image_public_info)
 
 
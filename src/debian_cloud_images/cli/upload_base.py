@@ -1,9 +1,17 @@
+import logging
 import pathlib
 
 from .base import BaseCommand
-from ..images import Images
+from ..api.cdo.build import Build
+from ..api.wellknown import annotation_ucdo_unchanged_from
+from ..images import ConvertTuning, Images
 from ..images.publicinfo import ImagePublicInfo, ImagePublicType
+from ..images.reference import ReferenceBuilds
 from ..utils import argparse_ext
+from ..utils.cache import FileCache, parse_size
+
+
+logger = logging.getLogger(__name__)
 
 
 class UploadBaseCommand(BaseCommand):
@@ -38,8 +46,16 @@ class UploadBaseCommand(BaseCommand):
             '--version-override',
             dest='override_version',
         )
+        parser.add_argument(
+            '--skip-unchanged',
+            action='append',
+            dest='references',
+            help='skip images with the same packages as the latest build in a manifest or public storage directory',
+            metavar='PATH',
+            type=pathlib.Path,
+        )
 
-    def __init__(self, *, manifests=[], output=None, public_type=None, override_version=None, **kw):
+    def __init__(self, *, manifests=[], output=None, public_type=None, override_version=None, references=None, **kw):
         super().__init__(**kw)
 
         self.output = output
@@ -48,11 +64,52 @@ class UploadBaseCommand(BaseCommand):
         if override_version:
             override_info['version'] = override_version
         self.image_public_info = ImagePublicInfo(public_type=public_type, override_info=override_info)
+        self.references = ReferenceBuilds(references, public_type) if references else None
+
+        cache = None
+        cache_path = self.config_get('cache.path', default=None)
+        if cache_path:
+            cache_size = self.config_get('cache.size', default=None)
+            cache = FileCache(
+                pathlib.Path(cache_path).expanduser(),
+                max_size=parse_size(cache_size) if cache_size else None,
+            )
+
+        convert_tuning = ConvertTuning(
+            workers=self.config_get('convert.workers', default=None),
+            coroutines=self.config_get('convert.coroutines', default=None),
+            unordered=self.config_get('convert.unordered', default=False),
+        )
 
-        self.images = Images()
+        self.images = Images(cache=cache, convert_tuning=convert_tuning)
         for manifest in manifests:
             self.images.read(manifest)
 
+    def skip_unchanged(self):
+        """ Remove images with unchanged packages, and write a manifest recording the skip """
+        if self.references is None:
+            return
+
+        for name, image in list(self.images.items()):
+            reference = self.references.unchanged(image, self.image_public_info.apply(image.build_info))
+            if reference is None:
+                continue
+
+            logger.info(f'Skipping image {name}, packages unchanged since version {reference.info.get("version")}')
+            metadata = image.build.metadata.copy()
+            metadata.annotations[annotation_ucdo_unchanged_from] = reference.info.get('version', '')
+            build = Build(info=image.build_info, packages=image.build.packages, metadata=metadata)
+            image.write_manifests('upload-unchanged', [build], output=self.output)
+            del self.images[name]
+
     def __call__(self):
+        self.skip_unchanged()
+        self.upload_images()
+
+        if self.images.cache is not None:
+            logger.info('Image cache: %(hits)d hits, %(misses)d misses', self.images.cache.stats())
+
+    def upload_images(self):
+        """ Upload images one after another """
         for image in self.images.values():
             self.uploader(image, public_info=self.image_public_info.apply(image.build_info))
@@ -1,17 +1,27 @@
+import collections
+import concurrent.futures
 import logging
-import time
+import os
+import threading
 
-from libcloud.compute.types import VolumeSnapshotState
+from libcloud.compute.base import VolumeSnapshot
 
 from .upload_base import UploadBaseCommand
 from ..api.cdo.upload import Upload
 from ..api.wellknown import label_ucdo_provider, label_ucdo_type
-from ..utils.libcloud.compute.ec2 import ExEC2NodeDriver
+from ..utils.cache import parse_size
+from ..utils.files import ChunkedFile, pread_into, zeros
+from ..utils.libcloud.compute.ec2 import ExEC2ImportSnapshotWaiter, ExEC2NodeDriver, ExEC2SnapshotWaiter
+from ..utils.libcloud.other.aws_ebs import EBSConnection, ebs_checksum_linear
 from ..utils.libcloud.storage.s3 import S3BucketStorageDriver
+from ..utils.vmdk import VmdkStreamOptimized
 
 
 class ImageUploaderEc2:
     compute_cls = ExEC2NodeDriver
+    ebs_cls = EBSConnection
+    import_waiter_cls = ExEC2ImportSnapshotWaiter
+    snapshot_waiter_cls = ExEC2SnapshotWaiter
     storage_cls = S3BucketStorageDriver
 
     architecture_map = {
@@ -19,7 +29,17 @@ class ImageUploaderEc2:
         'arm64': 'arm64',
     }
 
-    def __init__(self, output, bucket, key, secret, token, regions, add_tags, permission_public):
+    # Concurrent snapshot copies into one region allowed by EC2
+    copies_per_region = 20
+
+    # Blocks written to EBS snapshots at the same time
+    ebs_workers = 16
+
+    # Parts of the S3 staging object and how many are uploaded at the same time
+    storage_part_size = 16 * 1024 * 1024
+    storage_workers = 8
+
+    def __init__(self, output, bucket, key, secret, token, regions, add_tags, permission_public, workers=None, copies_per_region=None, ebs_direct=False, storage_part_size=None, storage_workers=None):
         self.output = output
         self.bucket = bucket
         self.key = key
@@ -28,8 +48,18 @@ class ImageUploaderEc2:
         self.regions = regions
         self.add_tags = add_tags or {}
         self.permission_public = permission_public
+        self.workers = workers
+        self.ebs_direct = ebs_direct
+        if copies_per_region:
+            self.copies_per_region = copies_per_region
+        if storage_part_size:
+            self.storage_part_size = storage_part_size
+        if storage_workers:
+            self.storage_workers = storage_workers
 
         self.__compute = self.__storage = None
+        self.__copy_slots = collections.defaultdict(lambda: threading.BoundedSemaphore(self.copies_per_region))
+        self.__copy_slots_lock = threading.Lock()
 
     @property
     def compute(self):
@@ -61,14 +91,71 @@ class ImageUploaderEc2:
         return ret
 
     def __call__(self, image, public_info):
-        name = public_info.vendor_name
-
-        obj = self.upload_file(image, name)
+        self.upload_images([(image, public_info)])
+
+    def upload_images(self, images):
+        """
+        Upload several images, given as (image, public_info).
+
+        Files are uploaded one after another and their import is started
+        right away, so imports run while later files are still uploaded.
+        All import tasks are checked together and each image is copied and
+        registered as soon as its own snapshot is available.  A failed image
+        does not stop the others.
+        """
+        errors = {}
+        futures = {}
+        futures_lock = threading.Lock()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(images) or 1) as executor, \
+                self.import_waiter_cls() as waiter:
+
+            def submit(image, public_info, obj, snapshot, error=None):
+                with futures_lock:
+                    future = executor.submit(self.publish_image, image, public_info, obj, snapshot, error)
+                    futures[future] = public_info.vendor_name
+
+            def track(image, public_info, obj, task):
+                waiter.add(
+                    task,
+                    lambda snapshot: submit(image, public_info, obj, snapshot),
+                    lambda task, error: submit(image, public_info, obj, None, error),
+                )
 
+            for image, public_info in images:
+                obj = None
+                try:
+                    if self.ebs_direct:
+                        submit(image, public_info, None, self.upload_snapshot(image, public_info))
+                        continue
+
+                    obj = self.upload_file(image, public_info.vendor_name)
+                    track(image, public_info, obj, self.import_snapshot(image, public_info, obj))
+
+                except Exception as e:
+                    logging.exception('Image %s failed', public_info.vendor_name)
+                    errors[public_info.vendor_name] = e
+                    if obj is not None:
+                        self.delete_file(image, obj)
+
+        for future, name in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                logging.exception('Image %s failed', name)
+                errors[name] = e
+
+        if errors:
+            raise RuntimeError('Upload failed for images: {}'.format(', '.join(sorted(errors))))
+
+    def publish_image(self, image, public_info, obj, snapshot, error=None):
+        """ Copy snapshot and register images in all regions, then delete file from storage """
         try:
-            ec2_snapshot = self.import_snapshot(image, public_info, obj)
-            ec2_snapshots = self.copy_snapshot(image, public_info, ec2_snapshot)
-            ec2_images = self.create_image(image, public_info, ec2_snapshots)
+            if error is not None:
+                raise error
+
+            errors = {}
+            ec2_images = self.copy_image(image, public_info, snapshot, errors)
 
             manifests = []
             for region, ec2_image in ec2_images.items():
@@ -85,8 +172,12 @@ class ImageUploaderEc2:
 
             image.write_manifests('upload-ec2', manifests, output=self.output)
 
+            if errors:
+                raise RuntimeError('Upload failed in regions: {}'.format(', '.join(sorted(errors))))
+
         finally:
-            self.delete_file(image, obj)
+            if obj is not None:
+                self.delete_file(image, obj)
 
     def generate_permissions(self, name):
         if self.permission_public:
@@ -104,103 +195,250 @@ class ImageUploaderEc2:
         })
         return tags
 
-    def create_image(self, image, public_info, snapshots):
-        """ Create images in all regions """
+    def fan_out(self, func, items, errors):
+        """
+        Call func(region, item) for all regions in a thread pool.
+
+        Returns results by region.  Failures only affect their own region,
+        they are logged and recorded in errors.
+        """
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers or min(len(items), 32) or 1) as executor:
+            futures = {executor.submit(func, region, item): region for region, item in items.items()}
+            for future in concurrent.futures.as_completed(futures):
+                region = futures[future]
+                try:
+                    results[region] = future.result()
+                except Exception as e:
+                    logging.exception('Region %s failed', region)
+                    errors[region] = e
+        return results
+
+    def copy_slot(self, region):
+        """ Semaphore limiting concurrent snapshot copies into region """
+        with self.__copy_slots_lock:
+            return self.__copy_slots[region]
+
+    def copy_image(self, image, public_info, snapshot_base, errors):
+        """
+        Copy snapshot to all regions and create images there.
+
+        Images are registered as soon as the snapshot in their region is
+        available, while copies to other regions are still running.
+        """
+        futures = {}
+        futures_lock = threading.Lock()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers or 8) as executor, \
+                self.snapshot_waiter_cls() as waiter:
+
+            def available(snapshot):
+                with futures_lock:
+                    futures[executor.submit(self.create_image, image, public_info, snapshot)] = snapshot.driver.region_name
+
+            def failed(snapshot, error):
+                logging.error('%s', error)
+                errors[snapshot.driver.region_name] = error
+
+            self.copy_snapshot(image, public_info, snapshot_base, waiter, available, failed, errors)
 
         ec2_images = {}
+        for future, region in futures.items():
+            try:
+                ec2_images[region] = future.result()
+            except Exception as e:
+                logging.exception('Region %s failed', region)
+                errors[region] = e
+        return ec2_images
 
-        for snapshot in snapshots:
-            mapping = [{
-                'DeviceName': '/dev/xvda',
-                'Ebs': {
-                    'SnapshotId': snapshot.id,
-                    'VolumeType': 'gp2',
-                    'DeleteOnTermination': 'true',
-                },
-            }]
-
-            driver = snapshot.driver
-            architecture = self.architecture_map[image.build_arch]
-
-            ec2_image = driver.ex_register_image(
-                name=public_info.vendor_name,
-                description=public_info.vendor_description,
-                architecture=architecture,
-                block_device_mapping=mapping,
-                root_device_name='/dev/xvda',
-                virtualization_type='hvm',
-                ena_support=True,
-                sriov_net_support='simple',
-            )
+    def create_image(self, image, public_info, snapshot):
+        """ Create image from snapshot in its region """
 
-            logging.info('Image %s/%s arch %s registered from %s', driver.region_name, ec2_image.id, architecture, snapshot.id)
+        mapping = [{
+            'DeviceName': '/dev/xvda',
+            'Ebs': {
+                'SnapshotId': snapshot.id,
+                'VolumeType': 'gp2',
+                'DeleteOnTermination': 'true',
+            },
+        }]
 
-            driver.ex_create_tags(ec2_image, self.generate_tags(image, public_info))
-            driver.ex_modify_image_attribute(
-                ec2_image,
-                self.generate_permissions('LaunchPermission'),
-            )
+        driver = snapshot.driver
+        architecture = self.architecture_map[image.build_arch]
 
-            ec2_images[driver.region_name] = ec2_image
+        ec2_image = driver.ex_register_image(
+            name=public_info.vendor_name,
+            description=public_info.vendor_description,
+            architecture=architecture,
+            block_device_mapping=mapping,
+            root_device_name='/dev/xvda',
+            virtualization_type='hvm',
+            ena_support=True,
+            sriov_net_support='simple',
+            tags=self.generate_tags(image, public_info),
+        )
 
-        return ec2_images
+        logging.info('Image %s/%s arch %s registered from %s', driver.region_name, ec2_image.id, architecture, snapshot.id)
+
+        driver.ex_modify_image_attribute(
+            ec2_image,
+            self.generate_permissions('LaunchPermission'),
+        )
+
+        return ec2_image
 
-    def copy_snapshot(self, image, public_info, snapshot_base):
-        """ Copy snapshot to other regions """
+    def copy_snapshot(self, image, public_info, snapshot_base, waiter, available, failed, errors):
+        """ Copy snapshot to other regions, waiter reports when each copy is done """
 
         region_base = snapshot_base.driver.region_name
         compute_regions = self.compute_regions(region_base)
+        tags = self.generate_tags(image, public_info)
 
-        snapshots_creating = []
-        for region, compute in compute_regions.items():
+        def copy(region, compute):
+            slot = None
             if region == region_base:
+                # Snapshots written with the EBS direct APIs got their tags at creation
+                if not self.ebs_direct:
+                    compute.ex_create_tags(snapshot_base, tags)
                 snapshot = snapshot_base
             else:
-                snapshot = compute.ex_copy_snapshot(
-                    snapshot_base,
-                    public_info.vendor_description,
+                # Copies are queued while the region has no free slot, the
+                # slot is only released once the copy is done
+                slot = self.copy_slot(region)
+                slot.acquire()
+
+            def done(func):
+                def wrapper(*args):
+                    if slot:
+                        slot.release()
+                    func(*args)
+                return wrapper
+
+            try:
+                if slot:
+                    snapshot = compute.ex_copy_snapshot(
+                        snapshot_base,
+                        public_info.vendor_description,
+                        tags=tags,
+                    )
+                    logging.info('Copy snapshot to %s/%s', region, snapshot.id)
+
+                compute.ex_modify_snapshot_attribute(
+                    snapshot,
+                    self.generate_permissions('CreateVolumePermission'),
                 )
 
-                logging.info('Copy snapshot to %s/%s', region, snapshot.id)
+            except BaseException:
+                if slot:
+                    slot.release()
+                raise
+
+            waiter.add(snapshot, done(available), done(failed))
+
+        self.fan_out(copy, compute_regions, errors)
+
+    def wait_snapshot(self, snapshot):
+        """ Wait for single snapshot to become available """
+        result = {}
 
-            compute.ex_create_tags(snapshot, self.generate_tags(image, public_info))
-            compute.ex_modify_snapshot_attribute(
+        with self.snapshot_waiter_cls() as waiter:
+            waiter.add(
                 snapshot,
-                self.generate_permissions('CreateVolumePermission'),
+                lambda s: result.update(snapshot=s),
+                lambda s, e: result.update(error=e),
             )
 
-            snapshots_creating.append(snapshot)
+        if 'error' in result:
+            raise result['error']
+        return result['snapshot']
 
-        snapshots_available = []
-        while len(snapshots_creating):
-            snapshot = snapshots_creating.pop(0)
-            snapshots_new = snapshot.driver.list_snapshots(snapshot)
-            if not snapshots_new:
-                snapshot_new = snapshot
-            else:
-                snapshot_new = snapshots_new[0]
+    def upload_snapshot(self, image, public_info):
+        """ Write image directly into new snapshot in same region as bucket, using the EBS direct APIs """
 
-            state = snapshot_new.state
+        region_name = self.storage.region_name
+        local = threading.local()
 
-            if state == VolumeSnapshotState.CREATING:
-                time.sleep(15)
-                snapshots_creating.append(snapshot_new)
-            elif state == VolumeSnapshotState.AVAILABLE:
-                logging.info('Snapshot %s/%s available', snapshot_new.driver.region_name, snapshot_new.id)
-                snapshots_available.append(snapshot_new)
-            else:
-                logging.error('Snapshot %s/%s in unknown state', snapshot_new.driver.region_name, snapshot_new.id)
+        def connection():
+            if not hasattr(local, 'connection'):
+                local.connection = self.ebs_cls(self.key, self.secret, region_name, token=self.token)
+            return local.connection
+
+        with image.open_image(None) as f:
+            size = f.seek(0, os.SEEK_END)
+            snapshot = connection().start_snapshot(
+                volume_size=-(-size // 1024 ** 3),
+                description=public_info.vendor_description,
+                tags=self.generate_tags(image, public_info),
+            )
+            snapshot_id, block_size = snapshot['SnapshotId'], snapshot['BlockSize']
+
+            logging.info('Write snapshot %s/%s', region_name, snapshot_id)
+
+            def put(index):
+                buf = bytearray(block_size)
+                offset = index * block_size
+                with memoryview(buf) as mv, mv[:min(block_size, size - offset)] as smv:
+                    pread_into(f, smv, offset)
+                if buf == zeros(block_size):
+                    return None
+                return connection().put_snapshot_block(snapshot_id, index, buf)
+
+            try:
+                checksums = {}
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self.ebs_workers) as executor:
+                    # Keep a bounded number of blocks in memory
+                    window = threading.BoundedSemaphore(self.ebs_workers * 2)
+                    futures = {}
+                    for index in self.snapshot_blocks(f, size, block_size):
+                        window.acquire()
+                        future = executor.submit(put, index)
+                        future.add_done_callback(lambda future: window.release())
+                        futures[future] = index
+
+                    for future in concurrent.futures.as_completed(futures):
+                        checksum = future.result()
+                        if checksum is not None:
+                            checksums[futures[future]] = checksum
+
+                logging.info('Wrote %d blocks of %d bytes to snapshot %s/%s', len(checksums), block_size, region_name, snapshot_id)
+
+                connection().complete_snapshot(
+                    snapshot_id,
+                    len(checksums),
+                    ebs_checksum_linear(checksums[i] for i in sorted(checksums)),
+                )
+
+            except BaseException:
+                self.delete_snapshot(VolumeSnapshot(snapshot_id, self.compute[region_name]))
+                raise
+
+        return self.wait_snapshot(VolumeSnapshot(snapshot_id, self.compute[region_name]))
 
-        return snapshots_available
+    def delete_snapshot(self, snapshot):
+        """ Delete snapshot left behind by failed upload """
+
+        logging.info('Deleting snapshot %s/%s', snapshot.driver.region_name, snapshot.id)
+
+        try:
+            snapshot.driver.destroy_volume_snapshot(snapshot)
+        except Exception:
+            logging.exception('Unable to delete snapshot %s/%s', snapshot.driver.region_name, snapshot.id)
+
+    @staticmethod
+    def snapshot_blocks(f, size, block_size):
+        """ Iterate over index of snapshot blocks containing data extents """
+        last = -1
+        for offset, length in ChunkedFile(f, block_size).extents:
+            for index in range(max(offset // block_size, last + 1), -(-(offset + length) // block_size)):
+                yield index
+                last = index
 
     def import_snapshot(self, image, public_info, obj):
-        """ Import file as snapshot in same region as bucket """
+        """ Start import of file as snapshot in same region as bucket, returns the import task """
 
         region_name = obj.driver.region_name
 
-        logging.info('Import snapshot to region %s', region_name)
-
-        return self.compute[region_name].ex_import_snapshot(
+        task = self.compute[region_name].ex_start_import_snapshot(
             description=public_info.vendor_description,
             disk_container=[{
                 'Description': 'root',
@@ -212,6 +450,10 @@ class ImageUploaderEc2:
             }],
         )
 
+        logging.info('Import snapshot to %s/%s', region_name, task.id)
+
+        return task
+
     def delete_file(self, image, obj):
         """ Delete file from storage """
 
@@ -226,11 +468,12 @@ class ImageUploaderEc2:
 
         logging.info('Uploading file to %s/%s', self.bucket, file_out)
 
-        with image.open_image('vmdk') as f:
-            return self.storage.upload_object_via_stream(
-                iterator=f,
-                container=None,
+        with image.open_image(None) as f:
+            return self.storage.ex_upload_object_via_stream_parallel(
+                iterator=iter(VmdkStreamOptimized(f)),
                 object_name=file_out,
+                part_size=self.storage_part_size,
+                workers=self.storage_workers,
                 extra={'content_type': 'application/octet-stream'},
             )
 
@@ -241,6 +484,11 @@ class UploadEc2Command(UploadBaseCommand):
     argparser_epilog = '''
 config options:
   ec2.storage.name     create temporary image file in this S3 bucket
+  ec2.storage.part_size
+                       size of parts to upload temporary image file in (default: 16M)
+  ec2.storage.workers  number of parts to upload at the same time (default: 8)
+  ec2.image.workers    number of regions to work on at the same time (default: all, up to 32)
+  ec2.image.copies     concurrent snapshot copies into one region (default: 20)
 '''
 
     @classmethod
@@ -252,10 +500,17 @@ config options:
             action='store_true',
             help='Make snapshot and image public',
         )
+        parser.add_argument(
+            '--ebs-direct',
+            action='store_true',
+            help='Write image directly into snapshot via the EBS direct APIs, instead of importing it from S3',
+        )
 
-    def __init__(self, *, regions=[], add_tags={}, permission_public, **kw):
+    def __init__(self, *, regions=[], add_tags={}, permission_public, ebs_direct=False, **kw):
         super().__init__(**kw)
 
+        storage_part_size = self.config_get('ec2.storage.part_size', default=None)
+
         self.uploader = ImageUploaderEc2(
             output=self.output,
             bucket=self.config_get('ec2.storage.name'),
@@ -265,8 +520,20 @@ config options:
             regions=self.config_get('ec2.image.regions', default=[]),
             add_tags=dict(tuple(i.split('=', 1)) for i in self.config_get('ec2.image.tags', default=[])),
             permission_public=permission_public,
+            workers=self.config_get('ec2.image.workers', default=None),
+            copies_per_region=self.config_get('ec2.image.copies', default=None),
+            ebs_direct=ebs_direct,
+            storage_part_size=parse_size(storage_part_size) if storage_part_size else None,
+            storage_workers=self.config_get('ec2.storage.workers', default=None),
         )
 
+    def upload_images(self):
+        """ Upload all images together, so their imports run at the same time """
+        self.uploader.upload_images([
+            (image, self.image_public_info.apply(image.build_info))
+            for image in self.images.values()
+        ])
+
 
 if __name__ == '__main__':
     UploadEc2Command._main()
@@ -1,3 +1,4 @@
+import contextlib
 import json
 import logging
 import zlib
@@ -15,6 +16,7 @@ from libcloud.storage.providers import get_driver as storage_driver
 class ImageUploaderGce:
     storage_cls = storage_driver(StorageProvider.GOOGLE_STORAGE)
     compute_cls = compute_driver(ComputeProvider.GCE)
+    gzip_level = 3
 
     def __init__(self, output, project, bucket, auth):
         self.output = output
@@ -116,21 +118,33 @@ class ImageUploaderGce:
 
         logging.info('Uploading file to %s/%s', self.bucket, file_out)
 
-        with image.open_tar() as tar:
-            f = tar.fileobj
-            f.seek(0)
+        def compressed():
+            with image.open_tar() as tar:
+                f_in = tar.fileobj
+                f_in.seek(0)
+                yield from self.gzip_compress(f_in)
+
+        def create(name):
+            with open(name, 'wb') as f_out:
+                for s in compressed():
+                    f_out.write(s)
+
+        # The compressed tar depends on the level, so it is part of the cache key
+        f = image.open_cached(('tar.gz', f'level={self.gzip_level}'), create)
+
+        with contextlib.ExitStack() as stack:
             return self.storage.upload_object_via_stream(
-                iterator=self.gzip_compress(f),
+                iterator=stack.enter_context(f) if f is not None else compressed(),
                 container=self.storage_container,
                 object_name=file_out,
                 extra={'content_type': 'application/octet-stream'},
             )
 
-    @staticmethod
-    def gzip_compress(f):
+    @classmethod
+    def gzip_compress(cls, f):
         """ Transparent compress stream with gzip """
         c = zlib.compressobj(
-            level=3,
+            level=cls.gzip_level,
             wbits=31,
         )
 
@@ -1,24 +1,40 @@
+import collections
+import concurrent.futures
 import contextlib
+import functools
 import json
 import logging
 import os
 import subprocess
 import tarfile
 import tempfile
+import threading
 
 from ..api.cdo.build import Build
 from ..api.cdo.upload import Upload
 from ..api.registry import registry as api_registry
+from ..api.wellknown import annotation_cdo_digest
+from ..utils.files import TarMemberFile
+from ..utils.vhd import VhdFixedFile
+from ..utils.xz import XzBlockFile
 
 
 logger = logging.getLogger(__name__)
 
 
+ConvertTuning = collections.namedtuple('ConvertTuning', ('workers', 'coroutines', 'unordered'), defaults=(None, None, False))
+
+
 class Images(dict):
+    def __init__(self, *, cache=None, convert_tuning=None):
+        super().__init__()
+        self.cache = cache
+        self.convert_tuning = convert_tuning
+
     def read(self, manifest):
         try:
             name = manifest.name.rsplit('.', 3)[0]
-            image = self.setdefault(name, Image(name, manifest.parent))
+            image = self.setdefault(name, Image(name, manifest.parent, cache=self.cache, convert_tuning=self.convert_tuning))
             image.read_manifests(manifest)
 
         except Exception:
@@ -26,9 +42,11 @@ class Images(dict):
 
 
 class Image:
-    def __init__(self, name, path):
+    def __init__(self, name, path, cache=None, convert_tuning=None):
         self.name = name
         self.__path = path
+        self.__cache = cache
+        self.__convert_tuning = convert_tuning or ConvertTuning()
         self.__builds = []
         self.__uploads = []
 
@@ -64,80 +82,150 @@ class Image:
     def uploads(self):
         return self.__uploads
 
+    virtual_image_formats = {
+        'vhd': VhdFixedFile,
+    }
+
+    convert_image_options = {
+        'qcow2': ('-O', 'qcow2', '-c', '-o', 'compat=1.1'),
+        'vmdk': ('-O', 'vmdk', '-o', 'subformat=streamOptimized'),
+    }
+
     def _convert_image_f(self, format):
-        if format == 'qcow2':
-            return self.__convert_image_to_qcow2
-        if format == 'vhd':
-            return self.__convert_image_to_vhd
-        if format == 'vmdk':
-            return self.__convert_image_to_vmdk
-        raise NotImplementedError
-
-    def __convert_image_to_qcow2(self, name_in, name_out):
-        subprocess.check_call((
-            'qemu-img',
-            'convert',
-            '-f', 'raw',
-            '-O', 'qcow2',
-            '-c',
-            '-o', 'compat=1.1',
-            name_in,
-            name_out,
-        ))
+        if format not in self.convert_image_options:
+            raise NotImplementedError
+        return functools.partial(self.__convert_image, self.convert_image_options[format])
 
-    def __convert_image_to_vhd(self, name_in, name_out):
-        subprocess.check_call((
-            'qemu-img',
-            'convert',
-            '-f', 'raw',
-            '-O', 'vpc',
-            '-o', 'subformat=fixed,force_size',
-            name_in,
-            name_out,
-        ))
+    def __convert_image(self, options, name_in, name_out):
+        tuning = ()
+        if self.__convert_tuning.coroutines:
+            tuning += ('-m', str(self.__convert_tuning.coroutines))
+        if self.__convert_tuning.unordered:
+            tuning += ('-W', )
 
-    def __convert_image_to_vmdk(self, name_in, name_out):
         subprocess.check_call((
             'qemu-img',
             'convert',
             '-f', 'raw',
-            '-O', 'vmdk',
-            '-o', 'subformat=streamOptimized',
+        ) + tuning + options + (
             name_in,
             name_out,
         ))
 
+    def cache_key(self, *parts):
+        """ Get key of cache entry derived from this image, if cache and digest exist """
+        if self.__cache is None:
+            return None
+        digest = self.build.metadata.annotations.get(annotation_cdo_digest)
+        if not digest:
+            return None
+        return self.__cache.key(digest, *parts)
+
+    def open_cached(self, parts, create):
+        """ Open cache entry derived from this image, or return None if not cachable """
+        key = self.cache_key(*parts)
+        if key is None:
+            return None
+        return self.__cache.open(key, create)
+
     @contextlib.contextmanager
     def open_image(self, *formats):
-        with self.open_tar() as tar:
-            with tempfile.TemporaryDirectory() as tempdirname:
-                names = []
+        with contextlib.ExitStack() as stack:
+            tempdirname = stack.enter_context(tempfile.TemporaryDirectory())
+            name_raw = os.path.join(tempdirname, 'disk.raw')
+            name_raw_lock = threading.Lock()
+            files = []
+            converts = {}
+
+            def extract():
+                with name_raw_lock:
+                    if not os.path.exists(name_raw):
+                        logger.debug('Extract image to %s', name_raw)
+                        with self.open_tar() as tar:
+                            tar.extract('disk.raw', path=tempdirname, set_attrs=False)
+                return name_raw
+
+            for format in formats:
+                if not format or format in self.virtual_image_formats:
+                    f = self.open_image_raw()
+                    if f is None:
+                        f = open(extract(), mode='rb', buffering=0)
+                    else:
+                        logger.debug('Reading image in place from tar')
+                    if format:
+                        logger.debug('Providing image as %s view', format)
+                        f = self.virtual_image_formats[format](f)
+                    files.append(stack.enter_context(f))
+                else:
+                    converts[len(files)] = format
+                    files.append(None)
+
+            if converts:
+                workers = self.__convert_tuning.workers or min(len(converts), os.cpu_count() or 1)
+                with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = {
+                        i: executor.submit(self._open_converted, format, extract, tempdirname)
+                        for i, format in converts.items()
+                    }
+                # Register all opened files before raising any error, so none leak
+                error = None
+                for i, future in futures.items():
+                    try:
+                        files[i] = stack.enter_context(future.result())
+                    except Exception as e:
+                        error = error or e
+                if error is not None:
+                    raise error
+
+            if len(files) == 1:
+                yield files[0]
+            else:
+                yield files
 
-                name_raw = os.path.join(tempdirname, 'disk.raw')
+    def _open_converted(self, format, extract, tempdirname):
+        convert = self._convert_image_f(format)
 
-                logger.debug('Extract image to %s', name_raw)
-                tar.extract('disk.raw', path=tempdirname, set_attrs=False)
+        def create(name_converted):
+            name_in = extract()
+            logger.debug('Converting image %s to %s as %s', name_in, name_converted, format)
+            convert(name_in, name_converted)
 
-                for format in formats:
-                    if format:
-                        name_converted = os.path.join(tempdirname, 'disk.{}'.format(format))
-                        names.append(name_converted)
+        f = self.open_cached((format, ) + self.convert_image_options[format], create)
+        if f is None:
+            name_converted = os.path.join(tempdirname, 'disk.{}'.format(format))
+            create(name_converted)
+            f = open(name_converted, mode='rb', buffering=0)
+        return f
 
-                        convert = self._convert_image_f(format)
-                        logger.debug('Converting image %s to %s as %s', name_raw, name_converted, format)
-                        convert(name_raw, name_converted)
-                    else:
-                        names.append(name_raw)
+    def open_image_raw(self):
+        """ Open raw image in place, if the tar file is uncompressed or seekable """
+        f_in = self.open_tar_decompressed()
+        if f_in is None:
+            return None
 
-                files = [open(i, mode='rb', buffering=0) for i in names]
-                if len(files) == 1:
-                    yield files[0]
-                else:
-                    yield files
-                [f.close() for f in files]
+        return TarMemberFile.open(f_in, 'disk.raw')
 
     def open_tar(self):
-        return tarfile.open(fileobj=self.open_tar_raw(), mode='r:*')
+        f_in = self.open_tar_decompressed()
+        if f_in is None:
+            f_in = self.open_tar_raw()
+        return tarfile.open(fileobj=f_in, mode='r:*')
+
+    def open_tar_decompressed(self):
+        """ Open seekable uncompressed tar, or return None if not available """
+        f_in = self.open_tar_raw()
+        if f_in.extension == '.tar':
+            return f_in
+
+        if f_in.extension == '.tar.xz':
+            f = XzBlockFile.open(f_in)
+            if f is not None:
+                logger.debug('Using parallel decompression of %d xz blocks', len(f.blocks))
+                return f
+            logger.debug('No xz block index found, using sequential decompression')
+
+        f_in.close()
+        return None
 
     def open_tar_raw(self):
         for ext in ('.tar', '.tar.xz'):
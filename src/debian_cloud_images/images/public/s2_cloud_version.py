@@ -12,6 +12,7 @@ from datetime import datetime
 
 from .info import PublicInfo
 from .s3_cloud_image import StepCloudImages
+from ...utils.digest import DigestPipeline
 from ...utils.image_version import ImageVersion
 
 
@@ -102,16 +103,14 @@ class StepCloudVersionAdd(StepCloudVersion):
             files.update(i.files)
             files_latest.update(i.files_latest)
 
-        chfile = self.__path / 'SHA512SUMS'
-        with chfile.open('w') as f:
-            for n, d in sorted(files.items()):
-                print(f'{d.hexdigest()}  {n}', file=f)
-        chfile.chmod(0o444)
+        for algorithm in DigestPipeline.algorithms:
+            self.__write_digest_file(self.__path / f'{algorithm.upper()}SUMS', algorithm, files)
+            self.__write_digest_file(self.__path_latest / f'{algorithm.upper()}SUMS', algorithm, files_latest)
 
-        chfile = self.__path_latest / 'SHA512SUMS'
+    def __write_digest_file(self, chfile, algorithm, files):
         with chfile.open('w') as f:
-            for n, d in sorted(files_latest.items()):
-                print(f'{d.hexdigest()}  {n}', file=f)
+            for n, d in sorted(files.items()):
+                print(f'{d[algorithm].hexdigest()}  {n}', file=f)
         chfile.chmod(0o444)
 
 
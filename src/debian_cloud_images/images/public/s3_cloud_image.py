@@ -1,17 +1,18 @@
 from __future__ import annotations
 
-import base64
 import collections.abc
 import hashlib
 import json
 import logging
+import os
 import pathlib
 import typing
 
 from ...api.cdo.upload import Upload
 from ...api.registry import registry as api_registry
 from ...api.wellknown import annotation_cdo_digest, label_ucdo_image_format, label_ucdo_type
-from ...utils.files import ChunkedFile
+from ...utils.digest import DigestPipeline, format_digest
+from ...utils.files import ChunkedFile, zeros
 
 from .info import PublicInfo
 
@@ -25,7 +26,7 @@ class StepCloudImage:
     basepath: pathlib.Path
     baseref: str
 
-    files: typing.Dict[str, hashlib._Hash]
+    files: typing.Dict[str, typing.Dict[str, hashlib._Hash]]
     manifests: typing.List
 
     def __init__(self, info: PublicInfo, name: str, family: str, basepath: pathlib.Path, baseref: str) -> None:
@@ -66,13 +67,14 @@ class StepCloudImage:
         manifests = self.__manifests_input + self.manifests
         path = self.__path.with_suffix('.json')
         path_latest = self.__path_latest.with_suffix('.json')
-        output_hash = hashlib.sha512()
+        output_hash = {a: hashlib.new(a) for a in DigestPipeline.algorithms}
 
         with path.open('wb') as f:
             s = json.dumps(api_registry.dump(manifests), indent=4, separators=(',', ': '), sort_keys=True)
             s = s.encode('utf-8')
             f.write(s)
-            output_hash.update(s)
+            for h in output_hash.values():
+                h.update(s)
         path.chmod(0o444)
 
         path_latest.symlink_to(pathlib.Path('..') / path.name)
@@ -115,15 +117,19 @@ class StepCloudImage:
         ref = self.__ref + '.raw'
         logger.info(f'Copy to {ref}')
         with path.open('wb') as f_out:
-            output_hash = hashlib.sha512()
-            chunked = ChunkedFile(f_in, 4 * 1024 * 1024)
-            for chunk in chunked:
-                data = chunk.read()
-                output_hash.update(data)
-                if chunk.is_data:
-                    f_out.seek(chunk.offset)
-                    f_out.write(data)
+            chunked = ChunkedFile(f_in, 4 * 1024 * 1024, zero_block_size=64 * 1024)
+            with DigestPipeline(lambda data, offset: os.pwrite(f_out.fileno(), data, offset)) as pipeline:
+                for chunk in chunked:
+                    if chunk.is_data:
+                        buf = pipeline.get_buffer()
+                        with memoryview(buf) as mv, mv[:chunk.size] as smv:
+                            chunk.readinto(smv)
+                        pipeline.put_buffer(buf, chunk.size, offset=chunk.offset)
+                    else:
+                        # Holes are only hashed, the file is truncated to full size below
+                        pipeline.put(zeros(chunk.size), write=False)
             f_out.truncate(chunked.size)
+            output_hash = pipeline.hashes
         path.chmod(0o444)
 
         path_latest.symlink_to(pathlib.Path('..') / path.name)
@@ -147,29 +153,15 @@ class StepCloudImage:
         self._append_manifest(image, ref, 'internal', output_hash)
         self._append_file(path, path_latest, output_hash)
 
-    def __copy_hash(self, f_in, f_out, length=64 * 1024):
-        output_hash = hashlib.sha512()
+    def __copy_hash(self, f_in, f_out):
+        with DigestPipeline(lambda data, offset: f_out.write(data)) as pipeline:
+            pipeline.readfrom(f_in)
 
-        with memoryview(bytearray(length)) as mv:
-            while True:
-                n = f_in.readinto(mv)
-                if not n:
-                    break
-                elif n < length:
-                    with mv[:n] as smv:
-                        f_out.write(smv)
-                        output_hash.update(smv)
-                else:
-                    f_out.write(mv)
-                    output_hash.update(mv)
-
-        return output_hash
+        return pipeline.hashes
 
     def _append_manifest(self, image, ref, image_format, output_hash):
-        output_digest = base64.b64encode(output_hash.digest()).decode().rstrip('=')
-
         metadata = image.build.metadata.copy()
-        metadata.annotations[annotation_cdo_digest] = f'{output_hash.name}:{output_digest}'
+        metadata.annotations[annotation_cdo_digest] = ','.join(format_digest(h) for h in output_hash.values())
         metadata.labels[label_ucdo_image_format] = image_format
         metadata.labels[label_ucdo_type] = self._info.public_type
 
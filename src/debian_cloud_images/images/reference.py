@@ -0,0 +1,73 @@
+import json
+import logging
+import pathlib
+import typing
+
+from ..api.cdo.build import Build
+from ..api.registry import registry as api_registry
+from .publicinfo import ImagePublicType
+
+
+logger = logging.getLogger(__name__)
+
+
+class ReferenceBuilds:
+    """
+    Previously published builds to compare new images against.
+
+    References are either manifest files, or the storage tree written by
+    PublicImages, where the latest manifest of each image family is used.
+    """
+
+    paths: typing.List[pathlib.Path]
+    public_type: ImagePublicType
+
+    def __init__(self, paths: typing.Iterable[pathlib.Path], public_type: ImagePublicType) -> None:
+        self.paths = list(paths)
+        self.public_type = public_type
+
+    def _manifest_files(self, image, public_info) -> typing.Iterator[pathlib.Path]:
+        for path in self.paths:
+            if path.is_dir():
+                path = path / image.build_release
+                if self.public_type != ImagePublicType.release:
+                    path = path / self.public_type.name
+                path = path / 'latest' / f'{public_info.family}.json'
+                if not path.exists():
+                    logger.debug(f'No published manifest {path}')
+                    continue
+            yield path
+
+    def find(self, image, public_info) -> typing.Optional[Build]:
+        """ Find reference build of same release, vendor and arch, but other version """
+        for path in self._manifest_files(image, public_info):
+            with path.open() as f:
+                manifests = api_registry.load(json.load(f))
+            if not isinstance(manifests, list):
+                manifests = [manifests]
+
+            for manifest in manifests:
+                if not isinstance(manifest, Build):
+                    continue
+                if all(manifest.info.get(k) == image.build_info.get(k) for k in ('release', 'vendor', 'arch')) \
+                        and manifest.info.get('version') != image.build_version:
+                    return manifest
+
+        return None
+
+    @staticmethod
+    def packages(build: Build) -> typing.Optional[typing.List[typing.Tuple[str, str]]]:
+        if build.packages is None:
+            return None
+        return sorted((p['name'], p['version']) for p in build.packages)
+
+    def unchanged(self, image, public_info) -> typing.Optional[Build]:
+        """ Returns reference build if it has the same packages as the image """
+        packages = self.packages(image.build)
+        if packages is None:
+            return None
+
+        reference = self.find(image, public_info)
+        if reference is not None and self.packages(reference) == packages:
+            return reference
+        return None
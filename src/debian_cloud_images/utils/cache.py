@@ -0,0 +1,199 @@
+import contextlib
+import fcntl
+import hashlib
+import logging
+import os
+import pathlib
+import re
+import tempfile
+import threading
+import typing
+
+
+logger = logging.getLogger(__name__)
+
+
+def parse_size(s) -> int:
+    """ Parse size with optional binary suffix, like 30G """
+    if isinstance(s, int):
+        return s
+    r = re.match(r'^\s*(\d+)\s*([KMGT]?)i?B?\s*$', str(s), re.IGNORECASE)
+    if not r:
+        raise ValueError(f'invalid size value: {s}')
+    return int(r.group(1)) * 1024 ** ' KMGT'.index(r.group(2).upper() or ' ')
+
+
+class FileCache:
+    """
+    Persistent cache of files, addressed by the digest of their key.
+
+    New entries are written to a temporary file and renamed into place while
+    holding a per-entry lock, so concurrent processes never see partial
+    entries and never create the same entry twice.  Once the total size
+    exceeds max_size, the least recently used entries are evicted down to
+    evict_ratio of max_size, together with their lock files.  The size is
+    tracked while adding entries, so the cache is only scanned again once
+    it is expected to exceed max_size.
+    """
+
+    path: pathlib.Path
+    max_size: typing.Optional[int]
+    evict_ratio: float = 0.9
+    hits: int
+    misses: int
+
+    def __init__(self, path: pathlib.Path, max_size: typing.Optional[int] = None) -> None:
+        self.path = pathlib.Path(path)
+        self.max_size = max_size
+        self.hits = self.misses = 0
+        self.__size: typing.Optional[int] = None
+        self.__stats_lock = threading.Lock()
+
+    @staticmethod
+    def key(*parts: str) -> str:
+        h = hashlib.sha256()
+        for part in parts:
+            h.update(str(part).encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def _entry_path(self, key: str) -> pathlib.Path:
+        return self.path / key[:2] / key
+
+    @staticmethod
+    def _lock_path(path: pathlib.Path) -> pathlib.Path:
+        return path.with_name(f'.{path.name}.lock')
+
+    @contextlib.contextmanager
+    def _lock(self, path: pathlib.Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        while True:
+            f = open(path, 'a')
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.stat(path).st_ino == os.fstat(f.fileno()).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            # Lock file was removed by evict while waiting, lock the new one
+            f.close()
+
+        with f:
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _remove_locked(path: pathlib.Path, lock_path: pathlib.Path) -> bool:
+        """ Remove entry and its lock file, unless the entry is in use, returns False if it is """
+        try:
+            f = open(lock_path, 'a')
+        except FileNotFoundError:
+            f = None
+        with contextlib.ExitStack() as stack:
+            if f is not None:
+                stack.enter_context(f)
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return False
+            for i in (path, lock_path):
+                with contextlib.suppress(FileNotFoundError):
+                    i.unlink()
+        return True
+
+    def get(self, key: str):
+        """ Open existing cache entry, returns None if missing """
+        path = self._entry_path(key)
+        try:
+            f = open(path, mode='rb', buffering=0)
+        except FileNotFoundError:
+            return None
+
+        os.utime(path)
+        with self.__stats_lock:
+            self.hits += 1
+        logger.info('Cache hit for %s', key)
+        return f
+
+    def open(self, key: str, create: typing.Callable[[str], None]):
+        """
+        Open cache entry, create it by calling create(filename) if missing.
+
+        The returned file stays readable even if the entry is evicted later.
+        """
+        path = self._entry_path(key)
+
+        with self._lock(self._lock_path(path)):
+            try:
+                f = open(path, mode='rb', buffering=0)
+                # Use mtime to record last use, atime is often unreliable
+                os.utime(path)
+                with self.__stats_lock:
+                    self.hits += 1
+                logger.info('Cache hit for %s', key)
+                return f
+            except FileNotFoundError:
+                pass
+
+            with self.__stats_lock:
+                self.misses += 1
+            logger.info('Cache miss for %s', key)
+
+            fd, name = tempfile.mkstemp(prefix=f'.{key}_', dir=path.parent)
+            os.close(fd)
+            try:
+                create(name)
+                os.chmod(name, 0o444)
+                os.rename(name, path)
+            except BaseException:
+                os.unlink(name)
+                raise
+
+            f = open(path, mode='rb', buffering=0)
+
+        if self.max_size is not None:
+            with self.__stats_lock:
+                if self.__size is not None:
+                    self.__size += os.fstat(f.fileno()).st_blocks * 512
+                scan = self.__size is None or self.__size > self.max_size
+            if scan:
+                self.evict(keep=(key, ))
+        return f
+
+    def evict(self, keep: typing.Iterable[str] = ()) -> None:
+        """ Remove least recently used entries above max_size, and lock files of missing entries """
+        if self.max_size is None:
+            return
+
+        with self._lock(self.path / '.lock'):
+            entries = []
+            size = 0
+            for path in self.path.glob('??/*'):
+                if path.name.startswith('.'):
+                    # Lock file left by failed or evicted entry
+                    if path.name.endswith('.lock') and not path.with_name(path.name[1:-5]).exists():
+                        self._remove_locked(path.with_name(path.name[1:-5]), path)
+                    continue
+                try:
+                    st = path.stat()
+                except FileNotFoundError:
+                    continue
+                size += st.st_blocks * 512
+                if path.name not in keep:
+                    entries.append((st.st_mtime, st.st_blocks * 512, path))
+
+            if size > self.max_size:
+                for mtime, entry_size, path in sorted(entries):
+                    if size <= self.max_size * self.evict_ratio:
+                        break
+                    if self._remove_locked(path, self._lock_path(path)):
+                        logger.info('Evicting cache entry %s', path.name)
+                        size -= entry_size
+
+            with self.__stats_lock:
+                self.__size = size
+
+    def stats(self) -> typing.Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,138 @@
+import base64
+import hashlib
+import queue
+import threading
+import typing
+
+
+def format_digest(h) -> str:
+    """ Format digest as used in manifests, like sha512:<base64> """
+    output_digest = base64.b64encode(h.digest()).decode().rstrip('=')
+    return f'{h.name}:{output_digest}'
+
+
+class DigestPipeline:
+    """
+    Write and hash a stream of data in parallel threads.
+
+    The writer and every digest run in their own thread, each fed by its own
+    queue, so reading, writing and hashing overlap.  hashlib releases the GIL
+    on large buffers, so digests scale across cores.  Buffers come from a
+    bounded pool and return to it once all consumers are done with them,
+    which bounds memory use and blocks the producer if consumers fall behind.
+    """
+
+    algorithms = ('sha512', 'sha256')
+
+    class _Item:
+        __slots__ = ('data', 'offset', 'write', 'buf', 'pending')
+
+        def __init__(self, data, offset, write, buf, pending):
+            self.data = data
+            self.offset = offset
+            self.write = write
+            self.buf = buf
+            self.pending = pending
+
+    def __init__(
+            self,
+            write: typing.Optional[typing.Callable] = None,
+            *,
+            algorithms: typing.Iterable[str] = algorithms,
+            buffers: int = 4,
+            buffer_size: int = 4 * 1024 * 1024,
+    ) -> None:
+        self.hashes = {a: hashlib.new(a) for a in algorithms}
+        self.buffer_size = buffer_size
+        self.error: typing.Optional[BaseException] = None
+
+        self.__write = write
+        self.__free: queue.Queue = queue.Queue()
+        for i in range(buffers):
+            self.__free.put(bytearray(buffer_size))
+        self.__lock = threading.Lock()
+        self.__queues: typing.List[queue.Queue] = []
+        self.__threads: typing.List[threading.Thread] = []
+
+    def __enter__(self):
+        consumers = [self._consume_hash(h) for h in self.hashes.values()]
+        if self.__write is not None:
+            consumers.append(self._consume_write)
+
+        for consumer in consumers:
+            q: queue.Queue = queue.Queue()
+            t = threading.Thread(target=self._run, args=(q, consumer), daemon=True)
+            t.start()
+            self.__queues.append(q)
+            self.__threads.append(t)
+        return self
+
+    def __exit__(self, type, value, tb):
+        for q in self.__queues:
+            q.put(None)
+        for t in self.__threads:
+            t.join()
+        if self.error is not None and value is None:
+            raise self.error
+
+    def _run(self, q: queue.Queue, consumer: typing.Callable) -> None:
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            try:
+                if self.error is None:
+                    consumer(item)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self._release(item)
+
+    @staticmethod
+    def _consume_hash(h):
+        def consume(item):
+            h.update(item.data)
+        return consume
+
+    def _consume_write(self, item) -> None:
+        if item.write:
+            self.__write(item.data, item.offset)
+
+    def _release(self, item) -> None:
+        with self.__lock:
+            item.pending -= 1
+            done = not item.pending
+        if done and item.buf is not None:
+            item.data.release()
+            self.__free.put(item.buf)
+
+    def _submit(self, data, offset, write, buf) -> None:
+        if self.error is not None:
+            raise self.error
+        item = self._Item(data, offset, write, buf, len(self.__queues))
+        for q in self.__queues:
+            q.put(item)
+
+    def get_buffer(self) -> bytearray:
+        """ Get free buffer from the pool, blocks until one is available """
+        if self.error is not None:
+            raise self.error
+        return self.__free.get()
+
+    def put_buffer(self, buf: bytearray, length: int, *, offset: typing.Optional[int] = None, write: bool = True) -> None:
+        """ Process first length bytes of buffer from get_buffer and return it to the pool afterwards """
+        self._submit(memoryview(buf)[:length], offset, write, buf)
+
+    def put(self, data: bytes, *, offset: typing.Optional[int] = None, write: bool = True) -> None:
+        """ Process immutable data """
+        self._submit(data, offset, write, None)
+
+    def readfrom(self, f_in) -> None:
+        """ Process all data read from file """
+        while True:
+            buf = self.get_buffer()
+            n = f_in.readinto(buf)
+            if not n:
+                self.__free.put(buf)
+                return
+            self.put_buffer(buf, n)
@@ -0,0 +1,271 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+Map of blocks allocated by the filesystems of a disk image.
+
+Only the partition table and the block bitmaps of ext4 filesystems are
+read.  Everything the map can't account for, like other filesystems,
+unpartitioned space or a damaged filesystem, is reported as allocated.
+"""
+
+import logging
+import struct
+import typing
+import zlib
+
+from collections import namedtuple
+
+from .files import pread_into
+
+
+logger = logging.getLogger(__name__)
+
+
+Partition = namedtuple('Partition', ('offset', 'size', 'type'))
+
+sector_size = 512
+
+mbr_types_gpt = frozenset((0xee, ))
+mbr_types_extended = frozenset((0x05, 0x0f, 0x85))
+
+ext4_magic = 0xef53
+ext4_feature_compat_sparse_super2 = 0x0200
+ext4_feature_incompat_meta_bg = 0x0010
+ext4_feature_incompat_64bit = 0x0080
+ext4_feature_ro_compat_sparse_super = 0x0001
+ext4_feature_ro_compat_bigalloc = 0x0200
+ext4_bg_block_uninit = 0x0002
+
+
+def _pread(fileobj, size: int, offset: int) -> bytes:
+    buf = bytearray(size)
+    n = pread_into(fileobj, buf, offset)
+    if n < size:
+        raise EOFError(f'Unexpected end of file at {offset + n}')
+    return buf
+
+
+def partitions(fileobj) -> typing.List[Partition]:
+    """
+    Read partitions from a GPT or MBR partition table.
+
+    The type is the partition type GUID for GPT and the type byte for MBR.
+    Returns an empty list if no partition table was found.
+    """
+    mbr = _pread(fileobj, sector_size, 0)
+    if mbr[510:512] != b'\x55\xaa':
+        return []
+
+    entries = [struct.unpack_from('<4xB3xII', mbr, 446 + i * 16) for i in range(4)]
+    if any(t in mbr_types_gpt for t, start, count in entries):
+        return gpt_partitions(fileobj)
+
+    ret = []
+    for t, start, count in entries:
+        if not t or not count:
+            continue
+        if t in mbr_types_extended:
+            logger.debug('Ignoring extended partition')
+            continue
+        ret.append(Partition(start * sector_size, count * sector_size, t))
+    return ret
+
+
+def gpt_partitions(fileobj) -> typing.List[Partition]:
+    header = _pread(fileobj, sector_size, sector_size)
+    signature, revision, header_size, header_crc = struct.unpack_from('<8sIII', header, 0)
+    if signature != b'EFI PART':
+        raise ValueError('No GPT header found')
+
+    check = bytearray(header[:header_size])
+    check[16:20] = bytes(4)
+    if zlib.crc32(check) != header_crc:
+        raise ValueError('GPT header checksum mismatch')
+
+    entries_lba, entries_count, entry_size, entries_crc = struct.unpack_from('<QIII', header, 72)
+    entries = _pread(fileobj, entries_count * entry_size, entries_lba * sector_size)
+    if zlib.crc32(entries) != entries_crc:
+        raise ValueError('GPT partition entries checksum mismatch')
+
+    ret = []
+    for i in range(entries_count):
+        t, first, last = struct.unpack_from('<16s16xQQ', entries, i * entry_size)
+        if t == bytes(16):
+            continue
+        ret.append(Partition(first * sector_size, (last - first + 1) * sector_size, t))
+    return ret
+
+
+def _bitmap_extents(bitmap: bytes, count: int) -> typing.Iterator[typing.Tuple[int, int]]:
+    """ Iterate over (first, number) of runs of set bits in the first count bits """
+    bits = int.from_bytes(bitmap, 'little') & ((1 << count) - 1)
+    pos = 0
+    while bits:
+        skip = (bits & -bits).bit_length() - 1
+        bits >>= skip
+        pos += skip
+        length = (~bits & (bits + 1)).bit_length() - 1
+        yield pos, length
+        bits >>= length
+        pos += length
+
+
+def _has_super(group: int, sparse_super: bool) -> bool:
+    if group <= 1 or not sparse_super:
+        return True
+    for base in (3, 5, 7):
+        n = base
+        while n < group:
+            n *= base
+        if n == group:
+            return True
+    return False
+
+
+def ext4_allocated_extents(fileobj, offset: int) -> typing.Optional[typing.List[typing.Tuple[int, int]]]:
+    """
+    Read (offset, size) of all blocks allocated in the ext4 filesystem at offset.
+
+    Returns None if there is no ext4 filesystem or it uses a layout not
+    supported here.
+    """
+    sb = _pread(fileobj, 1024, offset + 1024)
+    if struct.unpack_from('<H', sb, 0x38)[0] != ext4_magic:
+        return None
+
+    blocks_count_lo, first_data_block, log_block_size = struct.unpack_from('<4xI12xII', sb, 0)
+    blocks_per_group, inodes_per_group = struct.unpack_from('<I4xI', sb, 0x20)
+    rev_level, = struct.unpack_from('<I', sb, 0x4c)
+    inode_size, = struct.unpack_from('<H', sb, 0x58) if rev_level else (128, )
+    compat, incompat, ro_compat = struct.unpack_from('<III', sb, 0x5c)
+    reserved_gdt_blocks, = struct.unpack_from('<H', sb, 0xce)
+    block_size = 1024 << log_block_size
+
+    blocks_count = blocks_count_lo
+    desc_size = 32
+    if incompat & ext4_feature_incompat_64bit:
+        blocks_count |= struct.unpack_from('<I', sb, 0x150)[0] << 32
+        desc_size = struct.unpack_from('<H', sb, 0xfe)[0] or desc_size
+
+    if incompat & ext4_feature_incompat_meta_bg or compat & ext4_feature_compat_sparse_super2 \
+            or ro_compat & ext4_feature_ro_compat_bigalloc:
+        logger.info('Unsupported ext4 layout')
+        return None
+
+    groups = -(-(blocks_count - first_data_block) // blocks_per_group)
+    gdt_blocks = -(-(groups * desc_size) // block_size)
+    gdt = _pread(fileobj, groups * desc_size, offset + (first_data_block + 1) * block_size)
+    inode_table_blocks = -(-(inodes_per_group * inode_size) // block_size)
+    sparse_super = bool(ro_compat & ext4_feature_ro_compat_sparse_super)
+
+    # Block and inode bitmaps and inode tables may be placed in other groups
+    # with flex_bg, their blocks are always allocated
+    blocks = []
+    descs = []
+    for group in range(groups):
+        desc = gdt[group * desc_size:(group + 1) * desc_size]
+        block_bitmap, inode_bitmap, inode_table, flags = struct.unpack_from('<III6xH', desc, 0)
+        if desc_size >= 64:
+            hi = struct.unpack_from('<III', desc, 0x20)
+            block_bitmap |= hi[0] << 32
+            inode_bitmap |= hi[1] << 32
+            inode_table |= hi[2] << 32
+        blocks.extend(((block_bitmap, 1), (inode_bitmap, 1), (inode_table, inode_table_blocks)))
+        descs.append((block_bitmap, flags))
+
+    for group, (block_bitmap, flags) in enumerate(descs):
+        start = first_data_block + group * blocks_per_group
+        count = min(blocks_per_group, blocks_count - start)
+
+        if flags & ext4_bg_block_uninit:
+            # Bitmap never written, only superblock and descriptor backups are in use
+            if _has_super(group, sparse_super):
+                blocks.append((start, 1 + gdt_blocks + reserved_gdt_blocks))
+            continue
+
+        bitmap = _pread(fileobj, -(-count // 8), offset + block_bitmap * block_size)
+        blocks.extend((start + first, length) for first, length in _bitmap_extents(bitmap, count))
+
+    # Blocks in front of the first group, like the boot block of 1k filesystems
+    blocks.append((0, first_data_block))
+
+    return [
+        (offset + first * block_size, length * block_size)
+        for first, length in merge_extents(b for b in blocks if b[1])
+    ]
+
+
+def merge_extents(extents: typing.Iterable[typing.Tuple[int, int]]) -> typing.List[typing.Tuple[int, int]]:
+    """ Sort (offset, size) extents and merge overlapping or adjacent ones """
+    ret: typing.List[typing.Tuple[int, int]] = []
+    for offset, size in sorted(extents):
+        if ret and offset <= ret[-1][0] + ret[-1][1]:
+            last_offset, last_size = ret[-1]
+            ret[-1] = (last_offset, max(last_size, offset + size - last_offset))
+        else:
+            ret.append((offset, size))
+    return ret
+
+
+def ext4_filesystems(fileobj, size: int) -> typing.List[Partition]:
+    """
+    Read partitions of a disk image containing an ext4 filesystem.
+
+    Disk images without partition table are checked for a plain ext4
+    filesystem.
+    """
+    ret = []
+    for part in partitions(fileobj) or [Partition(0, size, None)]:
+        try:
+            sb = _pread(fileobj, 1024, part.offset + 1024)
+        except EOFError:
+            continue
+        if struct.unpack_from('<H', sb, 0x38)[0] == ext4_magic:
+            ret.append(part)
+    return ret
+
+
+def allocated_extents(fileobj, size: int) -> typing.List[typing.Tuple[int, int]]:
+    """
+    Read (offset, size) of all ranges of a disk image, which may hold data.
+
+    Ranges inside ext4 filesystems are only included if allocated by the
+    filesystem, the partition table and all other ranges are always included.
+    Disk images without partition table are checked for a plain ext4
+    filesystem.
+    """
+    try:
+        parts = partitions(fileobj) or [Partition(0, size, None)]
+    except (EOFError, ValueError) as e:
+        logger.warning(f'Unable to read partition table: {e}')
+        return [(0, size)]
+
+    extents = []
+    current = 0
+    for part in sorted(parts):
+        try:
+            fs = ext4_allocated_extents(fileobj, part.offset)
+        except (EOFError, ValueError) as e:
+            logger.warning(f'Unable to read filesystem at {part.offset}: {e}')
+            fs = None
+        if fs is None:
+            continue
+
+        fs_end = part.offset + part.size
+        extents.append((current, part.offset - current))
+        extents.extend((o, min(s, fs_end - o)) for o, s in fs if o < fs_end)
+        current = fs_end
+
+    extents.append((current, size - current))
+    return merge_extents(e for e in extents if e[1] > 0)
+
+
+def unallocated_extents(fileobj, size: int) -> typing.List[typing.Tuple[int, int]]:
+    """ Read (offset, size) of all ranges of a disk image, which don't hold data """
+    ret = []
+    current = 0
+    for offset, length in allocated_extents(fileobj, size) + [(size, 0)]:
+        if offset > current:
+            ret.append((current, offset - current))
+        current = max(current, offset + length)
+    return ret
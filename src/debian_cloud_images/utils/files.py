@@ -1,10 +1,183 @@
+import bisect
+import ctypes
 import errno
+import functools
+import io
 import os
+import tarfile
+import threading
+import typing
+
+from collections import namedtuple
+
+
+_seek_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=16)
+def _zeros(size: int) -> bytes:
+    return bytes(size)
+
+
+def zeros(size: int) -> bytes:
+    """ Shared read-only buffer of zeros, only chunk sized buffers are kept """
+    if size > 4 * 1024 * 1024:
+        return bytes(size)
+    return _zeros(size)
+
+
+def pread_into(fileobj, b, offset: int) -> int:
+    """
+    Read into buffer from offset, without using the file position.
+
+    Uses readinto_at of virtual files or pread on real files, both are safe to
+    use from several threads.  Other files are read via seek and readinto
+    under a global lock.
+    """
+    readinto_at = getattr(fileobj, 'readinto_at', None)
+    if readinto_at is not None:
+        return readinto_at(b, offset)
+
+    try:
+        fd = fileobj.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        fd = None
+
+    with memoryview(b) as mv_raw, mv_raw.cast('B') as mv:
+        done = 0
+        while done < len(mv):
+            with mv[done:] as smv:
+                if fd is not None:
+                    n = os.preadv(fd, [smv], offset + done)
+                else:
+                    with _seek_lock:
+                        fileobj.seek(offset + done, os.SEEK_SET)
+                        n = fileobj.readinto(smv)
+            if not n:
+                break
+            done += n
+        return done
+
+
+def data_extents(fileobj, size: int):
+    """ Iterate over (offset, size) of all data sections of a file """
+    hole_offset = 0
+
+    while hole_offset < size:
+        try:
+            data_offset = fileobj.seek(hole_offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+            return
+
+        hole_offset = fileobj.seek(data_offset, os.SEEK_HOLE)
+        yield data_offset, hole_offset - data_offset
+
+
+def copy_sparse(fileobj_in, fileobj_out, size: int, buffer_size: int = 4 * 1024 * 1024) -> None:
+    """ Copy the data sections of a file, keeping holes as holes """
+    buf = bytearray(buffer_size)
+    with memoryview(buf) as mv:
+        for offset, length in data_extents(fileobj_in, size):
+            end = offset + length
+            while offset < end:
+                with mv[:min(buffer_size, end - offset)] as smv:
+                    n = pread_into(fileobj_in, smv, offset)
+                    if not n:
+                        raise EOFError(f'Unexpected end of file at {offset}')
+                    os.pwrite(fileobj_out.fileno(), smv[:n], offset)
+                offset += n
+    fileobj_out.truncate(size)
+
+
+def zero_runs(buf, offset: int, block_size: int):
+    """
+    Iterate over (start, end, is_zero) of alternating runs in buf, read from offset.
+
+    Runs are made of blocks aligned to block_size in the file, partial
+    blocks at both ends included.  The buffer is compared to zeros as a
+    whole first; only buffers with data are checked block by block.  buf
+    should be bytes or bytearray, comparing memoryviews is slow.
+    """
+    length = len(buf)
+    if not length:
+        return
+    if buf == zeros(length):
+        yield 0, length, True
+        return
+
+    zero = zeros(block_size)
+    run_start = 0
+    run_zero = None
+    pos = 0
+    while pos < length:
+        end = min((offset + pos) // block_size * block_size + block_size - offset, length)
+        is_zero = buf[pos:end] == (zero if end - pos == block_size else zero[:end - pos])
+        if pos and is_zero != run_zero:
+            yield run_start, pos, run_zero
+            run_start = pos
+        run_zero = is_zero
+        pos = end
+
+    yield run_start, length, run_zero
+
+
+def zero_extents(fileobj, size: int, block_size: int = 4096, buffer_size: int = 4 * 1024 * 1024):
+    """ Iterate over (offset, size) of aligned blocks of data sections containing only zeros """
+    buffer_size -= buffer_size % block_size
+    buf = bytearray(buffer_size)
+
+    for data_offset, data_size in data_extents(fileobj, size):
+        begin = -(-data_offset // block_size) * block_size
+        end = (data_offset + data_size) // block_size * block_size
+        run_begin = None
+
+        for offset in range(begin, end, buffer_size):
+            length = min(end - offset, buffer_size)
+            with memoryview(buf) as mv, mv[:length] as smv:
+                n = pread_into(fileobj, smv, offset)
+            if n < length:
+                raise EOFError(f'Unexpected end of file at {offset + n}')
+
+            for start, stop, is_zero in zero_runs(buf if length == buffer_size else buf[:length], offset, block_size):
+                if is_zero:
+                    if run_begin is None:
+                        run_begin = offset + start
+                elif run_begin is not None:
+                    yield run_begin, offset + start - run_begin
+                    run_begin = None
+
+        if run_begin is not None:
+            yield run_begin, end - run_begin
+
+
+@functools.lru_cache(maxsize=None)
+def _fallocate():
+    libc = ctypes.CDLL(None, use_errno=True)
+    f = getattr(libc, 'fallocate64', None) or libc.fallocate
+    f.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+    f.restype = ctypes.c_int
+    return f
+
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+
+def punch_hole(fileobj, offset: int, size: int) -> None:
+    """ Deallocate range of file, which then reads as zeros """
+    if _fallocate()(fileobj.fileno(), FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, size):
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
 
 
 class ChunkedFile:
     """
     Read chunks of a file with a maximum size.
+
+    If zero_block_size is set, data chunks are read while iterating and
+    zero blocks in them are returned as holes.
     """
 
     class ChunkData:
@@ -17,8 +190,31 @@ class ChunkedFile:
             self.size = size
 
         def read(self, length=None) -> bytes:
-            self.fileobj.seek(self.offset, os.SEEK_SET)
-            return self.fileobj.read(self.size)
+            buf = bytearray(self.size)
+            n = self.readinto(buf)
+            del buf[n:]
+            return buf
+
+        def readinto(self, b) -> int:
+            """ Read chunk into start of caller supplied buffer """
+            with memoryview(b) as mv:
+                with mv[:self.size] as smv:
+                    return pread_into(self.fileobj, smv, self.offset)
+
+    class ChunkBuffered(ChunkData):
+        """ Data chunk already read while checking for zeros """
+
+        def __init__(self, fileobj, offset: int, size: int, data: bytes) -> None:
+            super().__init__(fileobj, offset, size)
+            self.data = data
+
+        def read(self, length=None) -> bytes:
+            return self.data
+
+        def readinto(self, b) -> int:
+            with memoryview(b) as mv:
+                mv[:self.size] = self.data
+            return self.size
 
     class ChunkHole:
         is_data = False
@@ -30,12 +226,19 @@ class ChunkedFile:
             self.size = size
 
         def read(self, length=None) -> bytes:
-            return b'\0' * self.size
+            return zeros(self.size)
+
+        def readinto(self, b) -> int:
+            with memoryview(b) as mv:
+                mv[:self.size] = zeros(self.size)
+            return self.size
 
-    def __init__(self, fileobj, chunk_size: int) -> None:
+    def __init__(self, fileobj, chunk_size: int, zero_block_size: typing.Optional[int] = None) -> None:
         self.fileobj = fileobj
         self.size = fileobj.seek(0, os.SEEK_END)
         self.chunk_size = chunk_size
+        self.zero_block_size = zero_block_size
+        self.__extents = None
 
     def __enter__(self):
         return self
@@ -44,24 +247,49 @@ class ChunkedFile:
         self.fileobj.close()
 
     def __iter__(self):
-        data_offset = hole_offset = self.fileobj.seek(0, os.SEEK_SET)
-
-        while True:
-            # Detect start next data section
-            try:
-                data_offset = self.fileobj.seek(hole_offset, os.SEEK_DATA)
-            except OSError as e:
-                if e.errno != errno.ENXIO:
-                    raise
-                # Next data section would be after end of file
-                yield from self.chunks(hole_offset, self.size, self.ChunkHole)
-                return
+        hole_offset = 0
 
+        for data_offset, data_size in self.extents:
             yield from self.chunks(hole_offset, data_offset, self.ChunkHole)
+            hole_offset = data_offset + data_size
+            if self.zero_block_size:
+                yield from self.chunks_nonzero(data_offset, hole_offset)
+            else:
+                yield from self.chunks(data_offset, hole_offset, self.ChunkData)
 
-            # Detect start next hole section
-            hole_offset = self.fileobj.seek(data_offset, os.SEEK_HOLE)
-            yield from self.chunks(data_offset, hole_offset, self.ChunkData)
+        yield from self.chunks(hole_offset, self.size, self.ChunkHole)
+
+    @property
+    def extents(self) -> typing.List[typing.Tuple[int, int]]:
+        """ Index of (offset, size) of all data extents, built once from SEEK_DATA/SEEK_HOLE """
+        if self.__extents is None:
+            self.__extents = list(data_extents(self.fileobj, self.size))
+        return self.__extents
+
+    @property
+    def data_size(self) -> int:
+        """ Total size of all data extents """
+        return sum(size for offset, size in self.extents)
+
+    def chunks_nonzero(self, begin: int, end: int):
+        """
+        Read data chunks while iterating, aligned blocks of zero_block_size
+        containing only zeros are returned as holes.  Data is only read once,
+        the remaining data chunks carry it along.
+        """
+        for chunk in self.chunks(begin, end, self.ChunkData):
+            buf = bytearray(chunk.size)
+            n = chunk.readinto(buf)
+            if n < chunk.size:
+                raise EOFError(f'Unexpected end of file at {chunk.offset + n}')
+
+            for start, stop, is_zero in zero_runs(buf, chunk.offset, self.zero_block_size):
+                if is_zero:
+                    yield self.ChunkHole(self.fileobj, chunk.offset + start, stop - start)
+                elif start == 0 and stop == chunk.size:
+                    yield self.ChunkBuffered(self.fileobj, chunk.offset, chunk.size, buf)
+                else:
+                    yield self.ChunkBuffered(self.fileobj, chunk.offset + start, stop - start, buf[start:stop])
 
     def chunks(self, begin: int, end: int, cls):
         blocks, remainder = divmod(end - begin, self.chunk_size)
@@ -73,3 +301,139 @@ class ChunkedFile:
         if remainder:
             start = begin + blocks * self.chunk_size
             yield cls(self.fileobj, start, remainder)
+
+
+class ExtentFile(io.RawIOBase):
+    """
+    Read-only file assembled from extents of other files.
+
+    Every extent maps a range of this file onto a range of a backing file.
+    Ranges not covered by any extent are holes; they read as zeros and are
+    reported via SEEK_DATA and SEEK_HOLE.
+    """
+
+    Extent = namedtuple('Extent', ('offset', 'size', 'fileobj', 'fileoffset'))
+
+    def __init__(self, size: int, extents) -> None:
+        self.size = size
+        self.extents = sorted((e for e in extents if e.size), key=lambda e: e.offset)
+        self.__extents_start = [e.offset for e in self.extents]
+        self.__current = 0
+
+    def _extent_find(self, offset: int) -> int:
+        """ Find number of first extent ending after offset """
+        n = bisect.bisect_right(self.__extents_start, offset) - 1
+        if n < 0 or self.extents[n].offset + self.extents[n].size <= offset:
+            n += 1
+        return n
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.__current
+
+    def readinto(self, b) -> int:
+        n = self.readinto_at(b, self.__current)
+        self.__current += n
+        return n
+
+    def readinto_at(self, b, offset: int) -> int:
+        """ Read into buffer from offset, safe to use from several threads """
+        with memoryview(b) as mv_raw, mv_raw.cast('B') as mv:
+            length = min(len(mv), max(self.size - offset, 0))
+            done = 0
+            n = self._extent_find(offset)
+
+            while done < length:
+                current = offset + done
+                extent = self.extents[n] if n < len(self.extents) else None
+
+                if extent is None or current < extent.offset:
+                    # Fill hole up to next extent
+                    end = min(extent.offset if extent else self.size, offset + length)
+                    mv[done:done + end - current] = zeros(end - current)
+                    done += end - current
+                    continue
+
+                end = min(extent.offset + extent.size, offset + length)
+                with mv[done:end - offset] as smv:
+                    r = pread_into(extent.fileobj, smv, extent.fileoffset + current - extent.offset)
+                if r != end - current:
+                    raise EOFError('Unexpected end of backing file')
+                done += r
+                n += 1
+
+            return done
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            pass
+        elif whence == os.SEEK_CUR:
+            offset += self.__current
+        elif whence == os.SEEK_END:
+            offset += self.size
+        elif whence == os.SEEK_DATA:
+            n = self._extent_find(offset)
+            if offset >= self.size or n >= len(self.extents):
+                raise OSError(errno.ENXIO, 'Behind end of file')
+            offset = max(offset, self.extents[n].offset)
+        elif whence == os.SEEK_HOLE:
+            if offset >= self.size:
+                raise OSError(errno.ENXIO, 'Behind end of file')
+            n = self._extent_find(offset)
+            while n < len(self.extents) and self.extents[n].offset <= offset:
+                offset = self.extents[n].offset + self.extents[n].size
+                n += 1
+            offset = min(offset, self.size)
+        else:
+            raise io.UnsupportedOperation
+
+        if offset < 0:
+            raise ValueError('Negative seek position')
+
+        self.__current = offset
+        return offset
+
+
+class TarMemberFile(ExtentFile):
+    """
+    Read-only view of a member of an uncompressed tar file.
+
+    GNU and PAX sparse members are mapped through their sparse map, so data
+    is read in place from the archive and holes stay holes.
+    """
+
+    def __init__(self, fileobj, tarinfo: tarfile.TarInfo) -> None:
+        if not tarinfo.isreg():
+            raise ValueError(f'Tar member {tarinfo.name} is no regular file')
+
+        extents = []
+        if tarinfo.sparse is None:
+            extents.append(self.Extent(0, tarinfo.size, fileobj, tarinfo.offset_data))
+        else:
+            fileoffset = tarinfo.offset_data
+            for offset, size in tarinfo.sparse:
+                extents.append(self.Extent(offset, size, fileobj, fileoffset))
+                fileoffset += size
+
+        super().__init__(tarinfo.size, extents)
+        self.fileobj = fileobj
+
+    @classmethod
+    def open(cls, fileobj, name: str):
+        """ Open member of uncompressed tar file, takes ownership of fileobj """
+        try:
+            with tarfile.open(fileobj=fileobj, mode='r:') as tar:
+                return cls(fileobj, tar.getmember(name))
+        except BaseException:
+            fileobj.close()
+            raise
+
+    def close(self) -> None:
+        if not self.closed:
+            self.fileobj.close()
+        super().close()
@@ -1,4 +1,8 @@
-from libcloud.compute.types import Provider
+import logging
+import threading
+import time
+
+from libcloud.compute.types import Provider, VolumeSnapshotState
 from libcloud.compute.drivers.ec2 import BaseEC2NodeDriver, EC2Connection, NAMESPACE, VolumeSnapshot
 from libcloud.utils.xml import findtext, fixxpath
 
@@ -29,13 +33,25 @@ class ExEC2NodeDriver(BaseEC2NodeDriver):
         endpoint = element.find(fixxpath('regionEndpoint', namespace=NAMESPACE)).text
         return ExEC2Region(name, endpoint)
 
-    def ex_copy_snapshot(self, snapshot, description):
+    @staticmethod
+    def _get_tag_specification_params(resource_type, tags, index=1):
+        """ Parameters to tag resources at creation time """
+        root = f'TagSpecification.{index}.'
+        params = {root + 'ResourceType': resource_type}
+        for i, (k, v) in enumerate(tags.items(), start=1):
+            params[f'{root}Tag.{i}.Key'] = k
+            params[f'{root}Tag.{i}.Value'] = v
+        return params
+
+    def ex_copy_snapshot(self, snapshot, description, tags=None):
         params = {
             'Action': 'CopySnapshot',
             'Description': description,
             'SourceRegion': snapshot.driver.region_name,
             'SourceSnapshotId': snapshot.id,
         }
+        if tags:
+            params.update(self._get_tag_specification_params('snapshot', tags))
 
         response = self.connection.request(self.path, params=params).object
 
@@ -43,6 +59,332 @@ class ExEC2NodeDriver(BaseEC2NodeDriver):
 
         return VolumeSnapshot(snapshot_id, self)
 
+    def ex_list_snapshots(self, snapshot_ids, batch_size=100):
+        """ Describe several snapshots, with one request per batch """
+        ret = []
+        snapshot_ids = list(snapshot_ids)
+        for i in range(0, len(snapshot_ids), batch_size):
+            params = {'Action': 'DescribeSnapshots'}
+            for n, snapshot_id in enumerate(snapshot_ids[i:i + batch_size], start=1):
+                params[f'SnapshotId.{n}'] = snapshot_id
+            response = self.connection.request(self.path, params=params).object
+            ret.extend(self._to_snapshots(response))
+        return ret
+
+    def ex_register_image(
+            self, name, description=None, architecture=None, image_location=None, root_device_name=None,
+            block_device_mapping=None, kernel_id=None, ramdisk_id=None, virtualization_type=None, ena_support=None,
+            billing_products=None, sriov_net_support=None, boot_mode=None, tpm_support=None, uefi_data=None,
+            imds_support=None, tags=None,
+    ):
+        """ Register image like EC2NodeDriver.ex_register_image, optionally tagged at creation time """
+        params = {'Action': 'RegisterImage', 'Name': name}
+        for key, value in (
+                ('Description', description),
+                ('Architecture', architecture),
+                ('ImageLocation', image_location),
+                ('RootDeviceName', root_device_name),
+                ('KernelId', kernel_id),
+                ('RamDiskId', ramdisk_id),
+                ('VirtualizationType', virtualization_type),
+                ('EnaSupport', ena_support),
+                ('SriovNetSupport', sriov_net_support),
+                ('BootMode', boot_mode),
+                ('TpmSupport', tpm_support),
+                ('UefiData', uefi_data),
+                ('ImdsSupport', imds_support),
+        ):
+            if value is not None:
+                params[key] = value
+        if block_device_mapping is not None:
+            params.update(self._get_block_device_mapping_params(block_device_mapping))
+        if billing_products is not None:
+            params.update(self._get_billing_product_params(billing_products))
+        if tags:
+            params.update(self._get_tag_specification_params('image', tags))
+
+        return self._to_image(self.connection.request(self.path, params=params).object)
+
+    def ex_start_import_snapshot(self, description=None, disk_container=None, client_token=None):
+        """ Start import of disk into snapshot, without waiting for it """
+        params = {'Action': 'ImportSnapshot'}
+        if description is not None:
+            params['Description'] = description
+        if disk_container is not None:
+            params.update(self._get_disk_container_params(disk_container))
+        if client_token is not None:
+            params['ClientToken'] = client_token
+
+        response = self.connection.request(self.path, params=params).object
+
+        import_task_id = findtext(element=response, xpath='importTaskId', namespace=NAMESPACE)
+
+        return ExEC2ImportSnapshotTask(import_task_id, self, 'active')
+
+    def ex_list_import_snapshot_tasks(self, import_task_ids, batch_size=100):
+        """ Describe several import snapshot tasks, with one request per batch """
+        ret = []
+        import_task_ids = list(import_task_ids)
+        for i in range(0, len(import_task_ids), batch_size):
+            params = {'Action': 'DescribeImportSnapshotTasks'}
+            for n, import_task_id in enumerate(import_task_ids[i:i + batch_size], start=1):
+                params[f'ImportTaskId.{n}'] = import_task_id
+            response = self.connection.request(self.path, params=params).object
+            ret.extend(self._to_import_snapshot_tasks(response, 'importSnapshotTaskSet/item'))
+        return ret
+
+    def _to_import_snapshot_tasks(self, object, xpath):
+        return [self._to_import_snapshot_task_ex(el)
+                for el in object.findall(fixxpath(xpath=xpath, namespace=NAMESPACE))]
+
+    def _to_import_snapshot_task_ex(self, element):
+        def detail(name):
+            return findtext(element=element, xpath=f'snapshotTaskDetail/{name}', namespace=NAMESPACE)
+
+        return ExEC2ImportSnapshotTask(
+            findtext(element=element, xpath='importTaskId', namespace=NAMESPACE),
+            self,
+            detail('status'),
+            snapshot_id=detail('snapshotId'),
+            extra={
+                'progress': detail('progress'),
+                'status_message': detail('statusMessage'),
+            },
+        )
+
+
+class ExEC2ImportSnapshotTask:
+    def __init__(self, id, driver, status, snapshot_id=None, extra=None):
+        self.id, self.driver, self.status = id, driver, status
+        self.snapshot_id = snapshot_id
+        self.extra = extra or {}
+
+    @property
+    def snapshot(self):
+        """ Snapshot created by a completed task """
+        if self.snapshot_id is None:
+            return None
+        return VolumeSnapshot(self.snapshot_id, self.driver)
+
+    def __repr__(self):
+        return '<{}("{}", "{}")>'.format(self.__class__.__name__, self.id, self.status)
+
+
+class ExEC2SnapshotWaiter:
+    """
+    Wait for snapshots in several regions to become available.
+
+    All pending snapshots of a region are checked with one DescribeSnapshots
+    call.  Regions are checked again once their snapshots are expected to
+    be completed, estimated from the progress reported so far; without
+    progress the interval is doubled.  Callbacks are called from the thread
+    of the waiter as soon as each snapshot is done, so they should only
+    hand off work.
+
+    A snapshot fails once it is not done after timeout seconds, or if it is
+    missing from missing_max consecutive describe calls, including failed
+    ones.
+    """
+
+    interval_min: float = 5
+    interval_max: float = 60
+    timeout: float = 6 * 3600
+    missing_max: int = 10
+
+    class Pending:
+        def __init__(self, snapshot, available, failed, now):
+            self.snapshot = snapshot
+            self.available = available
+            self.failed = failed
+            self.start = now
+            self.progress_start = None
+            self.missing = 0
+
+    def __init__(self, *, interval_min=None, interval_max=None, timeout=None, missing_max=None, clock=time.monotonic):
+        if interval_min is not None:
+            self.interval_min = interval_min
+        if interval_max is not None:
+            self.interval_max = interval_max
+        if timeout is not None:
+            self.timeout = timeout
+        if missing_max is not None:
+            self.missing_max = missing_max
+        self.clock = clock
+        self.requests = 0
+
+        self.__cond = threading.Condition()
+        self.__closed = False
+        self.__pending = {}
+        self.__interval = {}
+        self.__next = {}
+        self.__thread = None
+
+    def __enter__(self):
+        self.__thread = threading.Thread(target=self.run, name='snapshot-waiter', daemon=True)
+        self.__thread.start()
+        return self
+
+    def __exit__(self, *args):
+        """ Wait until all snapshots are done """
+        with self.__cond:
+            self.__closed = True
+            self.__cond.notify()
+        self.__thread.join()
+
+    def add(self, snapshot, available, failed):
+        """ Call available(snapshot) or failed(snapshot, error) once snapshot is done """
+        driver = snapshot.driver
+        with self.__cond:
+            self.__pending.setdefault(driver, {})[snapshot.id] = self.Pending(snapshot, available, failed, self.clock())
+            if driver not in self.__next:
+                self.__next[driver] = self.clock()
+                self.__interval[driver] = self.interval_min
+            self.__cond.notify()
+
+    def run(self):
+        while True:
+            with self.__cond:
+                while not self.__pending and not self.__closed:
+                    self.__cond.wait()
+                if not self.__pending:
+                    return
+
+                now = self.clock()
+                due = [d for d in self.__pending if self.__next[d] <= now]
+                if not due:
+                    self.__cond.wait(min(self.__next[d] for d in self.__pending) - now)
+                    continue
+
+            for driver in due:
+                self.poll(driver)
+
+    def poll(self, driver):
+        with self.__cond:
+            pending = dict(self.__pending[driver])
+
+        missing_error = None
+        try:
+            self.requests += 1
+            items = self.describe(driver, pending)
+        except Exception as e:
+            # New copies are not always visible right away
+            logging.debug('Unable to describe %s in %s: %s', self.kind, driver.region_name, e)
+            items = []
+            missing_error = e
+
+        now = self.clock()
+        done = []
+        estimates = []
+        seen = set()
+        for item in items:
+            p = pending.get(item.id)
+            if p is None:
+                continue
+            seen.add(item.id)
+            p.missing = 0
+
+            try:
+                result = self.check(driver, item)
+            except Exception as error:
+                done.append((p, p.failed, (item, error)))
+                continue
+
+            if result is not None:
+                done.append((p, p.available, (result, )))
+            else:
+                if now - p.start > self.timeout:
+                    error = TimeoutError(f'{driver.region_name}/{item.id} not done after {self.timeout}s')
+                    done.append((p, p.failed, (item, error)))
+                    continue
+                estimate = self.estimate(p, item, now)
+                if estimate is not None:
+                    estimates.append(estimate)
+
+        for item_id, p in pending.items():
+            if item_id in seen:
+                continue
+            p.missing += 1
+            if p.missing >= self.missing_max or now - p.start > self.timeout:
+                error = RuntimeError(
+                    f'{driver.region_name}/{item_id} not found in {p.missing} requests for {self.kind}: '
+                    f'{missing_error or "missing from response"}'
+                )
+                done.append((p, p.failed, (p.snapshot, error)))
+
+        with self.__cond:
+            for p, func, args in done:
+                del self.__pending[driver][p.snapshot.id]
+            if not self.__pending[driver]:
+                del self.__pending[driver], self.__next[driver], self.__interval[driver]
+            else:
+                if estimates:
+                    interval = min(estimates)
+                else:
+                    interval = self.__interval[driver] * 2
+                interval = min(max(interval, self.interval_min), self.interval_max)
+                self.__interval[driver] = interval
+                self.__next[driver] = now + interval
+
+        for p, func, args in done:
+            try:
+                func(*args)
+            except Exception:
+                logging.exception('Snapshot callback failed')
+
+    kind = 'snapshots'
+
+    def describe(self, driver, ids):
+        return driver.ex_list_snapshots(ids)
+
+    def check(self, driver, snapshot):
+        """ Return snapshot if available, None while pending, raise error if failed """
+        if snapshot.state == VolumeSnapshotState.AVAILABLE:
+            logging.info('Snapshot %s/%s available', driver.region_name, snapshot.id)
+            return snapshot
+        elif snapshot.state == VolumeSnapshotState.CREATING:
+            return None
+        raise RuntimeError(f'Snapshot {driver.region_name}/{snapshot.id} in state {snapshot.extra.get("state")}')
+
+    @staticmethod
+    def estimate(p, snapshot, now):
+        """ Estimate remaining time from progress since first seen """
+        try:
+            progress = float((snapshot.extra.get('progress') or '').rstrip('%'))
+        except ValueError:
+            return None
+
+        if p.progress_start is None:
+            p.progress_start = (now, progress)
+            return None
+
+        start, progress_start = p.progress_start
+        if progress <= progress_start or now <= start:
+            return None
+        return (100 - progress) * (now - start) / (progress - progress_start)
+
+
+class ExEC2ImportSnapshotWaiter(ExEC2SnapshotWaiter):
+    """
+    Wait for import snapshot tasks in several regions to complete.
+
+    All pending tasks of a region are checked with one
+    DescribeImportSnapshotTasks call, at the same intervals as snapshots.
+    available is called with the snapshot created by the task.
+    """
+
+    kind = 'import snapshot tasks'
+
+    def describe(self, driver, ids):
+        return driver.ex_list_import_snapshot_tasks(ids)
+
+    def check(self, driver, task):
+        if task.status == 'completed':
+            logging.info('Import %s/%s completed as snapshot %s', driver.region_name, task.id, task.snapshot_id)
+            return task.snapshot
+        elif task.status in ('active', 'pending'):
+            return None
+        raise RuntimeError(f'Import {driver.region_name}/{task.id} in state {task.status}: {task.extra.get("status_message")}')
+
 
 class ExEC2Region:
     def __init__(self, name, endpoint):
@@ -0,0 +1,110 @@
+import base64
+import hashlib
+import json
+
+from libcloud.common.aws import SignedAWSConnection
+from libcloud.common.base import JsonResponse
+
+
+def ebs_checksum(data) -> str:
+    """ Checksum of a block, as used by the EBS direct APIs """
+    return base64.b64encode(hashlib.sha256(data).digest()).decode('ascii')
+
+
+def ebs_checksum_linear(checksums) -> str:
+    """ Aggregated checksum of the block checksums, in order of their block index """
+    h = hashlib.sha256()
+    for checksum in checksums:
+        h.update(base64.b64decode(checksum))
+    return base64.b64encode(h.digest()).decode('ascii')
+
+
+class EBSDriver:
+    name = 'Amazon EBS'
+
+    def __init__(self, region_name):
+        self.region_name = region_name
+
+
+class EBSResponse(JsonResponse):
+    def parse_error(self):
+        try:
+            body = json.loads(self.body)
+        except ValueError:
+            body = {}
+        message = body.get('Message') or body.get('message') or self.body
+        return '{}: {}'.format(self.headers.get('x-amzn-errortype', self.status), message)
+
+
+class EBSConnection(SignedAWSConnection):
+    """
+    Connection to the EBS direct APIs, to write snapshots block by block.
+
+    Connections keep state of the current request, use one per thread.
+    """
+
+    version = '2019-11-02'
+    service_name = 'ebs'
+    responseCls = EBSResponse
+
+    def __init__(self, key, secret, region, token=None, host=None, port=None, secure=True):
+        self.driver = EBSDriver(region)
+        super().__init__(
+            key, secret,
+            host=host or 'ebs.{}.amazonaws.com'.format(region),
+            port=port,
+            secure=secure,
+            token=token,
+            signature_version=4,
+        )
+
+    def start_snapshot(self, volume_size, description=None, tags=None, client_token=None, timeout=None):
+        """ Start new snapshot of volume_size GiB, returns snapshot id and block size among others """
+        body = {'VolumeSize': volume_size}
+        if description is not None:
+            body['Description'] = description
+        if tags:
+            body['Tags'] = [{'Key': k, 'Value': v} for k, v in tags.items()]
+        if client_token is not None:
+            body['ClientToken'] = client_token
+        if timeout is not None:
+            body['Timeout'] = timeout
+
+        return self.request(
+            '/snapshots',
+            method='POST',
+            data=json.dumps(body),
+            headers={'Content-Type': 'application/json'},
+        ).object
+
+    def put_snapshot_block(self, snapshot_id, block_index, data, checksum=None):
+        """ Write one block, returns its checksum """
+        checksum = checksum or ebs_checksum(data)
+        self.request(
+            '/snapshots/{}/blocks/{}'.format(snapshot_id, block_index),
+            method='PUT',
+            data=bytes(data),
+            headers={
+                'Content-Type': 'application/octet-stream',
+                'x-amz-Data-Length': str(len(data)),
+                'x-amz-Checksum': checksum,
+                'x-amz-Checksum-Algorithm': 'SHA256',
+            },
+        )
+        return checksum
+
+    def complete_snapshot(self, snapshot_id, changed_blocks_count, checksum=None):
+        """ Seal snapshot, checksum is the linear aggregate of all block checksums """
+        headers = {'x-amz-ChangedBlocksCount': str(changed_blocks_count)}
+        if checksum is not None:
+            headers.update({
+                'x-amz-Checksum': checksum,
+                'x-amz-Checksum-Algorithm': 'SHA256',
+                'x-amz-Checksum-Aggregation-Method': 'LINEAR',
+            })
+
+        return self.request(
+            '/snapshots/completion/{}'.format(snapshot_id),
+            method='POST',
+            headers=headers,
+        ).object
@@ -1,9 +1,32 @@
+import base64
+import concurrent.futures
+import hashlib
+import logging
 import requests
+import threading
 import typing
 import urllib.parse
 
 from libcloud.common.aws import AWSDriver
+from libcloud.common.types import LibcloudError
+from libcloud.storage.base import Object
 from libcloud.storage.drivers.s3 import BaseS3StorageDriver, S3SignatureV4Connection
+from libcloud.utils.xml import fixxpath
+
+
+logger = logging.getLogger(__name__)
+
+
+def read_parts(iterator, part_size):
+    """ Collect data from iterator into parts of part_size, the last one may be shorter """
+    buf = bytearray()
+    for data in iterator:
+        buf += data
+        while len(buf) >= part_size:
+            yield bytes(buf[:part_size])
+            del buf[:part_size]
+    if buf:
+        yield bytes(buf)
 
 
 class S3BucketStorageDriver(AWSDriver, BaseS3StorageDriver):
@@ -35,3 +58,146 @@ class S3BucketStorageDriver(AWSDriver, BaseS3StorageDriver):
             return '/%s' % (container.name)
         else:
             return ''
+
+    def _ex_new_connection(self):
+        """ Create additional connection, connections keep state of the current request """
+        connection = self.connectionCls(
+            self.key, self.secret, self.secure, self.connection.host, self.connection.port,
+            **self._ex_connection_class_kwargs(),
+        )
+        connection.driver = self
+        connection.connect()
+        return connection
+
+    def ex_find_multipart_upload(self, object_name):
+        """ Find latest unfinished multipart upload of object, returns its id or None """
+        uploads = [
+            u for u in self.ex_iterate_multipart_uploads(None, prefix=object_name)
+            if u.key == object_name
+        ]
+        if uploads:
+            return max(uploads, key=lambda u: u.created_at).id
+        return None
+
+    def ex_iterate_multipart_parts(self, object_name, upload_id):
+        """ Iterate over (part number, etag, size) of parts already uploaded """
+        request_path = self._get_object_path(None, object_name)
+        params = {'uploadId': upload_id}
+
+        while True:
+            response = self.connection.request(request_path, params=params)
+            body = response.object
+
+            for node in body.findall(fixxpath(xpath='Part', namespace=self.namespace)):
+                yield (
+                    int(node.findtext(fixxpath(xpath='PartNumber', namespace=self.namespace))),
+                    node.findtext(fixxpath(xpath='ETag', namespace=self.namespace)).strip('"'),
+                    int(node.findtext(fixxpath(xpath='Size', namespace=self.namespace))),
+                )
+
+            if body.findtext(fixxpath(xpath='IsTruncated', namespace=self.namespace)).lower() != 'true':
+                break
+            params['part-number-marker'] = body.findtext(fixxpath(xpath='NextPartNumberMarker', namespace=self.namespace))
+
+    def ex_upload_object_via_stream_parallel(self, iterator, object_name, part_size=16 * 1024 * 1024, workers=8, extra=None, resume=True):
+        """
+        Upload object as multipart upload, with several parts in flight at once.
+
+        Data from iterator is split into parts of part_size, at most one part
+        more than workers is held in memory.  Each part is sent with its MD5
+        checksum.  With resume, an unfinished upload of the same object is
+        resumed, parts already uploaded with identical content are not sent
+        again, and on errors the upload is kept, so a later call can resume
+        it; parts of uploads never resumed are only removed by a lifecycle
+        rule of the bucket (AbortIncompleteMultipartUpload).  Without resume,
+        the upload is aborted on errors.
+        """
+        extra = extra or {}
+        request_path = self._get_object_path(None, object_name)
+
+        upload_id = self.ex_find_multipart_upload(object_name) if resume else None
+        uploaded = {}
+        if upload_id:
+            uploaded = {number: etag for number, etag, size in self.ex_iterate_multipart_parts(object_name, upload_id)}
+            logger.info('Resume upload of %s with %d parts already uploaded', object_name, len(uploaded))
+        else:
+            headers = {'Content-Type': self._determine_content_type(extra.get('content_type'), object_name)}
+            upload_id = self._initiate_multipart(None, object_name, headers=headers)
+
+        local = threading.local()
+
+        def connection():
+            if not hasattr(local, 'connection'):
+                local.connection = self._ex_new_connection()
+            return local.connection
+
+        def put(number, data):
+            checksum = hashlib.md5(data)
+            if uploaded.get(number) == checksum.hexdigest():
+                return uploaded[number]
+
+            response = connection().request(
+                request_path,
+                method='PUT',
+                data=data,
+                headers={
+                    'Content-Length': len(data),
+                    'Content-MD5': base64.b64encode(checksum.digest()).decode('ascii'),
+                },
+                params={'uploadId': upload_id, 'partNumber': number},
+            )
+            return response.headers['etag'].strip('"')
+
+        try:
+            size, chunks = self._ex_upload_parts(iterator, part_size, workers, put)
+            if not chunks:
+                raise LibcloudError('Unable to upload empty object as multipart upload', driver=self)
+
+            logger.info('Uploaded %d parts of %s, %d already present', len(chunks), object_name, sum(1 for n, e in chunks if uploaded.get(n) == e))
+
+            etag = self._commit_multipart(None, object_name, upload_id, chunks)
+
+        except BaseException:
+            if not resume:
+                logger.info('Aborting upload of %s', object_name)
+                try:
+                    self._abort_multipart(None, object_name, upload_id)
+                except Exception as e:
+                    logger.warning('Unable to abort upload of %s: %s', object_name, e)
+            raise
+
+        return Object(
+            name=object_name,
+            size=size,
+            hash=etag,
+            extra={},
+            meta_data=None,
+            container=None,
+            driver=self,
+        )
+
+    @staticmethod
+    def _ex_upload_parts(iterator, part_size, workers, put):
+        """ Upload parts with put(number, data), returns size and list of (part number, etag) """
+        size = 0
+        futures = {}
+        failed = threading.Event()
+        window = threading.BoundedSemaphore(workers + 1)
+
+        def done(future):
+            window.release()
+            if future.exception():
+                failed.set()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for number, data in enumerate(read_parts(iterator, part_size), start=1):
+                window.acquire()
+                if failed.is_set():
+                    window.release()
+                    break
+                size += len(data)
+                future = executor.submit(put, number, data)
+                future.add_done_callback(done)
+                futures[future] = number
+
+        return size, sorted((number, future.result()) for future, number in futures.items())
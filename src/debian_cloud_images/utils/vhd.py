@@ -0,0 +1,98 @@
+import datetime
+import io
+import os
+import struct
+import uuid
+
+from .files import ExtentFile, data_extents
+
+
+class VhdFixedFile(ExtentFile):
+    """
+    Read-only fixed VHD view of a raw image.
+
+    A fixed VHD is the raw disk followed by a 512 byte footer.  The raw data
+    is read in place, padded with a hole to the requested alignment (Azure
+    requires a multiple of 1MiB), and the footer is generated in memory.
+    """
+
+    align = 1024 * 1024
+    footer_size = 512
+
+    def __init__(self, fileobj, *, align: int = align, timestamp: datetime.datetime = None, unique_id: uuid.UUID = None) -> None:
+        raw_size = fileobj.seek(0, os.SEEK_END)
+        disk_size = -(-raw_size // align) * align
+
+        extents = [
+            self.Extent(offset, size, fileobj, offset)
+            for offset, size in data_extents(fileobj, raw_size)
+        ]
+        extents.append(self.Extent(
+            disk_size,
+            self.footer_size,
+            io.BytesIO(self.footer(disk_size, timestamp=timestamp, unique_id=unique_id)),
+            0,
+        ))
+
+        super().__init__(disk_size + self.footer_size, extents)
+        self.fileobj = fileobj
+        self.disk_size = disk_size
+
+    def close(self) -> None:
+        if not self.closed:
+            self.fileobj.close()
+        super().close()
+
+    @staticmethod
+    def geometry(size: int):
+        """ Calculate CHS geometry as specified in the VHD format specification """
+        sectors = min(size // 512, 65535 * 16 * 255)
+
+        if sectors >= 65535 * 16 * 63:
+            sectors_per_track = 255
+            heads = 16
+            cylinder_times_heads = sectors // sectors_per_track
+        else:
+            sectors_per_track = 17
+            cylinder_times_heads = sectors // sectors_per_track
+            heads = max((cylinder_times_heads + 1023) // 1024, 4)
+
+            if cylinder_times_heads >= heads * 1024 or heads > 16:
+                sectors_per_track = 31
+                heads = 16
+                cylinder_times_heads = sectors // sectors_per_track
+
+            if cylinder_times_heads >= heads * 1024:
+                sectors_per_track = 63
+                heads = 16
+                cylinder_times_heads = sectors // sectors_per_track
+
+        return cylinder_times_heads // heads, heads, sectors_per_track
+
+    @classmethod
+    def footer(cls, size: int, *, timestamp: datetime.datetime = None, unique_id: uuid.UUID = None) -> bytes:
+        epoch = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+        timestamp = timestamp or datetime.datetime.now(tz=datetime.timezone.utc)
+        unique_id = unique_id or uuid.uuid4()
+
+        footer = bytearray(struct.pack(
+            '>8sIIQI4sI4sQQHBBII16sB',
+            b'conectix',
+            2,                      # Features: reserved, must be set
+            0x00010000,             # File format version
+            0xffffffffffffffff,     # Data offset: none for fixed disks
+            int((timestamp - epoch).total_seconds()),
+            b'dci ',                # Creator application
+            0x00010000,             # Creator version
+            b'Wi2k',                # Creator host OS
+            size,                   # Original size
+            size,                   # Current size
+            *cls.geometry(size),
+            2,                      # Disk type: fixed
+            0,                      # Checksum, filled in below
+            unique_id.bytes,
+            0,                      # Saved state
+        ))
+        footer.extend(bytes(cls.footer_size - len(footer)))
+        struct.pack_into('>I', footer, 64, ~sum(footer) & 0xffffffff)
+        return bytes(footer)
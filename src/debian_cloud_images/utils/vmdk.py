@@ -0,0 +1,169 @@
+import array
+import collections
+import concurrent.futures
+import os
+import random
+import struct
+import zlib
+
+from .files import data_extents
+
+
+class VmdkStreamOptimized:
+    """
+    Encode a raw image as VMDK streamOptimized byte stream.
+
+    Iterating yields the VMDK file in order, without temporary files.  Only
+    grains containing data are read; they are compressed concurrently, with at
+    most `window` grains in flight, which bounds memory usage.  zlib releases
+    the GIL while compressing, so a thread pool scales across cores.
+    """
+
+    sector_size = 512
+    grain_sectors = 128
+    gtes_per_gt = 512
+    overhead_sectors = 128
+    descriptor_sectors = 20
+
+    flags = 0x1 | 0x10000 | 0x20000    # Newline detection, compressed grains, markers
+    gd_at_end = 0xffffffffffffffff
+
+    marker_eos = 0
+    marker_gt = 1
+    marker_gd = 2
+    marker_footer = 3
+
+    header_struct = struct.Struct('<4sIIQQQQIQQQB4sH')
+
+    def __init__(self, fileobj, *, workers: int = None, window: int = 64, level: int = 6) -> None:
+        self.fileobj = fileobj
+        self.size = fileobj.seek(0, os.SEEK_END)
+        self.workers = workers
+        self.window = window
+        self.level = level
+
+        self.capacity = -(-self.size // self.sector_size)
+        self.grains = -(-self.capacity // self.grain_sectors)
+        self.gts = -(-self.grains // self.gtes_per_gt)
+
+    @property
+    def grain_size(self) -> int:
+        return self.grain_sectors * self.sector_size
+
+    def __iter__(self):
+        grain_table = array.array('I', bytes(4 * self.gts * self.gtes_per_gt))
+        self._offset = 0
+
+        yield self._emit(self.header(self.gd_at_end))
+        yield self._emit(self.descriptor().ljust((self.overhead_sectors - 1) * self.sector_size, b'\0'))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = collections.deque()
+
+            for grain, data in self._read_grains():
+                pending.append((grain, executor.submit(zlib.compress, data, self.level)))
+                while len(pending) >= self.window:
+                    yield self._emit_grain(grain_table, *pending.popleft())
+
+            while pending:
+                yield self._emit_grain(grain_table, *pending.popleft())
+
+        grain_directory = array.array('I', bytes(4 * self.gts))
+        gt_sectors = self.gtes_per_gt * 4 // self.sector_size
+        for gt in range(self.gts):
+            yield self._emit(self.marker(gt_sectors, self.marker_gt))
+            grain_directory[gt] = self._offset // self.sector_size
+            table = grain_table[gt * self.gtes_per_gt:(gt + 1) * self.gtes_per_gt]
+            yield self._emit(self._to_le(table).tobytes())
+
+        gd = self._pad(self._to_le(grain_directory).tobytes())
+        yield self._emit(self.marker(len(gd) // self.sector_size, self.marker_gd))
+        gd_offset = self._offset // self.sector_size
+        yield self._emit(gd)
+
+        yield self._emit(self.marker(1, self.marker_footer))
+        yield self._emit(self.header(gd_offset))
+        yield self._emit(self.marker(0, self.marker_eos))
+
+    def _emit(self, data: bytes) -> bytes:
+        self._offset += len(data)
+        return data
+
+    def _emit_grain(self, grain_table, grain: int, future) -> bytes:
+        compressed = future.result()
+        grain_table[grain] = self._offset // self.sector_size
+        return self._emit(self._pad(struct.pack('<QI', grain * self.grain_sectors, len(compressed)) + compressed))
+
+    def _read_grains(self):
+        """ Iterate over all grains with non-zero data """
+        grain_size = self.grain_size
+        zero = bytes(grain_size)
+        grain_next = 0
+
+        for offset, size in list(data_extents(self.fileobj, self.size)):
+            grain_first = max(offset // grain_size, grain_next)
+            grain_next = -(-(offset + size) // grain_size)
+
+            for grain in range(grain_first, grain_next):
+                self.fileobj.seek(grain * grain_size, os.SEEK_SET)
+                data = self.fileobj.read(grain_size)
+                if len(data) < grain_size:
+                    data += zero[len(data):]
+                if data != zero:
+                    yield grain, data
+
+    @classmethod
+    def _pad(cls, data: bytes) -> bytes:
+        return data + bytes(-len(data) % cls.sector_size)
+
+    @staticmethod
+    def _to_le(a: array.array) -> array.array:
+        if struct.pack('=I', 1) != struct.pack('<I', 1):
+            a = array.array(a.typecode, a)
+            a.byteswap()
+        return a
+
+    @classmethod
+    def marker(cls, value: int, type: int) -> bytes:
+        return struct.pack('<QII', value, 0, type).ljust(cls.sector_size, b'\0')
+
+    def header(self, gd_offset: int) -> bytes:
+        return self.header_struct.pack(
+            b'KDMV',
+            3,
+            self.flags,
+            self.capacity,
+            self.grain_sectors,
+            1,                          # Descriptor offset
+            self.descriptor_sectors,
+            self.gtes_per_gt,
+            0,                          # Redundant grain directory offset
+            gd_offset,
+            self.overhead_sectors,
+            0,                          # Unclean shutdown
+            b'\n \r\n',
+            1,                          # Compression algorithm: deflate
+        ).ljust(self.sector_size, b'\0')
+
+    def descriptor(self) -> bytes:
+        cylinders = min(self.capacity // (255 * 63), 65535)
+        return '\n'.join((
+            '# Disk DescriptorFile',
+            'version=1',
+            'CID={:08x}'.format(random.getrandbits(32)),
+            'parentCID=ffffffff',
+            'createType="streamOptimized"',
+            '',
+            '# Extent description',
+            f'RW {self.capacity} SPARSE "disk.vmdk"',
+            '',
+            '# The Disk Data Base',
+            '#DDB',
+            '',
+            'ddb.virtualHWVersion = "4"',
+            f'ddb.geometry.cylinders = "{cylinders}"',
+            'ddb.geometry.heads = "255"',
+            'ddb.geometry.sectors = "63"',
+            'ddb.adapterType = "ide"',
+            '',
+        )).encode('ascii')
@@ -0,0 +1,358 @@
+import bisect
+import collections
+import concurrent.futures
+import io
+import lzma
+import os
+import struct
+import threading
+import typing
+import zlib
+
+from .files import pread_into
+
+
+class XzBlockFile(io.RawIOBase):
+    """
+    Read-only, seekable view of the uncompressed data of a multi-block xz file.
+
+    xz files written with independent blocks (e.g. xz --threads or
+    --block-size) carry an index of all blocks.  Every block is decompressed
+    on its own, so reads can start anywhere and blocks ahead of the current
+    position are decompressed in parallel.  Decompressed blocks are kept up
+    to cache_size bytes, read-ahead is limited to fit into it.
+    """
+
+    Block = collections.namedtuple('Block', ('offset', 'size', 'fileoffset', 'unpadded_size'))
+
+    header_size = footer_size = 12
+    header_magic = b'\xfd7zXZ\0'
+    footer_magic = b'YZ'
+
+    cache_size = 256 * 1024 * 1024
+
+    def __init__(self, fileobj, stream_flags: bytes, blocks: typing.List[Block], workers: int = None, cache_size: int = None) -> None:
+        self.fileobj = fileobj
+        self.stream_flags = stream_flags
+        self.blocks = blocks
+        self.size = sum(b.size for b in blocks)
+        self.__blocks_start = [b.offset for b in blocks]
+        self.__current = 0
+
+        self.workers = workers or os.cpu_count() or 1
+        if cache_size:
+            self.cache_size = cache_size
+        self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        self.__cache: typing.OrderedDict[int, concurrent.futures.Future] = collections.OrderedDict()
+        self.__cache_lock = threading.Lock()
+
+    @classmethod
+    def open(cls, fileobj, workers: int = None, cache_size: int = None):
+        """ Open xz file, returns None if it has no usable block index """
+        try:
+            stream_flags, blocks = cls._read_index(fileobj)
+        except ValueError:
+            return None
+
+        if len(blocks) < 2:
+            return None
+
+        return cls(fileobj, stream_flags, blocks, workers, cache_size)
+
+    @staticmethod
+    def _decode_varint(buf: bytes, pos: int) -> typing.Tuple[int, int]:
+        value = shift = 0
+        while True:
+            if pos >= len(buf) or shift > 63:
+                raise ValueError('Invalid xz index')
+            b = buf[pos]
+            value |= (b & 0x7f) << shift
+            pos += 1
+            if not b & 0x80:
+                return value, pos
+            shift += 7
+
+    @staticmethod
+    def _encode_varint(value: int) -> bytes:
+        ret = bytearray()
+        while value >= 0x80:
+            ret.append(value & 0x7f | 0x80)
+            value >>= 7
+        ret.append(value)
+        return bytes(ret)
+
+    @classmethod
+    def _read_index(cls, fileobj):
+        """ Read stream flags and list of blocks, only single stream files are supported """
+        size = fileobj.seek(0, os.SEEK_END)
+
+        fileobj.seek(0, os.SEEK_SET)
+        header = fileobj.read(cls.header_size)
+        if len(header) != cls.header_size or header[:6] != cls.header_magic:
+            raise ValueError('No xz file')
+        stream_flags = header[6:8]
+
+        # Skip stream padding
+        end = size
+        while end >= cls.header_size + cls.footer_size:
+            fileobj.seek(end - 4, os.SEEK_SET)
+            if fileobj.read(4) != b'\0\0\0\0':
+                break
+            end -= 4
+
+        fileobj.seek(end - cls.footer_size, os.SEEK_SET)
+        footer = fileobj.read(cls.footer_size)
+        if footer[10:12] != cls.footer_magic or footer[8:10] != stream_flags:
+            raise ValueError('Invalid xz stream footer')
+        index_size = (struct.unpack_from('<I', footer, 4)[0] + 1) * 4
+
+        index_start = end - cls.footer_size - index_size
+        if index_start < cls.header_size:
+            raise ValueError('Invalid xz index size')
+        fileobj.seek(index_start, os.SEEK_SET)
+        index = fileobj.read(index_size)
+        if index[0] != 0 or zlib.crc32(index[:-4]) != struct.unpack_from('<I', index, index_size - 4)[0]:
+            raise ValueError('Invalid xz index')
+
+        count, pos = cls._decode_varint(index, 1)
+        blocks = []
+        offset = 0
+        fileoffset = cls.header_size
+        for i in range(count):
+            unpadded_size, pos = cls._decode_varint(index, pos)
+            uncompressed_size, pos = cls._decode_varint(index, pos)
+            blocks.append(cls.Block(offset, uncompressed_size, fileoffset, unpadded_size))
+            offset += uncompressed_size
+            fileoffset += -(-unpadded_size // 4) * 4
+
+        if fileoffset != index_start:
+            # Index does not describe the whole file, e.g. concatenated streams
+            raise ValueError('Unsupported xz file with multiple streams')
+
+        return stream_flags, blocks
+
+    def _block_stream(self, block: Block, data: bytearray) -> bytes:
+        """ Wrap a single block into a complete xz stream """
+        index = bytearray(b'\0')
+        index += self._encode_varint(1)
+        index += self._encode_varint(block.unpadded_size)
+        index += self._encode_varint(block.size)
+        index += bytes(-len(index) % 4)
+        index += struct.pack('<I', zlib.crc32(index))
+
+        footer = struct.pack('<I', len(index) // 4 - 1) + self.stream_flags
+        footer = struct.pack('<I', zlib.crc32(footer)) + footer + self.footer_magic
+
+        header = self.header_magic + self.stream_flags
+        header += struct.pack('<I', zlib.crc32(self.stream_flags))
+
+        return header + data + index + footer
+
+    def _decompress(self, n: int) -> bytes:
+        block = self.blocks[n]
+        length = -(-block.unpadded_size // 4) * 4
+        data = bytearray(length)
+        pread_into(self.fileobj, data, block.fileoffset)
+        return lzma.decompress(self._block_stream(block, data), format=lzma.FORMAT_XZ)
+
+    def _block(self, n: int) -> bytes:
+        # Block n is always used, blocks ahead only as long as they fit into the cache
+        wanted = [n]
+        size = self.blocks[n].size
+        for i in range(n + 1, min(n + self.workers, len(self.blocks))):
+            size += self.blocks[i].size
+            if size > self.cache_size:
+                break
+            wanted.append(i)
+
+        with self.__cache_lock:
+            for i in wanted:
+                if i not in self.__cache:
+                    self.__cache[i] = self.__executor.submit(self._decompress, i)
+                self.__cache.move_to_end(i)
+
+            # Evict least recently used blocks
+            cached = sum(self.blocks[i].size for i in self.__cache)
+            while cached > self.cache_size:
+                i = next(iter(self.__cache))
+                if i in wanted:
+                    break
+                del self.__cache[i]
+                cached -= self.blocks[i].size
+
+            future = self.__cache[n]
+
+        return future.result()
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.__current
+
+    def readinto(self, b) -> int:
+        n = self.readinto_at(b, self.__current)
+        self.__current += n
+        return n
+
+    def readinto_at(self, b, offset: int) -> int:
+        """ Read into buffer from offset, safe to use from several threads """
+        with memoryview(b) as mv_raw, mv_raw.cast('B') as mv:
+            done = 0
+            length = min(len(mv), max(self.size - offset, 0))
+
+            while done < length:
+                current = offset + done
+                n = bisect.bisect_right(self.__blocks_start, current) - 1
+                block = self.blocks[n]
+                data = self._block(n)
+                start = current - block.offset
+                end = min(block.size, start + length - done)
+                with memoryview(data) as dmv:
+                    mv[done:done + end - start] = dmv[start:end]
+                done += end - start
+
+            return done
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            pass
+        elif whence == os.SEEK_CUR:
+            offset += self.__current
+        elif whence == os.SEEK_END:
+            offset += self.size
+        else:
+            raise io.UnsupportedOperation
+
+        if offset < 0:
+            raise ValueError('Negative seek position')
+
+        self.__current = offset
+        return offset
+
+    def close(self) -> None:
+        if not self.closed:
+            self.__executor.shutdown(wait=True, cancel_futures=True)
+            self.__cache.clear()
+            self.fileobj.close()
+        super().close()
+
+
+class XzBlockCompressor:
+    """
+    Compress data into a single xz stream of independent blocks.
+
+    Every block is compressed on its own in a thread pool, lzma releases the
+    GIL while compressing.  The resulting file carries a complete block
+    index, so XzBlockFile can read it with random access.  Compressed data is
+    passed in order to output, with at most 2 * workers blocks in flight as
+    long as their input fits into queue_size bytes, but always one.
+
+    Input is accepted with the same put, get_buffer and put_buffer interface
+    as DigestPipeline, so producers can write to either.
+    """
+
+    stream_flags = b'\0' + bytes((lzma.CHECK_CRC64, ))
+
+    queue_size = 256 * 1024 * 1024
+
+    def __init__(
+            self,
+            output: typing.Callable[[bytes], None],
+            *,
+            block_size: int = 16 * 1024 * 1024,
+            preset: int = 6,
+            workers: int = None,
+            buffer_size: int = 4 * 1024 * 1024,
+            queue_size: int = None,
+    ) -> None:
+        self.output = output
+        self.block_size = block_size
+        self.preset = preset
+        self.workers = workers or os.cpu_count() or 1
+        if queue_size:
+            self.queue_size = queue_size
+
+        self.__buffer = bytearray(buffer_size)
+        self.__block = bytearray()
+        self.__pending: typing.Deque[typing.Tuple[concurrent.futures.Future, int]] = collections.deque()
+        self.__pending_size = 0
+        self.__records: typing.List[typing.Tuple[int, int]] = []
+        self.__executor: typing.Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+    def __enter__(self):
+        self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        header = XzBlockFile.header_magic + self.stream_flags
+        self.output(header + struct.pack('<I', zlib.crc32(self.stream_flags)))
+        return self
+
+    def __exit__(self, type, value, tb):
+        try:
+            if value is None:
+                self.close()
+        finally:
+            self.__executor.shutdown(wait=True, cancel_futures=True)
+
+    def _compress(self, data: bytes) -> typing.Tuple[bytes, int, int]:
+        """ Compress data as xz stream and return the only block and its index record """
+        stream = lzma.compress(data, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC64, preset=self.preset)
+        stream_flags, blocks = XzBlockFile._read_index(io.BytesIO(stream))
+        block, = blocks
+        padded_size = -(-block.unpadded_size // 4) * 4
+        return stream[block.fileoffset:block.fileoffset + padded_size], block.unpadded_size, block.size
+
+    def _submit(self) -> None:
+        self.__pending.append((self.__executor.submit(self._compress, bytes(self.__block)), len(self.__block)))
+        self.__pending_size += len(self.__block)
+        self.__block.clear()
+        while len(self.__pending) > 1 and (
+                len(self.__pending) >= 2 * self.workers or self.__pending_size > self.queue_size):
+            self._emit()
+
+    def _emit(self) -> None:
+        future, pending_size = self.__pending.popleft()
+        self.__pending_size -= pending_size
+        data, unpadded_size, size = future.result()
+        self.__records.append((unpadded_size, size))
+        self.output(data)
+
+    def get_buffer(self) -> bytearray:
+        return self.__buffer
+
+    def put_buffer(self, buf: bytearray, length: int) -> None:
+        with memoryview(buf) as mv, mv[:length] as smv:
+            self.put(smv)
+
+    def put(self, data) -> None:
+        with memoryview(data) as mv:
+            offset = 0
+            while offset < len(mv):
+                n = min(self.block_size - len(self.__block), len(mv) - offset)
+                with mv[offset:offset + n] as smv:
+                    self.__block += smv
+                offset += n
+                if len(self.__block) == self.block_size:
+                    self._submit()
+
+    def close(self) -> None:
+        """ Flush all blocks and write index and stream footer """
+        if self.__block:
+            self._submit()
+        while self.__pending:
+            self._emit()
+
+        index = bytearray(b'\0')
+        index += XzBlockFile._encode_varint(len(self.__records))
+        for unpadded_size, size in self.__records:
+            index += XzBlockFile._encode_varint(unpadded_size)
+            index += XzBlockFile._encode_varint(size)
+        index += bytes(-len(index) % 4)
+        index += struct.pack('<I', zlib.crc32(index))
+
+        footer = struct.pack('<I', len(index) // 4 - 1) + self.stream_flags
+        footer = struct.pack('<I', zlib.crc32(footer)) + footer + XzBlockFile.footer_magic
+
+        self.output(bytes(index + footer))
@@ -0,0 +1,165 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import io
+import pytest
+import subprocess
+
+from unittest.mock import Mock
+
+from debian_cloud_images.build.basefile import RunBaseLayer, RunBasefile
+from debian_cloud_images.utils.cache import FileCache
+
+
+@pytest.fixture
+def fai_config(tmp_path):
+    path = tmp_path / 'fai_config'
+    (path / 'class').mkdir(parents=True)
+    (path / 'class' / 'DEBIAN.var').write_text('TIMEZONE=UTC\nFAI_DEBOOTSTRAP_OPTS="--variant minbase"\n')
+    return path
+
+
+@pytest.fixture
+def archive():
+    """ Stand-in for urlopen, serving InRelease files """
+    files = {'http://deb.debian.org/debian/dists/bullseye/InRelease': b'1'}
+    urlopen = Mock(side_effect=lambda url: io.BytesIO(files[url]))
+    urlopen.files = files
+    return urlopen
+
+
+def popen_create(returncode=0):
+    def popen(cmd):
+        if cmd[1] == 'tar':
+            with open(cmd[cmd.index('--file') + 1], 'w') as f:
+                f.write('base')
+        proc = Mock()
+        proc.wait = Mock(return_value=returncode)
+        return proc
+    return Mock(side_effect=popen)
+
+
+class TestRunBasefile:
+    def run(self, tmp_path, archive):
+        return RunBasefile(
+            cache=FileCache(tmp_path / 'cache'),
+            suite='bullseye',
+            arch='arm64',
+            mirror='http://deb.debian.org/debian/',
+            urlopen=archive,
+        )
+
+    def test___call__(self, tmp_path, fai_config, archive):
+        run = self.run(tmp_path, archive)
+        popen = popen_create()
+
+        path = run(True, popen=popen, fai_config_path=fai_config)
+        assert path.read_text() == 'base'
+
+        cmd = popen.call_args_list[0].args[0]
+        assert cmd[:7] == ('sudo', 'debootstrap', '--variant', 'minbase', '--arch', 'arm64', 'bullseye')
+        assert cmd[8] == 'http://deb.debian.org/debian/'
+        assert popen.call_args_list[2].args[0][:3] == ('sudo', 'rm', '-rf')
+
+        # Second call uses cache
+        popen.reset_mock()
+        assert run(True, popen=popen, fai_config_path=fai_config) == path
+        popen.assert_not_called()
+
+    def test___call___fail(self, tmp_path, fai_config, archive):
+        run = self.run(tmp_path, archive)
+
+        with pytest.raises(subprocess.CalledProcessError):
+            run(True, popen=popen_create(1), fai_config_path=fai_config)
+
+        assert not list((tmp_path / 'cache').glob('??/[!.]*'))
+
+    def test___call___noop(self, tmp_path, fai_config, archive):
+        run = self.run(tmp_path, archive)
+        popen = Mock()
+
+        assert run(False, popen=popen, fai_config_path=fai_config) is None
+        popen.assert_not_called()
+        archive.assert_not_called()
+
+    def test_key(self, tmp_path, fai_config, archive):
+        run = self.run(tmp_path, archive)
+        key = run.key(fai_config)
+
+        assert self.run(tmp_path, archive).key(fai_config) == key
+        archive.assert_called_with('http://deb.debian.org/debian/dists/bullseye/InRelease')
+
+        # Other variables do not change the debootstrap call
+        (fai_config / 'class' / 'DEBIAN.var').write_text('TIMEZONE=CET\nFAI_DEBOOTSTRAP_OPTS="--variant minbase"\n')
+        assert run.key(fai_config) == key
+
+        (fai_config / 'class' / 'DEBIAN.var').write_text('FAI_DEBOOTSTRAP_OPTS="--variant buildd"\n')
+        assert run.key(fai_config) != key
+        assert run.command_debootstrap('TARGET', fai_config)[2:4] == ('--variant', 'buildd')
+
+    def test_key_archive(self, tmp_path, fai_config, archive):
+        run = self.run(tmp_path, archive)
+        key = run.key(fai_config)
+
+        archive.files['http://deb.debian.org/debian/dists/bullseye/InRelease'] = b'2'
+        assert run.key(fai_config) != key
+
+
+class TestRunBaseLayer:
+    def run(self, tmp_path, archive):
+        return RunBaseLayer(
+            cache=FileCache(tmp_path / 'cache'),
+            suite='bullseye',
+            arch='amd64',
+            mirror='http://deb.debian.org/debian/',
+            classes=['DEBIAN', 'CLOUD'],
+            env={'CLOUD_BUILD_LAYER': '1'},
+            urlopen=archive,
+        )
+
+    def test___call__(self, tmp_path, fai_config, archive):
+        run = self.run(tmp_path, archive)
+        popen = popen_create()
+
+        path = run(True, popen=popen, fai_config_path=fai_config)
+        assert path.read_text() == 'base'
+
+        cmd = popen.call_args_list[0].args[0]
+        assert cmd[:2] == ('sudo', 'env')
+        assert 'CLOUD_BUILD_LAYER=1' in cmd
+        assert cmd[cmd.index('--class') + 1] == 'DEBIAN,CLOUD'
+        assert cmd[-2] == 'dirinstall'
+
+    def test_key(self, tmp_path, fai_config, archive):
+        run = self.run(tmp_path, archive)
+        (fai_config / 'scripts' / 'CLOUD').mkdir(parents=True)
+        (fai_config / 'scripts' / 'CLOUD' / '10-setup').write_text('1')
+        (fai_config / 'scripts' / 'EC2').mkdir(parents=True)
+        (fai_config / 'scripts' / 'EC2' / '10-setup').write_text('1')
+        (fai_config / 'hooks').mkdir()
+        (fai_config / 'hooks' / 'setup.DEBIAN.sh').write_text('1')
+
+        assert [i.relative_to(fai_config).as_posix() for i in run.config_files(fai_config)] == [
+            'class/DEBIAN.var',
+            'hooks/setup.DEBIAN.sh',
+            'scripts/CLOUD/10-setup',
+        ]
+
+        key = run.key(fai_config)
+        (fai_config / 'scripts' / 'EC2' / '10-setup').write_text('2')
+        assert run.key(fai_config) == key
+        (fai_config / 'scripts' / 'CLOUD' / '10-setup').write_text('2')
+        assert run.key(fai_config) != key
+
+    def test_key_archive(self, tmp_path, fai_config, archive):
+        run = self.run(tmp_path, archive)
+        sources = fai_config / 'files' / 'etc' / 'apt' / 'sources.list.d' / 'backports.list'
+        sources.mkdir(parents=True)
+        (sources / 'CLOUD').write_text('deb http://deb.debian.org/debian bullseye-backports main\n')
+        archive.files['http://deb.debian.org/debian/dists/bullseye-backports/InRelease'] = b'1'
+        key = run.key(fai_config)
+
+        archive.files['http://deb.debian.org/debian/dists/bullseye/InRelease'] = b'2'
+        key_base = run.key(fai_config)
+        assert key_base != key
+        archive.files['http://deb.debian.org/debian/dists/bullseye-backports/InRelease'] = b'2'
+        assert run.key(fai_config) != key_base
@@ -0,0 +1,123 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import io
+import pytest
+import urllib.error
+
+from debian_cloud_images.build.buildcache import BuildCache
+from debian_cloud_images.utils.cache import FileCache
+
+
+@pytest.fixture
+def fai_config(tmp_path):
+    path = tmp_path / 'fai_config'
+    (path / 'class').mkdir(parents=True)
+    (path / 'class' / 'DEBIAN.var').write_text('apt_cdn=http://deb.debian.org\n')
+    (path / 'class' / 'EC2.var').write_text('apt_cdn=http://cdn-aws.deb.debian.org\n')
+    (path / 'class' / 'SID.var').write_text('release=sid\nFAI_DEBOOTSTRAP="$release $apt_cdn/debian/"\nCLASS_BUILD="SID_BUILD"\n')
+    (path / 'files' / 'etc' / 'apt' / 'sources.list').mkdir(parents=True)
+    (path / 'files' / 'etc' / 'apt' / 'sources.list' / 'SID_BUILD').write_text('deb {%apt_cdn%}/debian {%release%} main\n')
+    (path / 'files' / 'etc' / 'apt' / 'sources.list.d' / 'local.list').mkdir(parents=True)
+    (path / 'files' / 'etc' / 'apt' / 'sources.list.d' / 'local.list' / 'DEBIAN').write_text(
+        'deb [trusted=yes] copy:/localdebs/ ./\n'
+        'deb [arch=amd64 trusted=yes] http://example.com/flat/ ./ # comment\n'
+    )
+    return path
+
+
+class Archive:
+    """ Stand-in for urlopen, serving InRelease or Release files """
+
+    def __init__(self, files):
+        self.files = files
+
+    def __call__(self, url):
+        if url not in self.files:
+            raise urllib.error.HTTPError(url, 404, 'Not Found', {}, None)
+        return io.BytesIO(self.files[url])
+
+
+@pytest.fixture
+def archive():
+    return Archive({
+        'http://deb.debian.org/debian/dists/sid/InRelease': b'1',
+        'http://cdn-aws.deb.debian.org/debian/dists/sid/InRelease': b'1',
+        'http://example.com/flat/./Release': b'flat',
+    })
+
+
+class TestBuildCache:
+    def key(self, cache, fai_config, classes=('DEBIAN', 'CLOUD', 'SID'), env={}, **kw):
+        return cache.key(
+            classes=classes,
+            env=dict({'CLOUD_RELEASE_ID': 'ec2', 'CLOUD_RELEASE_VERSION': '1'}, **env),
+            mirror='http://deb.debian.org/debian/',
+            fai_config_path=fai_config,
+            **kw,
+        )
+
+    def test_key(self, tmp_path, fai_config, archive):
+        cache = BuildCache(FileCache(tmp_path / 'cache'), urlopen=archive)
+        key = self.key(cache, fai_config)
+
+        assert self.key(cache, fai_config, env={'CLOUD_BUILD_NAME': 'name'}) == key
+        # The version is written into the restored image
+        assert self.key(cache, fai_config, env={'CLOUD_RELEASE_VERSION': '2'}) == key
+        assert self.key(cache, fai_config, env={'CLOUD_BUILD_INFO': '{}'}) == key
+        assert self.key(cache, fai_config, env={'CLOUD_RELEASE_ID': 'gce'}) != key
+        assert self.key(cache, fai_config, classes=('DEBIAN', 'SID')) != key
+
+        localdebs = tmp_path / 'localdebs'
+        localdebs.mkdir()
+        (localdebs / 'a.deb').write_text('1')
+        key_localdebs = self.key(cache, fai_config, localdebs=localdebs)
+        assert key_localdebs != key
+        (localdebs / 'a.deb').write_text('2')
+        assert self.key(cache, fai_config, localdebs=localdebs) != key_localdebs
+
+        (fai_config / 'class' / 'DEBIAN.var').write_text('apt_cdn=http://deb.debian.org\n\n')
+        assert self.key(cache, fai_config) != key
+
+    def test_key_archive(self, tmp_path, fai_config, archive):
+        cache = BuildCache(FileCache(tmp_path / 'cache'), urlopen=archive)
+        key = self.key(cache, fai_config)
+
+        archive.files['http://deb.debian.org/debian/dists/sid/InRelease'] = b'2'
+        assert self.key(cache, fai_config) != key
+
+        del archive.files['http://deb.debian.org/debian/dists/sid/InRelease']
+        with pytest.raises(urllib.error.HTTPError):
+            self.key(cache, fai_config)
+
+    def test_apt_sources(self, tmp_path, fai_config):
+        cache = BuildCache(FileCache(tmp_path / 'cache'))
+
+        assert cache.apt_sources(['DEBIAN', 'SID'], fai_config) == [
+            ('http://deb.debian.org/debian', 'sid'),
+            ('http://example.com/flat/', './'),
+        ]
+        assert cache.apt_sources(['DEBIAN', 'SID', 'EC2'], fai_config)[0] == ('http://cdn-aws.deb.debian.org/debian', 'sid')
+
+    def test_get_put(self, tmp_path, fai_config, archive):
+        cache = BuildCache(FileCache(tmp_path / 'cache'), urlopen=archive)
+        key = self.key(cache, fai_config)
+        image = tmp_path / 'image.raw'
+        manifest = tmp_path / 'image.build-fai.json'
+
+        assert not cache.get(key, image, manifest)
+        assert not image.exists()
+
+        with image.open('wb') as f:
+            f.truncate(4 * 1024 * 1024)
+            f.write(b'image')
+        manifest.write_text('manifest')
+        content = image.read_bytes()
+        cache.put(key, image, manifest)
+        image.unlink()
+        manifest.unlink()
+
+        assert cache.get(key, image, manifest)
+        assert image.read_bytes() == content
+        # Holes stay holes
+        assert image.stat().st_blocks * 512 < 1024 * 1024
+        assert manifest.read_text() == 'manifest'
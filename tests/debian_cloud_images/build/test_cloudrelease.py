@@ -0,0 +1,81 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import io
+import pytest
+import shutil
+import struct
+import subprocess
+
+from debian_cloud_images.build.cloudrelease import CloudRelease, RunCloudRelease
+
+
+check_no_e2fsprogs = any(shutil.which(i) is None for i in ('mkfs.ext4', 'debugfs'))
+skip_no_e2fsprogs = pytest.mark.skipif(check_no_e2fsprogs,
+                                       reason='Need available e2fsprogs')
+
+fs_offset = 1024 * 1024
+fs_size = 16 * 1024 * 1024
+
+
+def test_CloudRelease():
+    f = io.StringIO()
+    CloudRelease({'CLOUD_RELEASE_ID': 'ec2', 'CLOUD_RELEASE_VERSION': '20220101-1', 'CI_JOB_URL': ''}).write(f)
+    assert f.getvalue() == 'ID="ec2"\nVERSION="20220101-1"\n'
+
+
+@skip_no_e2fsprogs
+def test_RunCloudRelease(tmp_path):
+    root = tmp_path / 'root'
+    (root / 'etc').mkdir(parents=True)
+    (root / 'etc' / 'cloud-release').write_text('ID="ec2"\nVERSION="1"\n')
+    fs = tmp_path / 'fs'
+    with fs.open('wb') as f:
+        f.truncate(fs_size)
+    subprocess.run(('mkfs.ext4', '-q', '-F', '-d', root.as_posix(), fs.as_posix()), check=True)
+
+    disk = tmp_path / 'disk.raw'
+    with disk.open('wb') as f:
+        mbr = bytearray(512)
+        struct.pack_into('<4xB3xII', mbr, 446, 0x83, fs_offset // 512, fs_size // 512)
+        mbr[510:512] = b'\x55\xaa'
+        f.write(mbr)
+        f.seek(fs_offset)
+        f.write(fs.read_bytes())
+
+    run = RunCloudRelease(filename=disk, env={'CLOUD_RELEASE_ID': 'ec2', 'CLOUD_RELEASE_VERSION': '2'})
+    run.debugfs_filename = shutil.which('debugfs')
+    assert run.devices() == [f'{disk.as_posix()}?offset={fs_offset}']
+    run(True)
+
+    device = run.devices()[0]
+    output = subprocess.run(
+        ('debugfs', '-R', 'cat /etc/cloud-release', device),
+        check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+    ).stdout
+    assert output == 'ID="ec2"\nVERSION="2"\n'
+    output = subprocess.run(
+        ('debugfs', '-R', 'stat /etc/cloud-release', device),
+        check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+    ).stdout
+    assert 'Mode:  0644' in output
+    assert 'User:     0   Group:     0' in output
+
+
+@skip_no_e2fsprogs
+def test_RunCloudRelease_missing(tmp_path):
+    disk = tmp_path / 'disk.raw'
+    with disk.open('wb') as f:
+        f.truncate(fs_size)
+    subprocess.run(('mkfs.ext4', '-q', '-F', disk.as_posix()), check=True)
+
+    run = RunCloudRelease(filename=disk, env={})
+    run.debugfs_filename = shutil.which('debugfs')
+    with pytest.raises(RuntimeError):
+        run(True)
+
+
+def test_RunCloudRelease_noop(tmp_path):
+    disk = tmp_path / 'disk.raw'
+    run = RunCloudRelease(filename=disk, env={})
+    run(False)
+    assert not disk.exists()
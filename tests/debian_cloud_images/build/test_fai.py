@@ -1,5 +1,6 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import json
 import pytest
 import subprocess
 
@@ -7,6 +8,7 @@ from unittest.mock import Mock
 
 from debian_cloud_images.build.fai import (
     fai_config_path,
+    FaiTimings,
     RunFAI,
 )
 
@@ -24,12 +26,18 @@ class TestRunFAI:
             size_gb=23,
             env=env,
             fai_filename=tmp_path.as_posix(),
+            timings_filename=tmp_path / 'timings.json',
         )
         popen_proc = Mock()
+        popen_proc.stdout = [b'Calling task_setup\n', b'output\n', b'Calling task_instsoft\n']
         popen_proc.wait = Mock(return_value=0)
         popen = Mock(return_value=popen_proc)
 
-        run(True, popen=popen, dci_path='/nonexistent')
+        timings = run(True, popen=popen, dci_path='/nonexistent')
+
+        assert list(timings.tasks) == ['setup', 'instsoft']
+        with (tmp_path / 'timings.json').open() as f:
+            assert list(json.load(f)['tasks']) == ['setup', 'instsoft']
 
         popen.assert_called_with(
             (
@@ -46,6 +54,8 @@ class TestRunFAI:
                 '--cspace', fai_config_path,
                 tmp_path.as_posix(),
             ),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
         )
 
     def test___call___fail(self, tmp_path):
@@ -58,6 +68,7 @@ class TestRunFAI:
             fai_filename=tmp_path.as_posix(),
         )
         popen_proc = Mock()
+        popen_proc.stdout = []
         popen_proc.wait = Mock(return_value=23)
         popen = Mock(return_value=popen_proc)
 
@@ -80,3 +91,23 @@ class TestRunFAI:
         run(False, popen=popen)
 
         popen.assert_not_called()
+
+
+class TestFaiTimings:
+    def test(self):
+        clock = Mock(side_effect=range(0, 100, 10))
+        timings = FaiTimings(clock=clock)                       # 0
+        timings.feed('Calling task_partition\n')               # 10
+        timings.feed('Calling hook: instsoft.DEBIAN\n')        # 20
+        timings.feed('Calling task_instsoft\n')                # 30
+        timings.feed('some output\n')                          # 40
+        timings.feed('Executing    shell: DEBIAN/10-files\n')  # 50
+        timings.feed('Calling task_configure\n')               # 60
+        timings.finish()                                        # 70
+
+        assert timings.dump() == {
+            'total': 70,
+            'tasks': {'partition': 20, 'instsoft': 30, 'configure': 10},
+            'hooks': {'instsoft.DEBIAN': 10},
+            'scripts': {'DEBIAN/10-files': 10},
+        }
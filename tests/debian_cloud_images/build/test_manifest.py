@@ -28,11 +28,12 @@ class TestCreateManifest:
         with input_filename.open('w') as f:
             f.write('{"apiVersion":"cloud.debian.org/v1alpha1","kind":"Build","metadata":{},"data":{}}')
 
-        run(True, ['digest'])
+        run(True, ['digest'], {'instsoft': 12.345})
 
         with output_filename.open() as f:
             data = json.load(f)
             assert data['data']['info'] == self.info
+            assert data['metadata']['annotations']['build.cloud.debian.org/time-instsoft'] == '12.3'
 
     def test___call___fail(self, tmp_path):
         input_filename = tmp_path / 'in'
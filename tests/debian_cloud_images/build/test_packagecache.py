@@ -0,0 +1,94 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import http.server
+import pytest
+import threading
+import urllib.error
+import urllib.request
+
+from debian_cloud_images.build.packagecache import PackageCache
+from debian_cloud_images.utils.cache import FileCache
+
+
+class Upstream(http.server.BaseHTTPRequestHandler):
+    files = {
+        '/debian/pool/main/h/hello/hello_2.10-3_amd64.deb': b'deb' * 1000,
+        '/mirror/debian/pool/main/h/hello/hello_2.10-3_amd64.deb': b'deb' * 1000,
+        '/debian/pool/main/h/hello/hello_2.10-4_amd64.deb': b'new',
+        '/debian/dists/sid/InRelease': b'release',
+    }
+    requests = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.requests.append(('GET', self.path))
+        data = self.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def upstream():
+    Upstream.requests = []
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Upstream)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def open_proxy(proxy, url):
+    opener = urllib.request.build_opener(urllib.request.ProxyHandler({'http': proxy}))
+    with opener.open(url) as r:
+        return r.read()
+
+
+class TestPackageCache:
+    def test_cached(self, tmp_path, upstream):
+        url = upstream + '/debian/pool/main/h/hello/hello_2.10-3_amd64.deb'
+
+        with PackageCache(FileCache(tmp_path)) as cache:
+            assert open_proxy(cache.url, url) == b'deb' * 1000
+            assert open_proxy(cache.url, url) == b'deb' * 1000
+
+        # Another build, using another mirror
+        with PackageCache(FileCache(tmp_path)) as cache:
+            assert open_proxy(cache.url, upstream + '/mirror/debian/pool/main/h/hello/hello_2.10-3_amd64.deb') == b'deb' * 1000
+            assert cache.cache.stats() == {'hits': 1, 'misses': 0}
+
+        assert Upstream.requests == [('GET', '/debian/pool/main/h/hello/hello_2.10-3_amd64.deb')]
+
+    def test_evict(self, tmp_path, upstream):
+        with PackageCache(FileCache(tmp_path, max_size=1)) as cache:
+            open_proxy(cache.url, upstream + '/debian/pool/main/h/hello/hello_2.10-3_amd64.deb')
+            open_proxy(cache.url, upstream + '/debian/pool/main/h/hello/hello_2.10-4_amd64.deb')
+
+        # Only the last entry is kept
+        assert len(list(tmp_path.glob('??/[!.]*'))) == 1
+
+    def test_passthrough(self, tmp_path, upstream):
+        url = upstream + '/debian/dists/sid/InRelease'
+
+        with PackageCache(FileCache(tmp_path)) as cache:
+            assert open_proxy(cache.url, url) == b'release'
+            assert open_proxy(cache.url, url) == b'release'
+            assert cache.cache.stats() == {'hits': 0, 'misses': 0}
+
+        assert Upstream.requests == [('GET', '/debian/dists/sid/InRelease')] * 2
+
+    def test_missing(self, tmp_path, upstream):
+        with PackageCache(FileCache(tmp_path)) as cache:
+            for path in ('/debian/dists/sid/Release', '/debian/pool/main/m/missing/missing_1_all.deb'):
+                with pytest.raises(urllib.error.HTTPError) as e:
+                    open_proxy(cache.url, upstream + path)
+                assert e.value.code == 404
+
+        assert not list(tmp_path.glob('??/[!.]*'))
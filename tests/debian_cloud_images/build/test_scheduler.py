@@ -0,0 +1,58 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import threading
+import time
+
+from debian_cloud_images.build.scheduler import Job, ResourceScheduler
+
+
+class TestResourceScheduler:
+    def test_run(self):
+        lock = threading.Lock()
+        used = {'disk': 0}
+        peak = {'disk': 0}
+
+        def func(disk):
+            def run():
+                with lock:
+                    used['disk'] += disk
+                    peak['disk'] = max(peak['disk'], used['disk'])
+                time.sleep(0.05)
+                with lock:
+                    used['disk'] -= disk
+            return run
+
+        jobs = [Job(str(i), func(disk), {'disk': disk}) for i, disk in enumerate((30, 10, 10, 10, 2, 2))]
+
+        start = time.monotonic()
+        ResourceScheduler({'disk': 32}).run(jobs)
+        duration = time.monotonic() - start
+
+        assert peak['disk'] == 32
+        assert all(job.duration >= 0.05 and job.error is None for job in jobs)
+        # 30+2, 10+10+10+2, serial execution would take 0.3s
+        assert duration < 0.25
+
+    def test_run_error(self):
+        def fail():
+            raise RuntimeError('failed')
+
+        jobs = ResourceScheduler({'jobs': 1}).run([
+            Job('fail', fail, {'jobs': 1}),
+            Job('ok', lambda: None, {'jobs': 1}),
+        ])
+
+        assert isinstance(jobs[0].error, RuntimeError)
+        assert jobs[1].error is None
+        assert jobs[1].start >= jobs[0].end
+
+    def test_run_too_large(self):
+        jobs = ResourceScheduler({'jobs': 1}).run([
+            Job('large', lambda: None, {'jobs': 2}),
+            Job('ok', lambda: None, {'jobs': 1}),
+        ])
+
+        assert isinstance(jobs[0].error, ValueError)
+        assert jobs[0].start is None
+        assert jobs[1].error is None
+        assert jobs[1].duration is not None
@@ -0,0 +1,52 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import pytest
+import subprocess
+
+from unittest.mock import Mock
+
+from debian_cloud_images.build.sparse import RunSparse
+from debian_cloud_images.utils.files import data_extents
+
+
+@pytest.fixture
+def image(tmp_path):
+    filename = tmp_path / 'disk.raw'
+    with filename.open('wb') as f:
+        f.write(b'1' * 1000)
+        f.write(bytes(8 * 1024 * 1024))
+        f.write(b'2' * 1000)
+        f.truncate(16 * 1024 * 1024)
+    return filename
+
+
+class TestRunSparse:
+    def test___call__(self, image):
+        content = image.read_bytes()
+        run = RunSparse(filename=image)
+
+        reclaimed = run(True)
+
+        assert image.read_bytes() == content
+        with image.open('rb') as f:
+            extents = list(data_extents(f, len(content)))
+        if reclaimed == 0:
+            pytest.skip('Filesystem does not support holes')
+        assert reclaimed >= 8 * 1024 * 1024 - 8192
+        assert extents == [(0, 4096), (8 * 1024 * 1024, 4096)]
+
+    def test___call___permission(self, image):
+        run = RunSparse(filename=image)
+        popen_proc = Mock()
+        popen_proc.wait = Mock(return_value=23)
+        popen = Mock(return_value=popen_proc)
+        run.punch = Mock(side_effect=PermissionError)
+
+        with pytest.raises(subprocess.CalledProcessError):
+            run(True, popen=popen)
+
+        popen.assert_called_with(('sudo', 'fallocate', '--dig-holes', image.as_posix()))
+
+    def test___call___noop(self, image):
+        run = RunSparse(filename=image)
+        assert run(False) == 0
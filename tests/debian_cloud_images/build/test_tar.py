@@ -1,13 +1,30 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
-import io
+import base64
+import hashlib
 import pytest
+import shutil
 import subprocess
 import tarfile
 
-from unittest.mock import Mock
-
 from debian_cloud_images.build.tar import RunTar
+from debian_cloud_images.utils.files import TarMemberFile
+
+
+check_no_tar = shutil.which('tar') is None
+skip_no_tar = pytest.mark.skipif(check_no_tar,
+                                 reason='Need available tar')
+
+
+@pytest.fixture
+def input_sparse(tmp_path):
+    input_filename = tmp_path / 'in'
+    with input_filename.open('wb') as f:
+        f.write(b'1' * 1000)
+        f.seek(1024 * 1024)
+        f.write(b'2' * 5000)
+        f.truncate(4 * 1024 * 1024)
+    return input_filename
 
 
 class TestRunTar:
@@ -19,29 +36,21 @@ class TestRunTar:
             output_filename=output_filename,
             inner_filename='file',
         )
-        popen_proc = Mock()
-        popen_proc.stdout = io.BytesIO(b'')
-        popen_proc.wait = Mock(return_value=0)
-        popen = Mock(return_value=popen_proc)
-
-        digest = run(True, popen=popen)
-
-        # Digest of empty string
-        assert digest == 'sha512:z4PhNX7vuL3xVChQ1m2AB9Yg5AULVxXcg/SpIdNs6c5H0NE8XYXysP+DGNKHfuwvY7kxvUdBeoGlODJ6+SfaPg'
-
-        popen.assert_called_with(
-            (
-                'tar',
-                '--create',
-                '--absolute-names',
-                '--sparse',
-                '--transform', r's/.*/file/',
-                input_filename.as_posix(),
-            ),
-            bufsize=0,
-            stdout=subprocess.PIPE,
-        )
-        popen_proc.wait.assert_called()
+
+        with input_filename.open('w') as f:
+            f.write('content')
+
+        digests = run(True)
+        assert [i.split(':')[0] for i in digests] == ['sha512', 'sha256']
+
+        with output_filename.open('rb') as f:
+            assert len(f.read()) % tarfile.RECORDSIZE == 0
+            f.seek(0)
+            with tarfile.TarFile(fileobj=f) as t:
+                members = t.getmembers()
+                assert len(members) == 1
+                assert members[0].name == 'file'
+                assert t.extractfile(members[0]).read() == b'content'
 
     def test___call___fail(self, tmp_path):
         input_filename = tmp_path / 'in'
@@ -51,15 +60,9 @@ class TestRunTar:
             output_filename=output_filename,
             inner_filename='file',
         )
-        popen_proc = Mock()
-        popen_proc.stdout = io.BytesIO(b'')
-        popen_proc.wait = Mock(return_value=23)
-        popen = Mock(return_value=popen_proc)
-
-        with pytest.raises(subprocess.CalledProcessError) as excinfo:
-            run(True, popen=popen)
 
-        assert excinfo.value.returncode == 23
+        with pytest.raises(FileNotFoundError):
+            run(True)
 
     def test___call___noop(self, tmp_path):
         input_filename = tmp_path / 'in'
@@ -69,32 +72,86 @@ class TestRunTar:
             output_filename=output_filename,
             inner_filename='file',
         )
-        popen = Mock()
 
-        run(False, popen=popen)
+        digests = run(False)
 
-        popen.assert_not_called()
+        # Digests of empty string
+        assert digests == [
+            'sha512:z4PhNX7vuL3xVChQ1m2AB9Yg5AULVxXcg/SpIdNs6c5H0NE8XYXysP+DGNKHfuwvY7kxvUdBeoGlODJ6+SfaPg',
+            'sha256:47DEQpj8HBSa+/TImW+5JCeuQeRkm5NMpJWZG3hSuFU',
+        ]
+        assert not output_filename.exists()
 
-    def test___call___real(self, tmp_path, capfd):
-        input_filename = tmp_path / 'in'
+    def test___call___sparse(self, tmp_path, input_sparse):
         output_filename = tmp_path / 'out'
         run = RunTar(
-            input_filename=input_filename,
+            input_filename=input_sparse,
             output_filename=output_filename,
-            inner_filename='file',
         )
 
-        with input_filename.open('w') as f:
-            f.write('content')
+        digests = run(True)
+
+        data = output_filename.read_bytes()
+        assert digests == [
+            'sha512:' + base64.b64encode(hashlib.sha512(data).digest()).decode().rstrip('='),
+            'sha256:' + base64.b64encode(hashlib.sha256(data).digest()).decode().rstrip('='),
+        ]
+
+        with TarMemberFile.open(output_filename.open('rb'), 'disk.raw') as f:
+            assert f.size == input_sparse.stat().st_size
+            assert f.read() == input_sparse.read_bytes()
+
+    def test___call___compress(self, tmp_path, input_sparse):
+        output_filename = tmp_path / 'out.tar.xz'
+        run = RunTar(
+            input_filename=input_sparse,
+            output_filename=output_filename,
+            compress='xz',
+        )
+
+        digests = run(True)
+
+        data = output_filename.read_bytes()
+        assert digests[0] == 'sha512:' + base64.b64encode(hashlib.sha512(data).digest()).decode().rstrip('=')
+
+        with tarfile.open(output_filename) as t:
+            assert t.extractfile('disk.raw').read() == input_sparse.read_bytes()
+
+    def test___call___compress_invalid(self, tmp_path):
+        with pytest.raises(ValueError):
+            RunTar(
+                input_filename=tmp_path / 'in',
+                output_filename=tmp_path / 'out',
+                compress='invalid',
+            )
+
+    @skip_no_tar
+    def test___call___sparse_gnu_tar(self, tmp_path, input_sparse, capfd):
+        output_filename = tmp_path / 'out'
+        extract_path = tmp_path / 'extract'
+        extract_path.mkdir()
+        run = RunTar(
+            input_filename=input_sparse,
+            output_filename=output_filename,
+        )
 
         run(True)
 
-        with output_filename.open('rb') as f:
-            with tarfile.TarFile(fileobj=f) as t:
-                members = t.getmembers()
-                assert len(members) == 1
-                assert members[0].name == 'file'
+        subprocess.check_call((
+            'tar',
+            '--extract',
+            '--file', output_filename.as_posix(),
+            '--directory', extract_path.as_posix(),
+        ))
+
+        assert [i.name for i in extract_path.iterdir()] == ['disk.raw']
+        assert (extract_path / 'disk.raw').read_bytes() == input_sparse.read_bytes()
 
         captured = capfd.readouterr()
         assert not captured.out
         assert not captured.err
+
+    def test_sparse_map(self):
+        assert RunTar.sparse_map(10, []) == b'1\n10\n0\n'.ljust(512, b'\0')
+        assert RunTar.sparse_map(10, [(0, 10)]) == b'1\n0\n10\n'.ljust(512, b'\0')
+        assert RunTar.sparse_map(10, [(2, 3)]) == b'2\n2\n3\n10\n0\n'.ljust(512, b'\0')
@@ -1,6 +1,14 @@
+import datetime
+import json
+
 from debian_cloud_images.cli.build import (
     ArchEnum,
+    BuildCommand,
+    BuildId,
+    BuildTypeEnum,
+    Check,
     ReleaseEnum,
+    VendorEnum,
 )
 
 
@@ -14,3 +22,109 @@ class TestCommand:
         assert sid.supports_linux_image_cloud_for_arch(amd64.name) is True
         assert sid.supports_linux_image_cloud_for_arch(arm64.name) is True
         assert sid.supports_linux_image_cloud_for_arch(ppc64el.name) is False
+
+    def test_classes_layer(self):
+        def check(vendor):
+            c = Check()
+            c.set_type(BuildTypeEnum.dev)
+            c.set_release(ReleaseEnum.bullseye)
+            c.set_vendor(vendor)
+            c.set_arch(ArchEnum.amd64)
+            c.check()
+            return c
+
+        ec2 = check(VendorEnum.ec2)
+        azure = check(VendorEnum.azure)
+
+        assert ec2.classes_layer == azure.classes_layer == [
+            'DEBIAN', 'CLOUD', 'TYPE_DEV', 'BULLSEYE', 'EXTRAS', 'AMD64',
+        ]
+        assert 'GRUB_CLOUD_AMD64' in ec2.classes
+        assert 'EC2' in ec2.classes
+
+
+def test_BuildCommand_layered(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    c = BuildCommand(
+        release=ReleaseEnum.bullseye,
+        vendor=VendorEnum.ec2,
+        arch=ArchEnum.amd64,
+        build_id=BuildId('test'),
+        build_type=BuildTypeEnum.dev,
+        version=1,
+        version_date=datetime.datetime(2022, 1, 1),
+        output=tmp_path / 'output',
+        basefile_cache=tmp_path / 'cache',
+        layered=True,
+    )
+
+    assert c.layer.classes == c.c.classes_layer
+    # fcopy and the class dependent package lists need all classes in the vendor build
+    assert list(c.fai.classes) == list(c.c.classes)
+    assert set(c.c.classes_layer) < set(c.fai.classes)
+
+
+def test_BuildCommand_build_cache(tmp_path, monkeypatch):
+    from debian_cloud_images.api.cdo.build import Build
+    from debian_cloud_images.api.registry import registry as api_registry
+    from debian_cloud_images.build.buildcache import BuildCache
+    from debian_cloud_images.build.cloudrelease import RunCloudRelease
+
+    monkeypatch.chdir(tmp_path)
+    archive = {'digest': '1'}
+
+    def release_digest(self, uri, suite):
+        if archive['digest'] is None:
+            raise OSError('unreachable')
+        return archive['digest']
+
+    monkeypatch.setattr(BuildCache, 'release_digest', release_digest)
+
+    def command(version):
+        return BuildCommand(
+            release=ReleaseEnum.bullseye,
+            vendor=VendorEnum.ec2,
+            arch=ArchEnum.amd64,
+            build_id=BuildId('test'),
+            build_type=BuildTypeEnum.dev,
+            version=version,
+            version_date=datetime.datetime(2022, 1, 1),
+            output=tmp_path / 'output',
+            build_cache=tmp_path / 'cache',
+        )
+
+    c1 = command(1)
+    c1.sparse.filename.write_bytes(b'image')
+    with c1.manifest.input_filename.open('w') as f:
+        json.dump(api_registry.dump(Build(packages=[])), f)
+    c1.build_cache.put(c1.build_cache_key, c1.sparse.filename, c1.manifest.input_filename)
+
+    # The state of the archive defines the packages, the version is written into the image on a hit
+    assert command(2).build_cache_key == c1.build_cache_key
+    archive['digest'] = '2'
+    assert command(1).build_cache_key != c1.build_cache_key
+    archive['digest'] = None
+    assert command(1).build_cache is None
+    archive['digest'] = '1'
+
+    c1.sparse.filename.unlink()
+    c1.manifest.input_filename.unlink()
+    c2 = command(2)
+    assert c2.build_cache_key == c1.build_cache_key
+    stamped = []
+    monkeypatch.setattr(RunCloudRelease, '__call__', lambda self, run: stamped.append(dict(self.env)))
+    c2()
+
+    assert c2.sparse.filename.read_bytes() == b'image'
+    assert stamped[0]['CLOUD_RELEASE_VERSION'] == c2.c.version
+    with c2.manifest.output_filename.open() as f:
+        data = json.load(f)
+    assert data['data']['info'] == c2.c.info
+    assert data['metadata']['labels']['cloud.debian.org/version'] == c2.c.version
+    # The tar is written from the restored image
+    assert c2.tar.output_filename.exists()
+    assert data['metadata']['annotations']['cloud.debian.org/digest'].startswith('sha512:')
+    assert data['metadata']['annotations']['build.cloud.debian.org/cache'] == 'hit'
+    assert data['metadata']['annotations']['build.cloud.debian.org/cache-key'] == c2.build_cache_key
+    assert not [k for k in data['metadata']['annotations'] if 'time-' in k]
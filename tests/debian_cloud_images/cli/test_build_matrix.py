@@ -0,0 +1,54 @@
+import pathlib
+
+from debian_cloud_images.cli.build import BuildId, BuildTypeEnum
+from debian_cloud_images.cli.build_matrix import BuildMatrixCommand
+
+
+class TestCommand:
+    def test_jobs(self, tmp_path):
+        c = BuildMatrixCommand(
+            releases=['bullseye'],
+            vendors=['ec2', 'azure'],
+            archs=['amd64', 'arm64'],
+            build_id=BuildId('test'),
+            build_type=BuildTypeEnum.dev,
+            output=tmp_path,
+            version=1,
+            jobs=2,
+            max_disk=64 * 1024 ** 3,
+            compress='xz',
+            basefile_cache=tmp_path / 'basefiles',
+        )
+
+        jobs = c.jobs()
+        # azure has no arm64 images
+        assert [j.name for j in jobs] == [
+            'bullseye-azure-amd64',
+            'bullseye-ec2-amd64',
+            'bullseye-ec2-arm64',
+        ]
+        assert jobs[0].resources == {'jobs': 1, 'disk': 30 * 1024 ** 3, 'loop_devices': 1}
+        assert c.scheduler.capacity == {'jobs': 2, 'disk': 64 * 1024 ** 3, 'loop_devices': 8}
+
+        cmd = c.build_command('bullseye', 'ec2', 'arm64')
+        assert cmd[1:6] == ['-m', 'debian_cloud_images.cli.build', 'bullseye', 'ec2', 'arm64']
+        assert cmd[cmd.index('--output') + 1] == pathlib.Path(tmp_path).as_posix()
+        assert cmd[cmd.index('--compress') + 1] == 'xz'
+        assert cmd[cmd.index('--version') + 1] == '1'
+        assert cmd[cmd.index('--basefile-cache') + 1] == (tmp_path / 'basefiles').as_posix()
+        assert '--basefile-mirror' not in cmd
+
+    def test_jobs_default(self, tmp_path):
+        c = BuildMatrixCommand(build_id=BuildId('test'), build_type=BuildTypeEnum.dev, output=tmp_path, max_disk=1)
+
+        names = {j.name for j in c.jobs()}
+        assert 'sid-generic-ppc64el' in names
+        assert 'sid-ec2-arm64' in names
+        assert 'sid-vagrant-ppc64el' in names
+        for vendor in ('azure', 'ec2', 'gce'):
+            assert f'sid-{vendor}-ppc64el' not in names
+        assert 'sid-azure-arm64' not in names
+        # Same selection as generate-ci
+        assert 'bullseye-gce-amd64' not in names
+        assert 'bullseye-backports-gce-amd64' in names
+        assert len(names) == 8 * 16 - 1
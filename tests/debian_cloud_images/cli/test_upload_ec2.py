@@ -30,6 +30,8 @@ class TestCommand:
                     },
                     'storage': {
                         'name': 'bucket',
+                        'part_size': '8M',
+                        'workers': 4,
                     },
                     'image': {
                         'regions': ['all'],
@@ -46,10 +48,215 @@ class TestCommand:
         mock_uploader.assert_called_once_with(
             add_tags={'Tag': 'Value'},
             bucket='bucket',
+            copies_per_region=None,
+            ebs_direct=False,
             key='access_key_id',
             output='output',
             permission_public='permission_public',
             regions=['all'],
             secret='access_secret_key',
+            storage_part_size=8 * 1024 * 1024,
+            storage_workers=4,
             token='access_session_token',
+            workers=None,
         )
+
+
+class TestImageUploaderEc2:
+    @pytest.fixture
+    def uploader(self):
+        from debian_cloud_images.cli.upload_ec2 import ImageUploaderEc2
+        from debian_cloud_images.utils.libcloud.compute.ec2 import ExEC2SnapshotWaiter
+
+        class Waiter(ExEC2SnapshotWaiter):
+            interval_min = 0.01
+
+        ret = ImageUploaderEc2(
+            output=None, bucket='bucket', key='key', secret='secret', token=None,
+            regions=['all'], add_tags={}, permission_public=False,
+        )
+        ret.snapshot_waiter_cls = Waiter
+        return ret
+
+    @pytest.fixture
+    def drivers(self, uploader, monkeypatch):
+        from unittest.mock import MagicMock
+        from libcloud.compute.base import VolumeSnapshot
+        from libcloud.compute.types import VolumeSnapshotState
+
+        drivers = {}
+        for region in ('base', 'a', 'b', 'broken', 'failed'):
+            driver = drivers[region] = MagicMock()
+            driver.region_name = region
+            driver.ex_copy_snapshot.side_effect = lambda snapshot, description, tags, driver=driver: VolumeSnapshot(f'snap-{driver.region_name}', driver)
+            driver.ex_list_snapshots.side_effect = lambda ids, driver=driver: [
+                VolumeSnapshot(i, driver, state=VolumeSnapshotState.AVAILABLE) for i in ids
+            ]
+        drivers['broken'].ex_copy_snapshot.side_effect = RuntimeError('broken')
+        drivers['failed'].ex_list_snapshots.side_effect = lambda ids, driver=drivers['failed']: [
+            VolumeSnapshot(i, driver, state=VolumeSnapshotState.ERROR, extra={'state': 'error'}) for i in ids
+        ]
+        monkeypatch.setattr(type(uploader), 'compute', drivers)
+        return drivers
+
+    @pytest.fixture
+    def image(self):
+        from unittest.mock import MagicMock
+        image = MagicMock()
+        image.build_arch = 'amd64'
+        image.build_info = {'version': '1'}
+        return image
+
+    def test_copy_image(self, uploader, drivers, image):
+        from unittest.mock import MagicMock
+        from libcloud.compute.base import VolumeSnapshot
+        public_info = MagicMock(vendor_name='name', vendor_family='family', vendor_description='description')
+
+        errors = {}
+        images = uploader.copy_image(image, public_info, VolumeSnapshot('snap-base', drivers['base']), errors)
+
+        assert sorted(images) == ['a', 'b', 'base']
+        assert sorted(errors) == ['broken', 'failed']
+
+        tags = drivers['a'].ex_copy_snapshot.call_args.kwargs['tags']
+        assert tags['AMI'] == 'name'
+        drivers['a'].ex_create_tags.assert_not_called()
+        drivers['base'].ex_create_tags.assert_called_once()
+        drivers['a'].ex_modify_snapshot_attribute.assert_called_once()
+        assert drivers['a'].ex_register_image.call_args.kwargs['tags'] == tags
+        assert drivers['a'].ex_register_image.call_args.kwargs['block_device_mapping'][0]['Ebs']['SnapshotId'] == 'snap-a'
+        drivers['failed'].ex_register_image.assert_not_called()
+
+        # All copy slots are released again
+        for region in ('a', 'broken', 'failed'):
+            slot = uploader.copy_slot(region)
+            assert all(slot.acquire(blocking=False) for i in range(uploader.copies_per_region))
+
+    def test_copy_image_ebs_direct(self, uploader, drivers, image):
+        from unittest.mock import MagicMock
+        from libcloud.compute.base import VolumeSnapshot
+        public_info = MagicMock(vendor_name='name', vendor_family='family', vendor_description='description')
+        uploader.ebs_direct = True
+
+        errors = {}
+        images = uploader.copy_image(image, public_info, VolumeSnapshot('snap-base', drivers['base']), errors)
+
+        assert 'base' in images
+        # The snapshot was tagged by start_snapshot already
+        drivers['base'].ex_create_tags.assert_not_called()
+        drivers['base'].ex_modify_snapshot_attribute.assert_called_once()
+
+    def test_copy_slot(self, uploader):
+        uploader.copies_per_region = 1
+        slot = uploader.copy_slot('a')
+        assert slot is uploader.copy_slot('a')
+        assert slot is not uploader.copy_slot('b')
+        assert slot.acquire(blocking=False)
+        assert not slot.acquire(blocking=False)
+
+    def test_upload_snapshot(self, uploader, drivers, image, ebs_server, tmp_path, monkeypatch):
+        import functools
+        from unittest.mock import MagicMock
+        from debian_cloud_images.utils.libcloud.other.aws_ebs import EBSConnection
+
+        block_size = ebs_server.block_size
+        raw = tmp_path / 'disk.raw'
+        with raw.open('wb') as f:
+            f.seek(100)
+            f.write(b'a' * 100)
+            f.seek(2 * block_size)
+            f.write(bytes(block_size))
+            f.seek(5 * block_size - 10)
+            f.write(b'b' * 1010)
+        size = raw.stat().st_size
+
+        image.open_image.side_effect = lambda *formats: raw.open('rb', buffering=0)
+        uploader.ebs_cls = functools.partial(EBSConnection, host='127.0.0.1', port=ebs_server.port, secure=False)
+        monkeypatch.setattr(type(uploader), 'storage', MagicMock(region_name='base'))
+        public_info = MagicMock(vendor_name='name', vendor_family='family', vendor_description='description')
+
+        snapshot = uploader.upload_snapshot(image, public_info)
+
+        assert snapshot.id == 'snap-0'
+        assert snapshot.driver is drivers['base']
+        stored = ebs_server.snapshots['snap-0']
+        assert stored['status'] == 'completed'
+        assert stored['request']['VolumeSize'] == 1
+        assert {t['Key']: t['Value'] for t in stored['request']['Tags']}['AMI'] == 'name'
+        # Blocks with only zeros are skipped, the last one is padded
+        assert sorted(stored['blocks']) == [0, 4, 5]
+        content = bytearray(6 * block_size)
+        for index, data in stored['blocks'].items():
+            content[index * block_size:(index + 1) * block_size] = data
+        assert content[:size] == raw.read_bytes()
+        assert not any(content[size:])
+
+    def test_upload_snapshot_failed(self, uploader, drivers, image, ebs_server, tmp_path, monkeypatch):
+        import functools
+        from unittest.mock import MagicMock
+        from debian_cloud_images.utils.libcloud.other.aws_ebs import EBSConnection
+
+        raw = tmp_path / 'disk.raw'
+        raw.write_bytes(b'a' * ebs_server.block_size * 2)
+        ebs_server.fail_blocks.add(1)
+
+        image.open_image.side_effect = lambda *formats: raw.open('rb', buffering=0)
+        uploader.ebs_cls = functools.partial(EBSConnection, host='127.0.0.1', port=ebs_server.port, secure=False)
+        monkeypatch.setattr(type(uploader), 'storage', MagicMock(region_name='base'))
+        public_info = MagicMock(vendor_name='name', vendor_family='family', vendor_description='description')
+
+        with pytest.raises(Exception):
+            uploader.upload_snapshot(image, public_info)
+
+        assert ebs_server.snapshots['snap-0']['status'] == 'pending'
+        snapshot = drivers['base'].destroy_volume_snapshot.call_args.args[0]
+        assert snapshot.id == 'snap-0'
+
+    def test_upload_images(self, uploader, drivers, monkeypatch):
+        import types
+        from unittest.mock import MagicMock
+        from debian_cloud_images.utils.libcloud.compute.ec2 import ExEC2ImportSnapshotTask, ExEC2ImportSnapshotWaiter
+
+        class Waiter(ExEC2ImportSnapshotWaiter):
+            interval_min = 0.05
+
+        base = drivers['base']
+        calls = []
+
+        def list_tasks(ids):
+            ids = sorted(ids)
+            calls.append(ids)
+            if len(calls) == 1:
+                return [ExEC2ImportSnapshotTask(i, base, 'active') for i in ids]
+            return [
+                ExEC2ImportSnapshotTask(i, base, 'completed', snapshot_id=i.replace('import', 'snap'))
+                if i != 'import-broken' else
+                ExEC2ImportSnapshotTask(i, base, 'deleted', extra={'status_message': 'failed'})
+                for i in ids
+            ]
+
+        base.ex_start_import_snapshot.side_effect = lambda description, disk_container: ExEC2ImportSnapshotTask(
+            'import-{}'.format(disk_container[0]['UserBucket']['S3Key'].split('.')[0]), base, 'active',
+        )
+        base.ex_list_import_snapshot_tasks.side_effect = list_tasks
+        uploader.import_waiter_cls = Waiter
+        uploader.regions = ['base']
+        uploader.upload_file = lambda image, name: types.SimpleNamespace(name=f'{name}.vmdk', driver=base)
+        uploader.delete_file = MagicMock()
+
+        images = []
+        for name in ('amd64', 'arm64', 'broken'):
+            image = MagicMock(build_arch='amd64', build_info={'version': '1'})
+            images.append((image, MagicMock(vendor_name=name, vendor_family='family', vendor_description='description')))
+
+        with pytest.raises(RuntimeError, match='Upload failed for images: broken'):
+            uploader.upload_images(images)
+
+        # All imports are started up front and checked together
+        assert ['import-amd64', 'import-arm64', 'import-broken'] in calls
+        registered = sorted(c.kwargs['block_device_mapping'][0]['Ebs']['SnapshotId'] for c in base.ex_register_image.call_args_list)
+        assert registered == ['snap-amd64', 'snap-arm64']
+        for image, public_info in images[:2]:
+            image.write_manifests.assert_called_once()
+        images[2][0].write_manifests.assert_not_called()
+        assert sorted(c.args[1].name for c in uploader.delete_file.call_args_list) == ['amd64.vmdk', 'arm64.vmdk', 'broken.vmdk']
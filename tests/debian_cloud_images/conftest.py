@@ -0,0 +1,178 @@
+import base64
+import hashlib
+import http.server
+import json
+import pytest
+import re
+import threading
+import urllib.parse
+
+
+class EbsStandIn(http.server.BaseHTTPRequestHandler):
+    """ Local stand-in for the EBS direct APIs, keeping snapshots in memory """
+
+    block_size = 512 * 1024
+    snapshots = {}
+    fail_blocks = set()
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=None, headers={}):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_POST(self):
+        assert self.headers['Authorization'].startswith('AWS4-HMAC-SHA256 ')
+        body = self.read_body()
+        if self.path == '/snapshots':
+            request = json.loads(body)
+            snapshot_id = 'snap-{}'.format(len(self.snapshots))
+            self.snapshots[snapshot_id] = {'request': request, 'blocks': {}, 'status': 'pending'}
+            self.reply(201, {'SnapshotId': snapshot_id, 'BlockSize': self.block_size, 'Status': 'pending', 'VolumeSize': request['VolumeSize']})
+            return
+
+        m = re.match(r'^/snapshots/completion/([^/?]+)', self.path)
+        snapshot = self.snapshots[m.group(1)]
+        assert int(self.headers['x-amz-ChangedBlocksCount']) == len(snapshot['blocks'])
+        h = hashlib.sha256()
+        for index in sorted(snapshot['blocks']):
+            h.update(hashlib.sha256(snapshot['blocks'][index]).digest())
+        if self.headers['x-amz-Checksum'] != base64.b64encode(h.digest()).decode():
+            self.reply(400, {'Message': 'checksum mismatch'}, {'x-amzn-ErrorType': 'ValidationException'})
+            return
+        snapshot['status'] = 'completed'
+        self.reply(202, {'Status': 'completed'})
+
+    def do_PUT(self):
+        m = re.match(r'^/snapshots/([^/]+)/blocks/(\d+)', self.path)
+        snapshot = self.snapshots[m.group(1)]
+        data = self.read_body()
+        if int(m.group(2)) in self.fail_blocks:
+            self.reply(400, {'Message': 'failed'}, {'x-amzn-ErrorType': 'ValidationException'})
+            return
+        checksum = base64.b64encode(hashlib.sha256(data).digest()).decode()
+        if len(data) != self.block_size or int(self.headers['x-amz-Data-Length']) != len(data) or self.headers['x-amz-Checksum'] != checksum:
+            self.reply(400, {'Message': 'invalid block'}, {'x-amzn-ErrorType': 'ValidationException'})
+            return
+        snapshot['blocks'][int(m.group(2))] = data
+        self.reply(201, headers={'x-amz-Checksum': checksum, 'x-amz-Checksum-Algorithm': 'SHA256'})
+
+
+@pytest.fixture
+def ebs_server():
+    """ Run stand-in for EBS direct APIs, returns handler class with port set """
+    handler = type('EbsStandIn', (EbsStandIn, ), {'snapshots': {}, 'fail_blocks': set()})
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    handler.port = server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield handler
+    server.shutdown()
+    server.server_close()
+
+
+class S3StandIn(http.server.BaseHTTPRequestHandler):
+    """ Local stand-in for S3 multipart uploads of a single bucket, keeping objects in memory """
+
+    namespace = 'http://s3.amazonaws.com/doc/2006-03-01/'
+    objects = {}
+    uploads = {}
+    requests = []
+    fail_parts = set()
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=None, headers={}):
+        data = body.encode() if body is not None else b''
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def reply_xml(self, root, content):
+        self.reply(200, f'<?xml version="1.0" encoding="UTF-8"?><{root} xmlns="{self.namespace}">{content}</{root}>')
+
+    def parse(self):
+        assert self.headers['Authorization'].startswith('AWS4-HMAC-SHA256 ')
+        url = urllib.parse.urlsplit(self.path)
+        params = {k: v[0] for k, v in urllib.parse.parse_qs(url.query, keep_blank_values=True).items()}
+        self.requests.append((self.command, url.path, params.get('partNumber')))
+        return urllib.parse.unquote(url.path[1:]), params
+
+    def do_GET(self):
+        key, params = self.parse()
+        if 'uploads' in params:
+            self.reply_xml('ListMultipartUploadsResult', ''.join(
+                f'<Upload><Key>{u["key"]}</Key><UploadId>{i}</UploadId><Initiated>{u["initiated"]}</Initiated>'
+                '<Initiator><DisplayName>test</DisplayName></Initiator><Owner><DisplayName>test</DisplayName></Owner></Upload>'
+                for i, u in self.uploads.items() if u['key'].startswith(params.get('prefix', ''))
+            ) + '<IsTruncated>false</IsTruncated>')
+            return
+
+        # List parts, two per response to check paging
+        parts = self.uploads[params['uploadId']]['parts']
+        numbers = [n for n in sorted(parts) if n > int(params.get('part-number-marker', 0))]
+        self.reply_xml('ListPartsResult', ''.join(
+            f'<Part><PartNumber>{n}</PartNumber><ETag>"{hashlib.md5(parts[n]).hexdigest()}"</ETag><Size>{len(parts[n])}</Size></Part>'
+            for n in numbers[:2]
+        ) + '<IsTruncated>{}</IsTruncated><NextPartNumberMarker>{}</NextPartNumberMarker>'.format(
+            'true' if len(numbers) > 2 else 'false', numbers[1] if len(numbers) > 2 else 0,
+        ))
+
+    def do_POST(self):
+        key, params = self.parse()
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if 'uploads' in params:
+            upload_id = 'upload-{}'.format(len(self.uploads) + len(self.objects))
+            self.uploads[upload_id] = {'key': key, 'parts': {}, 'initiated': '2024-01-01T00:00:00.000Z'}
+            self.reply_xml('InitiateMultipartUploadResult', f'<Key>{key}</Key><UploadId>{upload_id}</UploadId>')
+            return
+
+        upload = self.uploads.pop(params['uploadId'])
+        numbers = [int(n) for n in re.findall(r'<PartNumber>(\d+)</PartNumber>', body.decode())]
+        assert numbers == list(range(1, len(numbers) + 1))
+        self.objects[key] = b''.join(upload['parts'][n] for n in numbers)
+        self.reply_xml('CompleteMultipartUploadResult', f'<Key>{key}</Key><ETag>"etag-{len(numbers)}"</ETag>')
+
+    def do_PUT(self):
+        key, params = self.parse()
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        number = int(params['partNumber'])
+        if number in self.fail_parts:
+            self.reply(500, '<Error><Code>InternalError</Code><Message>failed</Message></Error>')
+            return
+        if self.headers['Content-MD5'] != base64.b64encode(hashlib.md5(data).digest()).decode():
+            self.reply(400, '<Error><Code>BadDigest</Code><Message>checksum mismatch</Message></Error>')
+            return
+        self.uploads[params['uploadId']]['parts'][number] = data
+        self.reply(200, headers={'ETag': '"{}"'.format(hashlib.md5(data).hexdigest())})
+
+    def do_DELETE(self):
+        key, params = self.parse()
+        del self.uploads[params['uploadId']]
+        self.reply(204)
+
+
+@pytest.fixture
+def s3_server():
+    """ Run stand-in for S3, returns handler class with port set """
+    handler = type('S3StandIn', (S3StandIn, ), {'objects': {}, 'uploads': {}, 'requests': [], 'fail_parts': set()})
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    handler.port = server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield handler
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,68 @@
+import json
+
+from debian_cloud_images.images import Image
+from debian_cloud_images.images.publicinfo import ImagePublicInfo, ImagePublicType
+from debian_cloud_images.images.reference import ReferenceBuilds
+
+
+def write_build(path, version, packages):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open('w') as f:
+        json.dump({'apiVersion': 'v1', 'kind': 'List', 'items': [{
+            'apiVersion': 'cloud.debian.org/v1alpha1',
+            'kind': 'Build',
+            'metadata': {},
+            'data': {
+                'info': {
+                    'arch': 'amd64',
+                    'release': 'sid',
+                    'release_id': 'sid',
+                    'vendor': 'ec2',
+                    'version': version,
+                    'build_id': 'test',
+                },
+                'packages': [
+                    {'name': name, 'version': v, 'source_name': name, 'source_version': v}
+                    for name, v in packages
+                ],
+            },
+        }]}, f)
+
+
+def image(tmp_path, packages):
+    write_build(tmp_path / 'new' / 'test.build.json', '2', packages)
+    ret = Image('test', tmp_path / 'new')
+    ret.read_manifests(tmp_path / 'new' / 'test.build.json')
+    return ret
+
+
+class TestReferenceBuilds:
+    def test_manifest(self, tmp_path):
+        write_build(tmp_path / 'ref.json', '1', [('a', '1'), ('b', '1')])
+        references = ReferenceBuilds([tmp_path / 'ref.json'], ImagePublicType.dev)
+        public_info = ImagePublicInfo(public_type=ImagePublicType.dev).apply
+
+        i = image(tmp_path, [('b', '1'), ('a', '1')])
+        assert references.unchanged(i, public_info(i.build_info)).info['version'] == '1'
+
+        i = image(tmp_path, [('b', '2'), ('a', '1')])
+        assert references.unchanged(i, public_info(i.build_info)) is None
+
+    def test_manifest_same_version(self, tmp_path):
+        write_build(tmp_path / 'ref.json', '2', [('a', '1')])
+        references = ReferenceBuilds([tmp_path / 'ref.json'], ImagePublicType.dev)
+
+        i = image(tmp_path, [('a', '1')])
+        assert references.unchanged(i, ImagePublicInfo().apply(i.build_info)) is None
+
+    def test_storage(self, tmp_path):
+        storage = tmp_path / 'storage'
+        write_build(storage / 'sid' / 'daily' / 'latest' / 'debian-sid-ec2-amd64-daily.json', '1', [('a', '1')])
+        references = ReferenceBuilds([storage], ImagePublicType.daily)
+        public_info = ImagePublicInfo(public_type=ImagePublicType.daily).apply
+
+        i = image(tmp_path, [('a', '1')])
+        assert references.unchanged(i, public_info(i.build_info)).info['version'] == '1'
+
+        references = ReferenceBuilds([storage], ImagePublicType.release)
+        assert references.unchanged(i, public_info(i.build_info)) is None
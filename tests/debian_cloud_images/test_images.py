@@ -5,9 +5,11 @@ import pathlib
 import pkg_resources
 import pytest
 import shutil
+import subprocess
 import tarfile
 
-from debian_cloud_images.images import Images, Image
+from debian_cloud_images.images import ConvertTuning, Images, Image
+from debian_cloud_images.utils.cache import FileCache
 
 
 if pkg_resources.parse_version(pytest.__version__) < pkg_resources.parse_version('3.9'):
@@ -106,13 +108,135 @@ def test_Image_open_image(images_path_tar):
     with image.open_image('qcow2') as f:
         assert f.read(8) == b'QFI\xfb\0\0\0\3'
 
+    with image.open_image('vmdk') as f:
+        assert f.read(8) == b'KDMV\3\0\0\0'
+
+
+def test_Image_open_image_vhd(images_path_tar):
+    images = Images()
+    images.read(images_path_tar / 'test.build.json')
+    image = images['test']
+
     with image.open_image('vhd') as f:
         assert f.read(8) == b'1' * 8
+        assert f.seek(0, os.SEEK_END) == 1024 * 1024 + 512
         f.seek(-512, os.SEEK_END)
         assert f.read(16) == b'conectix\0\0\0\2\0\1\0\0'
 
-    with image.open_image('vmdk') as f:
-        assert f.read(8) == b'KDMV\3\0\0\0'
+
+def test_Image_open_image_parallel(images_path_tar, monkeypatch):
+    calls = []
+
+    def check_call(cmd):
+        calls.append(cmd)
+        with open(cmd[-1], 'wb') as f:
+            f.write(cmd[cmd.index('-O') + 1].encode())
+
+    from debian_cloud_images import images as images_module
+    monkeypatch.setattr(images_module.subprocess, 'check_call', check_call)
+
+    images = Images(convert_tuning=ConvertTuning(workers=2, coroutines=8, unordered=True))
+    images.read(images_path_tar / 'test.build.json')
+    image = images['test']
+
+    with image.open_image('qcow2', None, 'vmdk') as (f_qcow2, f_raw, f_vmdk):
+        assert f_qcow2.read() == b'qcow2'
+        assert f_raw.read(8) == b'1' * 8
+        assert f_vmdk.read() == b'vmdk'
+
+    assert len(calls) == 2
+    for cmd in calls:
+        assert cmd[:7] == ('qemu-img', 'convert', '-f', 'raw', '-m', '8', '-W')
+
+
+def test_Image_open_image_parallel_error(images_path_tar, monkeypatch):
+    opened = []
+
+    def check_call(cmd):
+        if '-O' in cmd and cmd[cmd.index('-O') + 1] == 'vmdk':
+            raise subprocess.CalledProcessError(1, cmd)
+        with open(cmd[-1], 'wb') as f:
+            f.write(b'converted')
+
+    def open_converted(self, *args, _open_converted=Image._open_converted):
+        f = _open_converted(self, *args)
+        opened.append(f)
+        return f
+
+    from debian_cloud_images import images as images_module
+    monkeypatch.setattr(images_module.subprocess, 'check_call', check_call)
+    monkeypatch.setattr(Image, '_open_converted', open_converted)
+
+    images = Images(convert_tuning=ConvertTuning(workers=2))
+    images.read(images_path_tar / 'test.build.json')
+    image = images['test']
+
+    with pytest.raises(subprocess.CalledProcessError):
+        with image.open_image('vmdk', 'qcow2'):
+            pass
+
+    # The successful conversion is closed again
+    assert len(opened) == 1
+    assert opened[0].closed
+
+
+def test_Image_open_image_raw(images_path_tar):
+    images = Images()
+    images.read(images_path_tar / 'test.build.json')
+    image = images['test']
+
+    with image.open_image(None) as f:
+        assert f.seek(0, os.SEEK_END) == 1024 * 1024
+        f.seek(0)
+        assert f.read() == b'1' * 1024 * 1024
+
+
+def test_Image_open_image_raw_xz(images_path_tar_xz):
+    images = Images()
+    images.read(images_path_tar_xz / 'test.build.json')
+    image = images['test']
+
+    assert image.open_image_raw() is None
+
+    with image.open_image(None) as f:
+        assert f.read() == b'1' * 1024 * 1024
+
+
+def test_Image_open_cached(images_path, tmp_path_factory):
+    def create(name):
+        with open(name, 'wb') as f:
+            f.write(b'converted')
+
+    images = Images()
+    images.read(images_path / 'test.build.json')
+    assert images['test'].open_cached(('format', ), create) is None
+
+    cache = FileCache(tmp_path_factory.mktemp('cache'))
+    images = Images(cache=cache)
+    images.read(images_path / 'test.build.json')
+    image = images['test']
+
+    # No digest, no caching
+    assert image.open_cached(('format', ), create) is None
+
+    image.build.metadata.annotations['cloud.debian.org/digest'] = 'sha512:digest'
+    with image.open_cached(('format', ), create) as f:
+        assert f.read() == b'converted'
+    with image.open_cached(('format', ), create) as f:
+        assert f.read() == b'converted'
+    assert cache.stats() == {'hits': 1, 'misses': 1}
+
+
+@pytest.mark.skipif(shutil.which('xz') is None, reason='Need available xz')
+def test_Image_open_image_raw_xz_blocks(images_path_tar):
+    subprocess.check_call(('xz', '--block-size=64KiB', (images_path_tar / 'test.tar').as_posix()))
+
+    images = Images()
+    images.read(images_path_tar / 'test.build.json')
+    image = images['test']
+
+    with image.open_image_raw() as f:
+        assert f.read() == b'1' * 1024 * 1024
 
 
 def test_Image_open_tar(images_path_tar):
@@ -0,0 +1,218 @@
+import pytest
+import threading
+
+from unittest.mock import MagicMock
+
+from libcloud.compute.base import VolumeSnapshot
+from libcloud.compute.types import VolumeSnapshotState
+
+from debian_cloud_images.utils.libcloud.compute.ec2 import (
+    ExEC2ImportSnapshotTask,
+    ExEC2ImportSnapshotWaiter,
+    ExEC2NodeDriver,
+    ExEC2SnapshotWaiter,
+)
+from libcloud.utils.py3 import ET
+
+
+class TestExEC2NodeDriver:
+    def test__get_tag_specification_params(self):
+        assert ExEC2NodeDriver._get_tag_specification_params('image', {'Name': 'name', 'AMI': 'ami'}) == {
+            'TagSpecification.1.ResourceType': 'image',
+            'TagSpecification.1.Tag.1.Key': 'Name',
+            'TagSpecification.1.Tag.1.Value': 'name',
+            'TagSpecification.1.Tag.2.Key': 'AMI',
+            'TagSpecification.1.Tag.2.Value': 'ami',
+        }
+
+    def test_ex_register_image(self):
+        driver = ExEC2NodeDriver('key', 'secret', region='region')
+        driver.connection = MagicMock()
+        driver._to_image = MagicMock()
+
+        driver.ex_register_image(
+            'name',
+            architecture='arm64',
+            kernel_id='aki-1',
+            billing_products=['bp-1'],
+            boot_mode='uefi',
+            imds_support='v2.0',
+            tags={'Name': 'name'},
+        )
+
+        assert driver.connection.request.call_args.kwargs['params'] == {
+            'Action': 'RegisterImage',
+            'Name': 'name',
+            'Architecture': 'arm64',
+            'KernelId': 'aki-1',
+            'BootMode': 'uefi',
+            'ImdsSupport': 'v2.0',
+            'BillingProduct.1': 'bp-1',
+            'TagSpecification.1.ResourceType': 'image',
+            'TagSpecification.1.Tag.1.Key': 'Name',
+            'TagSpecification.1.Tag.1.Value': 'name',
+        }
+
+    def test__to_import_snapshot_tasks(self):
+        response = ET.fromstring('''
+            <DescribeImportSnapshotTasksResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">
+              <importSnapshotTaskSet>
+                <item>
+                  <importTaskId>import-snap-1</importTaskId>
+                  <snapshotTaskDetail><status>completed</status><snapshotId>snap-1</snapshotId></snapshotTaskDetail>
+                </item>
+                <item>
+                  <importTaskId>import-snap-2</importTaskId>
+                  <snapshotTaskDetail><status>active</status><progress>42</progress></snapshotTaskDetail>
+                </item>
+              </importSnapshotTaskSet>
+            </DescribeImportSnapshotTasksResponse>
+        ''')
+        driver = ExEC2NodeDriver('key', 'secret', region='region')
+
+        tasks = driver._to_import_snapshot_tasks(response, 'importSnapshotTaskSet/item')
+
+        assert [(t.id, t.status, t.snapshot_id, t.extra['progress']) for t in tasks] == [
+            ('import-snap-1', 'completed', 'snap-1', None),
+            ('import-snap-2', 'active', None, '42'),
+        ]
+        assert tasks[0].snapshot.id == 'snap-1'
+        assert tasks[0].snapshot.driver is driver
+        assert tasks[1].snapshot is None
+
+
+class FakeRegion:
+    """ Region with snapshots becoming available after a number of polls, reporting progress """
+
+    def __init__(self, name, polls):
+        self.region_name = name
+        self.polls = polls
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def ex_list_snapshots(self, ids):
+        ids = sorted(ids)
+        with self.lock:
+            self.calls.append(ids)
+            n = len(self.calls)
+        if n == 1:
+            raise RuntimeError('InvalidSnapshot.NotFound')
+        ret = []
+        for i in ids:
+            if n > self.polls[i]:
+                ret.append(VolumeSnapshot(i, self, state=VolumeSnapshotState.AVAILABLE, extra={'progress': '100%'}))
+            else:
+                ret.append(VolumeSnapshot(i, self, state=VolumeSnapshotState.CREATING, extra={'progress': f'{n * 10}%'}))
+        return ret
+
+
+class TestExEC2SnapshotWaiter:
+    def test_batched(self):
+        fast = FakeRegion('fast', {'snap-1': 1, 'snap-2': 2})
+        slow = FakeRegion('slow', {'snap-3': 4})
+        available = []
+        failed = MagicMock()
+
+        with ExEC2SnapshotWaiter(interval_min=0.001, interval_max=0.01) as waiter:
+            for region, snapshot_id in ((fast, 'snap-1'), (fast, 'snap-2'), (slow, 'snap-3')):
+                waiter.add(VolumeSnapshot(snapshot_id, region), lambda s: available.append((s.driver.region_name, s.id)), failed)
+
+        assert sorted(available) == [('fast', 'snap-1'), ('fast', 'snap-2'), ('slow', 'snap-3')]
+        failed.assert_not_called()
+        # One request per region and round, completed snapshots are not requested again
+        assert fast.calls == [['snap-1', 'snap-2'], ['snap-1', 'snap-2'], ['snap-2']]
+        assert slow.calls == [['snap-3']] * 5
+        assert waiter.requests == 8
+
+    def test_failed(self):
+        region = MagicMock(region_name='region')
+        region.ex_list_snapshots.side_effect = lambda ids: [
+            VolumeSnapshot(i, region, state=VolumeSnapshotState.ERROR, extra={'state': 'error'}) for i in ids
+        ]
+        available = MagicMock()
+        failed = MagicMock()
+
+        with ExEC2SnapshotWaiter(interval_min=0.001) as waiter:
+            waiter.add(VolumeSnapshot('snap-1', region), available, failed)
+
+        available.assert_not_called()
+        snapshot, error = failed.call_args.args
+        assert snapshot.id == 'snap-1'
+        assert 'state error' in str(error)
+
+    def test_failed_missing(self):
+        region = MagicMock(region_name='region')
+        region.ex_list_snapshots.side_effect = RuntimeError('RequestLimitExceeded')
+        failed = MagicMock()
+
+        with ExEC2SnapshotWaiter(interval_min=0.001, interval_max=0.001, missing_max=3) as waiter:
+            waiter.add(VolumeSnapshot('snap-1', region), MagicMock(), failed)
+
+        assert region.ex_list_snapshots.call_count == 3
+        snapshot, error = failed.call_args.args
+        assert snapshot.id == 'snap-1'
+        assert 'RequestLimitExceeded' in str(error)
+
+    def test_failed_timeout(self):
+        region = MagicMock(region_name='region')
+        region.ex_list_snapshots.side_effect = lambda ids: [
+            VolumeSnapshot(i, region, state=VolumeSnapshotState.CREATING, extra={'progress': '0%'}) for i in ids
+        ]
+        failed = MagicMock()
+
+        with ExEC2SnapshotWaiter(interval_min=0.001, interval_max=0.001, timeout=0.05) as waiter:
+            waiter.add(VolumeSnapshot('snap-1', region), MagicMock(), failed)
+
+        snapshot, error = failed.call_args.args
+        assert snapshot.id == 'snap-1'
+        assert isinstance(error, TimeoutError)
+
+    @pytest.mark.parametrize('progress, expected', (
+        (['10%', '20%'], 8.0),
+        (['10%', '10%'], None),
+        (['', '20%'], None),
+    ))
+    def test_estimate(self, progress, expected):
+        p = ExEC2SnapshotWaiter.Pending(None, None, None, 0)
+        for now, value in enumerate(progress):
+            estimate = ExEC2SnapshotWaiter.estimate(p, VolumeSnapshot('snap', None, extra={'progress': value}), now)
+        assert estimate == expected
+
+
+class TestExEC2ImportSnapshotWaiter:
+    def test_batched(self):
+        region = MagicMock(region_name='region')
+        calls = []
+
+        def list_tasks(ids):
+            ids = sorted(ids)
+            calls.append(ids)
+            if len(calls) < 3:
+                return [ExEC2ImportSnapshotTask(i, region, 'active', extra={'progress': str(len(calls) * 40)}) for i in ids]
+            return [
+                ExEC2ImportSnapshotTask('import-1', region, 'completed', snapshot_id='snap-1'),
+                ExEC2ImportSnapshotTask('import-2', region, 'deleted', extra={'status_message': 'ClientError: Disk validation failed'}),
+            ]
+
+        region.ex_list_import_snapshot_tasks.side_effect = list_tasks
+        available = []
+        failed = []
+
+        with ExEC2ImportSnapshotWaiter(interval_min=0.001, interval_max=0.01) as waiter:
+            waiter.add(ExEC2ImportSnapshotTask('import-1', region, 'active'), available.append, lambda t, e: failed.append((t.id, str(e))))
+            waiter.add(ExEC2ImportSnapshotTask('import-2', region, 'active'), available.append, lambda t, e: failed.append((t.id, str(e))))
+
+        assert [s.id for s in available] == ['snap-1']
+        assert available[0].driver is region
+        assert failed == [('import-2', 'Import region/import-2 in state deleted: ClientError: Disk validation failed')]
+        assert calls[-1] == ['import-1', 'import-2']
+
+    def test_missing(self):
+        region = MagicMock(region_name='region')
+        region.ex_list_import_snapshot_tasks.return_value = []
+        failed = []
+
+        with ExEC2ImportSnapshotWaiter(interval_min=0.001, interval_max=0.001, missing_max=2) as waiter:
+            waiter.add(ExEC2ImportSnapshotTask('import-1', region, 'active'), MagicMock(), lambda t, e: failed.append((t.id, str(e))))
+
+        assert failed == [('import-1', 'region/import-1 not found in 2 requests for import snapshot tasks: missing from response')]
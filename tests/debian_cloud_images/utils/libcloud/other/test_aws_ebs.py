@@ -0,0 +1,36 @@
+import pytest
+
+from libcloud.common.exceptions import BaseHTTPError
+
+from debian_cloud_images.utils.libcloud.other.aws_ebs import EBSConnection, ebs_checksum, ebs_checksum_linear
+
+
+@pytest.fixture
+def connection(ebs_server):
+    return EBSConnection('key', 'secret', 'region', host='127.0.0.1', port=ebs_server.port, secure=False)
+
+
+class TestEBSConnection:
+    def test_snapshot(self, ebs_server, connection):
+        block = b'1' * ebs_server.block_size
+
+        snapshot = connection.start_snapshot(8, description='description', tags={'Name': 'name'})
+        snapshot_id = snapshot['SnapshotId']
+        assert snapshot['BlockSize'] == ebs_server.block_size
+
+        checksums = [connection.put_snapshot_block(snapshot_id, i, block) for i in (3, 7)]
+        assert checksums == [ebs_checksum(block)] * 2
+        connection.complete_snapshot(snapshot_id, 2, ebs_checksum_linear(checksums))
+
+        stored = ebs_server.snapshots[snapshot_id]
+        assert stored['status'] == 'completed'
+        assert stored['request'] == {'VolumeSize': 8, 'Description': 'description', 'Tags': [{'Key': 'Name', 'Value': 'name'}]}
+        assert sorted(stored['blocks']) == [3, 7]
+
+    def test_checksum_mismatch(self, ebs_server, connection):
+        snapshot_id = connection.start_snapshot(1)['SnapshotId']
+        connection.put_snapshot_block(snapshot_id, 0, b'1' * ebs_server.block_size)
+
+        with pytest.raises(BaseHTTPError) as e:
+            connection.complete_snapshot(snapshot_id, 1, ebs_checksum(b''))
+        assert 'ValidationException: checksum mismatch' in str(e.value)
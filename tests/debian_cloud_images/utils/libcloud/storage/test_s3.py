@@ -0,0 +1,80 @@
+import os
+import pytest
+
+from libcloud.common.types import LibcloudError
+
+from debian_cloud_images.utils.libcloud.storage.s3 import S3BucketStorageDriver, read_parts
+
+
+class LocalS3BucketStorageDriver(S3BucketStorageDriver):
+    def _get_host_region(self, bucket):
+        return '127.0.0.1', 'region'
+
+
+@pytest.fixture
+def driver(s3_server):
+    return LocalS3BucketStorageDriver('bucket', 'key', 'secret', secure=False, port=s3_server.port)
+
+
+def chunks(data, size=10000):
+    return iter([data[i:i + size] for i in range(0, len(data), size)])
+
+
+def test_read_parts():
+    assert list(read_parts(iter([]), 4)) == []
+    assert list(read_parts(iter([b'abc', b'', b'defghi', b'j']), 4)) == [b'abcd', b'efgh', b'ij']
+    assert list(read_parts(iter([b'abcdefgh']), 4)) == [b'abcd', b'efgh']
+
+
+class TestS3BucketStorageDriver:
+    part_size = 64 * 1024
+
+    def test_upload_parallel(self, s3_server, driver):
+        data = os.urandom(self.part_size * 5 + 1000)
+
+        obj = driver.ex_upload_object_via_stream_parallel(chunks(data), 'image.vmdk', part_size=self.part_size, workers=3)
+
+        assert obj.name == 'image.vmdk'
+        assert obj.size == len(data)
+        assert obj.hash == '"etag-6"'
+        assert s3_server.objects == {'image.vmdk': data}
+        assert s3_server.uploads == {}
+        assert sorted(p for m, path, p in s3_server.requests if m == 'PUT') == ['1', '2', '3', '4', '5', '6']
+
+    def test_upload_parallel_resume(self, s3_server, driver):
+        data = os.urandom(self.part_size * 5 + 1000)
+
+        s3_server.fail_parts = {3}
+        with pytest.raises(LibcloudError):
+            driver.ex_upload_object_via_stream_parallel(chunks(data), 'image.vmdk', part_size=self.part_size, workers=2)
+
+        assert s3_server.objects == {}
+        upload, = s3_server.uploads.values()
+        assert 3 not in upload['parts']
+        uploaded = set(upload['parts'])
+
+        # Another unrelated upload with the same prefix is left alone
+        driver._initiate_multipart(None, 'image.vmdk.other')
+
+        s3_server.fail_parts = set()
+        s3_server.requests.clear()
+        obj = driver.ex_upload_object_via_stream_parallel(chunks(data), 'image.vmdk', part_size=self.part_size, workers=2)
+
+        assert obj.size == len(data)
+        assert s3_server.objects == {'image.vmdk': data}
+        assert [u['key'] for u in s3_server.uploads.values()] == ['image.vmdk.other']
+        sent = {int(p) for m, path, p in s3_server.requests if m == 'PUT'}
+        assert sent == set(range(1, 7)) - uploaded
+
+    def test_upload_parallel_abort(self, s3_server, driver):
+        data = os.urandom(self.part_size * 5 + 1000)
+
+        # Unfinished uploads are neither resumed nor kept without resume
+        driver._initiate_multipart(None, 'image.vmdk')
+        s3_server.fail_parts = {3}
+        with pytest.raises(LibcloudError):
+            driver.ex_upload_object_via_stream_parallel(chunks(data), 'image.vmdk', part_size=self.part_size, workers=2, resume=False)
+
+        assert s3_server.objects == {}
+        assert list(s3_server.uploads) == ['upload-0']
+        assert ('DELETE', '/image.vmdk', None) in s3_server.requests
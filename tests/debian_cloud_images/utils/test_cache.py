@@ -0,0 +1,116 @@
+import os
+import pytest
+
+from debian_cloud_images.utils.cache import FileCache, parse_size
+
+
+def test_parse_size():
+    assert parse_size(23) == 23
+    assert parse_size('23') == 23
+    assert parse_size('2K') == 2 * 1024
+    assert parse_size('30G') == 30 * 1024 ** 3
+    assert parse_size('1TiB') == 1024 ** 4
+
+    with pytest.raises(ValueError):
+        parse_size('G')
+
+
+class TestFileCache:
+    def test_open(self, tmp_path):
+        cache = FileCache(tmp_path)
+        key = cache.key('digest', 'format')
+        created = []
+
+        def create(name):
+            created.append(name)
+            with open(name, 'wb') as f:
+                f.write(b'content')
+
+        with cache.open(key, create) as f:
+            assert f.read() == b'content'
+        with cache.open(key, create) as f:
+            assert f.read() == b'content'
+
+        assert len(created) == 1
+        assert cache.stats() == {'hits': 1, 'misses': 1}
+
+    def test_open_fail(self, tmp_path):
+        cache = FileCache(tmp_path)
+        key = cache.key('digest')
+
+        def create(name):
+            raise RuntimeError
+
+        with pytest.raises(RuntimeError):
+            cache.open(key, create)
+
+        assert not [i for i in (tmp_path / key[:2]).iterdir() if not i.name.endswith('.lock')]
+
+    def test_evict(self, tmp_path):
+        cache = FileCache(tmp_path, max_size=3 * 4096)
+        keys = [cache.key(str(i)) for i in range(4)]
+
+        def create(name):
+            with open(name, 'wb') as f:
+                f.write(b'1' * 4096)
+
+        for i, key in enumerate(keys):
+            cache.open(key, create).close()
+            path = tmp_path / key[:2] / key
+            os.utime(path, (i, i))
+
+        # Use first entry again, so it is the most recently used one
+        cache.open(keys[0], create).close()
+        cache.evict()
+
+        remaining = {i.name for i in tmp_path.glob('??/*') if not i.name.startswith('.')}
+        assert keys[0] in remaining
+        assert keys[1] not in remaining
+        assert keys[3] in remaining
+        # Lock files of evicted entries are removed as well
+        locks = {i.name[1:-5] for i in tmp_path.glob('??/.*.lock')}
+        assert locks == remaining
+
+    def test_evict_scans(self, tmp_path, monkeypatch):
+        cache = FileCache(tmp_path, max_size=10 * 4096)
+        scans = []
+        evict = cache.evict
+        monkeypatch.setattr(cache, 'evict', lambda **kw: scans.append(1) or evict(**kw))
+
+        def create(name):
+            with open(name, 'wb') as f:
+                f.write(b'1' * 4096)
+
+        for i in range(20):
+            cache.open(cache.key(str(i)), create).close()
+
+        # Initial scan, then once the size exceeds max_size, evicting down to 90%
+        assert len(scans) < 20 // 2
+        assert len([i for i in tmp_path.glob('??/*') if not i.name.startswith('.')]) <= 10
+
+    def test_evict_stale_lock(self, tmp_path):
+        cache = FileCache(tmp_path, max_size=4096)
+        key = cache.key('failed')
+
+        def create(name):
+            raise RuntimeError
+
+        with pytest.raises(RuntimeError):
+            cache.open(key, create)
+        cache.evict()
+
+        assert not list(tmp_path.glob('??/.*.lock'))
+
+
+def test_FileCache_get(tmp_path):
+    cache = FileCache(tmp_path)
+    key = cache.key('digest')
+
+    assert cache.get(key) is None
+
+    with cache.open(key, lambda name: open(name, 'wb').close()):
+        pass
+    with cache.get(key) as f:
+        assert f.read() == b''
+
+    assert cache.stats() == {'hits': 1, 'misses': 1}
@@ -0,0 +1,44 @@
+import hashlib
+import io
+
+import pytest
+
+from debian_cloud_images.utils.digest import DigestPipeline, format_digest
+
+
+def test_format_digest():
+    assert format_digest(hashlib.sha256(b'')) == 'sha256:47DEQpj8HBSa+/TImW+5JCeuQeRkm5NMpJWZG3hSuFU'
+
+
+class TestDigestPipeline:
+    def test_readfrom(self):
+        data = bytes(range(256)) * 1000
+        out = io.BytesIO()
+
+        with DigestPipeline(lambda d, o: out.write(d), buffers=2, buffer_size=1000) as pipeline:
+            pipeline.readfrom(io.BytesIO(data))
+
+        assert out.getvalue() == data
+        assert pipeline.hashes['sha512'].digest() == hashlib.sha512(data).digest()
+        assert pipeline.hashes['sha256'].digest() == hashlib.sha256(data).digest()
+
+    def test_put(self):
+        writes = []
+
+        with DigestPipeline(lambda d, o: writes.append((bytes(d), o)), algorithms=('sha256', )) as pipeline:
+            pipeline.put(b'a', offset=10)
+            pipeline.put(b'\0', write=False)
+            buf = pipeline.get_buffer()
+            buf[:2] = b'bc'
+            pipeline.put_buffer(buf, 2, offset=20)
+
+        assert writes == [(b'a', 10), (b'bc', 20)]
+        assert pipeline.hashes['sha256'].digest() == hashlib.sha256(b'a\0bc').digest()
+
+    def test_error(self):
+        def write(d, o):
+            raise OSError('write failed')
+
+        with pytest.raises(OSError, match='write failed'):
+            with DigestPipeline(write, buffers=1, buffer_size=10) as pipeline:
+                pipeline.readfrom(io.BytesIO(bytes(100)))
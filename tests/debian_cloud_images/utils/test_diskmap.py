@@ -0,0 +1,174 @@
+import os
+import pytest
+import shutil
+import struct
+import subprocess
+import uuid
+import zlib
+
+from debian_cloud_images.build.sparse import RunSparse
+from debian_cloud_images.utils.diskmap import (
+    allocated_extents,
+    ext4_filesystems,
+    merge_extents,
+    partitions,
+    unallocated_extents,
+    _bitmap_extents,
+    _has_super,
+)
+
+
+check_no_e2fsprogs = any(shutil.which(i) is None for i in ('mkfs.ext4', 'debugfs', 'e2fsck'))
+skip_no_e2fsprogs = pytest.mark.skipif(check_no_e2fsprogs,
+                                       reason='Need available e2fsprogs')
+
+fs_offset = 1024 * 1024
+fs_size = 32 * 1024 * 1024
+disk_size = fs_offset + fs_size + 1024 * 1024
+stale = b'stale data!' * 372 + b'....'
+
+
+def write_mbr(f):
+    mbr = bytearray(512)
+    struct.pack_into('<4xB3xII', mbr, 446, 0x83, fs_offset // 512, fs_size // 512)
+    mbr[510:512] = b'\x55\xaa'
+    f.seek(0)
+    f.write(mbr)
+
+
+def write_gpt(f):
+    mbr = bytearray(512)
+    struct.pack_into('<4xB3xII', mbr, 446, 0xee, 1, disk_size // 512 - 1)
+    mbr[510:512] = b'\x55\xaa'
+
+    entries = bytearray(128 * 128)
+    struct.pack_into(
+        '<16s16sQQ', entries, 0,
+        uuid.UUID('0fc63daf-8483-4772-8e79-3d69d8477de4').bytes_le, uuid.uuid4().bytes_le,
+        fs_offset // 512, (fs_offset + fs_size) // 512 - 1,
+    )
+
+    header = bytearray(512)
+    struct.pack_into(
+        '<8sIIIIQQQQ16sQIII', header, 0,
+        b'EFI PART', 0x10000, 92, 0, 0, 1, disk_size // 512 - 1, 34, disk_size // 512 - 34,
+        uuid.uuid4().bytes_le, 2, 128, 128, zlib.crc32(entries),
+    )
+    struct.pack_into('<I', header, 16, zlib.crc32(header[:92]))
+
+    f.seek(0)
+    f.write(mbr + header + entries)
+
+
+@pytest.fixture
+def filesystem(tmp_path):
+    """ ext4 filesystem with several block groups, a file and stale data of a removed file """
+    fs = tmp_path / 'fs'
+    keep = tmp_path / 'keep'
+    gone = tmp_path / 'gone'
+    keep.write_bytes(os.urandom(100000))
+    gone.write_bytes(stale * 256)
+
+    with fs.open('wb') as f:
+        f.truncate(fs_size)
+    subprocess.run(('mkfs.ext4', '-q', '-F', '-b', '4096', '-g', '1024', fs.as_posix()), check=True)
+    for request in ('write {0}/keep keep', 'write {0}/gone gone', 'rm gone'):
+        subprocess.run(
+            ('debugfs', '-w', '-R', request.format(tmp_path), fs.as_posix()),
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+    assert stale in fs.read_bytes()
+    return fs
+
+
+def make_disk(tmp_path, filesystem, write_table):
+    disk = tmp_path / 'disk.raw'
+    with disk.open('wb') as f:
+        f.truncate(disk_size)
+        write_table(f)
+        f.seek(fs_offset)
+        f.write(filesystem.read_bytes())
+        f.seek(disk_size - 4096)
+        f.write(b'end' * 1024)
+    return disk
+
+
+def test_bitmap_extents():
+    assert list(_bitmap_extents(b'', 0)) == []
+    assert list(_bitmap_extents(b'\x00\x00', 16)) == []
+    assert list(_bitmap_extents(b'\xff\xff', 16)) == [(0, 16)]
+    assert list(_bitmap_extents(b'\xff\xff', 12)) == [(0, 12)]
+    assert list(_bitmap_extents(b'\x0e\x81', 16)) == [(1, 3), (8, 1), (15, 1)]
+
+
+def test_has_super():
+    assert [g for g in range(60) if _has_super(g, True)] == [0, 1, 3, 5, 7, 9, 25, 27, 49]
+    assert _has_super(2, False)
+
+
+def test_merge_extents():
+    assert merge_extents([(10, 5), (0, 5), (5, 2), (12, 1), (20, 1)]) == [(0, 7), (10, 5), (20, 1)]
+
+
+def test_partitions_none(tmp_path):
+    disk = tmp_path / 'disk.raw'
+    disk.write_bytes(bytes(disk_size))
+    with disk.open('rb') as f:
+        assert partitions(f) == []
+        assert ext4_filesystems(f, disk_size) == []
+        assert allocated_extents(f, disk_size) == [(0, disk_size)]
+        assert unallocated_extents(f, disk_size) == []
+
+
+@skip_no_e2fsprogs
+@pytest.mark.parametrize('write_table', (write_mbr, write_gpt))
+def test_allocated_extents(tmp_path, filesystem, write_table):
+    disk = make_disk(tmp_path, filesystem, write_table)
+    content = disk.read_bytes()
+
+    with disk.open('rb') as f:
+        assert [(p.offset, p.size) for p in partitions(f)] == [(fs_offset, fs_size)]
+        assert [(p.offset, p.size) for p in ext4_filesystems(f, disk_size)] == [(fs_offset, fs_size)]
+        allocated = allocated_extents(f, disk_size)
+        unallocated = unallocated_extents(f, disk_size)
+
+    assert allocated[0][0] == 0
+    assert allocated[-1] == (fs_offset + fs_size, disk_size - fs_offset - fs_size)
+    assert sum(s for o, s in allocated + unallocated) == disk_size
+
+    # Stale data is only found in unallocated blocks
+    allocated_content = b''.join(content[o:o + s] for o, s in allocated)
+    unallocated_content = b''.join(content[o:o + s] for o, s in unallocated)
+    assert stale not in allocated_content
+    assert stale in unallocated_content
+
+    # Compare with the number of free blocks reported by the filesystem
+    output = subprocess.run(
+        ('debugfs', '-R', 'stats', filesystem.as_posix()),
+        check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+    ).stdout
+    free = int(output.split('Free blocks:')[1].split()[0])
+    assert sum(s for o, s in unallocated) == free * 4096
+
+
+@skip_no_e2fsprogs
+def test_RunSparse_unallocated(tmp_path, filesystem):
+    disk = make_disk(tmp_path, filesystem, write_gpt)
+    content = disk.read_bytes()
+
+    RunSparse(filename=disk, unallocated=True)(True)
+
+    new = disk.read_bytes()
+    assert len(new) == len(content)
+    assert stale not in new
+    assert new[:fs_offset] == content[:fs_offset]
+    assert new[fs_offset + fs_size:] == content[fs_offset + fs_size:]
+
+    fs = tmp_path / 'fs.new'
+    fs.write_bytes(new[fs_offset:fs_offset + fs_size])
+    subprocess.run(('e2fsck', '-f', '-n', fs.as_posix()), check=True, stdout=subprocess.DEVNULL)
+    subprocess.run(
+        ('debugfs', '-R', f'dump keep {tmp_path}/keep.new', fs.as_posix()),
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    assert (tmp_path / 'keep.new').read_bytes() == (tmp_path / 'keep').read_bytes()
@@ -3,8 +3,16 @@ import errno
 import io
 import itertools
 import os
+import pytest
+import shutil
+import subprocess
 
-from debian_cloud_images.utils.files import ChunkedFile
+from debian_cloud_images.utils.files import ChunkedFile, ExtentFile, TarMemberFile, copy_sparse, data_extents, zero_runs
+
+
+check_no_tar = shutil.which('tar') is None
+skip_no_tar = pytest.mark.skipif(check_no_tar,
+                                 reason='Need available tar')
 
 
 class HoleFile(io.RawIOBase):
@@ -145,3 +153,187 @@ def test_ChunkedFile_2():
             assert chunk.offset == want_offset
             assert chunk.size == want_size
             assert len(chunk.read()) == want_size
+
+
+def test_ExtentFile():
+    backing = io.BytesIO(b'abcdefgh')
+    f = ExtentFile(12, [
+        ExtentFile.Extent(2, 3, backing, 0),
+        ExtentFile.Extent(5, 2, backing, 6),
+        ExtentFile.Extent(9, 0, backing, 0),
+        ExtentFile.Extent(10, 1, backing, 7),
+    ])
+
+    assert f.read() == b'\0\0abcgh\0\0\0h\0'
+    assert f.seek(3) == 3
+    assert f.read(3) == b'bcg'
+
+    assert f.seek(0, os.SEEK_DATA) == 2
+    assert f.seek(3, os.SEEK_DATA) == 3
+    assert f.seek(7, os.SEEK_DATA) == 10
+    with pytest.raises(OSError) as excinfo:
+        f.seek(11, os.SEEK_DATA)
+    assert excinfo.value.errno == errno.ENXIO
+
+    assert f.seek(0, os.SEEK_HOLE) == 0
+    assert f.seek(2, os.SEEK_HOLE) == 7
+    assert f.seek(10, os.SEEK_HOLE) == 11
+    with pytest.raises(OSError):
+        f.seek(12, os.SEEK_HOLE)
+
+
+def test_ExtentFile_ChunkedFile():
+    backing = io.BytesIO(b'abcd')
+    f = ExtentFile(8, [
+        ExtentFile.Extent(2, 4, backing, 0),
+    ])
+
+    result = [
+        (False, 0, 2),
+        (True, 2, 2),
+        (True, 4, 2),
+        (False, 6, 2),
+    ]
+
+    with ChunkedFile(f, 2) as chunked:
+        for chunk, (want_is_data, want_offset, want_size) in itertools.zip_longest(chunked, result):
+            assert chunk.is_data is want_is_data
+            assert chunk.offset == want_offset
+            assert chunk.size == want_size
+
+
+@skip_no_tar
+@pytest.mark.parametrize('tar_format', ['gnu', 'posix'])
+def test_TarMemberFile(tmp_path, tar_format):
+    mib = 1024 * 1024
+    input_filename = tmp_path / 'in'
+    output_filename = tmp_path / 'out.tar'
+
+    with input_filename.open('wb') as f:
+        f.write(b'1' * mib)
+        f.seek(4 * mib)
+        f.write(b'2' * mib)
+        f.truncate(8 * mib)
+
+    subprocess.check_call((
+        'tar',
+        '--create',
+        '--sparse',
+        '--format', tar_format,
+        '--file', output_filename.as_posix(),
+        '--directory', tmp_path.as_posix(),
+        'in',
+    ))
+
+    with TarMemberFile.open(output_filename.open('rb'), 'in') as f:
+        assert f.size == 8 * mib
+        assert f.read() == input_filename.read_bytes()
+
+        # Filesystems without hole support make the whole file one extent
+        if f.seek(0, os.SEEK_HOLE) != 8 * mib:
+            assert f.seek(0, os.SEEK_DATA) == 0
+            assert f.seek(0, os.SEEK_HOLE) == mib
+            assert f.seek(mib, os.SEEK_DATA) == 4 * mib
+            assert f.seek(4 * mib, os.SEEK_HOLE) == 5 * mib
+
+
+def test_ChunkedFile_zero():
+    backing = io.BytesIO(b'1' * 4 + b'\0' * 8 + b'1' * 2 + b'\0' * 6)
+    f = ExtentFile(24, [
+        ExtentFile.Extent(0, 20, backing, 0),
+    ])
+
+    result = [
+        (True, 0, 4),
+        (False, 4, 4),
+        (False, 8, 4),
+        (True, 12, 4),
+        (False, 16, 4),
+        (False, 20, 4),
+    ]
+
+    with ChunkedFile(f, 4, zero_block_size=4) as chunked:
+        assert chunked.extents == [(0, 20)]
+        assert chunked.data_size == 20
+
+        # Index is reused on further iterations
+        for i in range(2):
+            for chunk, (want_is_data, want_offset, want_size) in itertools.zip_longest(chunked, result):
+                assert chunk.is_data is want_is_data
+                assert chunk.offset == want_offset
+                assert chunk.size == want_size
+
+
+def test_ChunkedFile_zero_split():
+    data = b'1' * 2 + b'\0' * 8 + b'1' * 3 + b'\0' * 3
+    f = ExtentFile(16, [ExtentFile.Extent(0, 16, io.BytesIO(data), 0)])
+    reads = []
+    readinto_at = f.readinto_at
+    f.readinto_at = lambda b, offset: reads.append((offset, len(b))) or readinto_at(b, offset)
+
+    with ChunkedFile(f, 8, zero_block_size=4) as chunked:
+        chunks = [(c.is_data, c.offset, c.size, bytes(c.read())) for c in chunked]
+
+    assert chunks == [
+        (True, 0, 4, b'11\0\0'),
+        (False, 4, 4, b'\0' * 4),
+        (True, 8, 8, b'\0\0' + b'111' + b'\0\0\0'),
+    ]
+    # Every chunk is read only once
+    assert reads == [(0, 8), (8, 8)]
+
+
+def test_zero_runs():
+    assert list(zero_runs(b'', 0, 4)) == []
+    assert list(zero_runs(bytes(10), 3, 4)) == [(0, 10, True)]
+    assert list(zero_runs(b'\0\0\0\0\0\0\0\0\1', 0, 4)) == [(0, 8, True), (8, 9, False)]
+    # Blocks are aligned to the file offset
+    assert list(zero_runs(b'\0\1\0\0\0\0\0\0\0', 3, 4)) == [(0, 1, True), (1, 5, False), (5, 9, True)]
+
+
+def test_copy_sparse(tmp_path):
+    src = tmp_path / 'src'
+    dst = tmp_path / 'dst'
+    with src.open('wb') as f:
+        f.truncate(4 * 1024 * 1024)
+        f.seek(1024 * 1024)
+        f.write(b'data' * 1024)
+
+    with src.open('rb') as f_in, dst.open('wb') as f_out:
+        copy_sparse(f_in, f_out, 4 * 1024 * 1024, buffer_size=1000)
+
+    assert dst.read_bytes() == src.read_bytes()
+    with src.open('rb') as f_src, dst.open('rb') as f_dst:
+        assert list(data_extents(f_dst, 4 * 1024 * 1024)) == list(data_extents(f_src, 4 * 1024 * 1024))
+
+
+def test_ChunkedFile_threads(tmp_path):
+    import concurrent.futures
+
+    path = tmp_path / 'file'
+    data = bytes(range(256)) * 4096
+    path.write_bytes(data)
+
+    with ChunkedFile(open(path, 'rb'), 4096) as chunked:
+        chunks = list(chunked)
+
+        def read(chunk):
+            buf = bytearray(4096)
+            n = chunk.readinto(buf)
+            return chunk.offset, bytes(buf[:n])
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            for offset, chunk_data in executor.map(read, chunks):
+                assert chunk_data == data[offset:offset + 4096]
+
+
+def test_ChunkedFile_hole_shared():
+    fileobj = HoleFile(8, {
+        0: False,
+        4: False,
+    })
+
+    with ChunkedFile(fileobj, 4) as chunked:
+        holes = [chunk.read() for chunk in chunked]
+        assert holes == [b'\0' * 4, b'\0' * 4]
+        assert holes[0] is holes[1]
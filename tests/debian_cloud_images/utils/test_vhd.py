@@ -0,0 +1,63 @@
+import datetime
+import io
+import os
+import struct
+import uuid
+
+from debian_cloud_images.utils.files import ChunkedFile, ExtentFile
+from debian_cloud_images.utils.vhd import VhdFixedFile
+
+
+def test_VhdFixedFile_geometry():
+    assert VhdFixedFile.geometry(30 * 1024 ** 3) == (62415, 16, 63)
+    assert VhdFixedFile.geometry(2 * 1024 ** 3) == (4161, 16, 63)
+    assert VhdFixedFile.geometry(1024 * 1024) == (30, 4, 17)
+
+
+def test_VhdFixedFile_footer():
+    timestamp = datetime.datetime(2000, 1, 1, 0, 0, 23, tzinfo=datetime.timezone.utc)
+    unique_id = uuid.UUID(int=1)
+    footer = VhdFixedFile.footer(1024 * 1024, timestamp=timestamp, unique_id=unique_id)
+
+    assert len(footer) == 512
+    assert footer[:16] == b'conectix\0\0\0\2\0\1\0\0'
+    assert struct.unpack_from('>I', footer, 24) == (23, )
+    assert struct.unpack_from('>QQ', footer, 40) == (1024 * 1024, 1024 * 1024)
+    assert struct.unpack_from('>I', footer, 60) == (2, )
+    assert footer[68:84] == unique_id.bytes
+
+    checksum, = struct.unpack_from('>I', footer, 64)
+    assert checksum == ~(sum(footer[:64]) + sum(footer[68:])) & 0xffffffff
+
+
+def test_VhdFixedFile():
+    mib = 1024 * 1024
+    backing = io.BytesIO(b'1' * mib)
+    raw = ExtentFile(mib + 23, [
+        ExtentFile.Extent(0, mib // 2, backing, 0),
+        ExtentFile.Extent(mib, 23, backing, 0),
+    ])
+
+    with VhdFixedFile(raw) as f:
+        assert f.disk_size == 2 * mib
+        assert f.seek(0, os.SEEK_END) == 2 * mib + 512
+
+        f.seek(0)
+        data = f.read()
+        assert data[:mib // 2] == b'1' * (mib // 2)
+        assert data[mib // 2:mib] == bytes(mib // 2)
+        assert data[mib:mib + 23] == b'1' * 23
+        assert data[mib + 23:2 * mib] == bytes(mib - 23)
+        assert data[2 * mib:2 * mib + 8] == b'conectix'
+
+        chunked = ChunkedFile(f, mib)
+        assert [(c.is_data, c.offset, c.size) for c in chunked] == [
+            (True, 0, mib // 2),
+            (False, mib // 2, mib // 2),
+            (True, mib, 23),
+            (False, mib + 23, mib - 23),
+            (True, 2 * mib, 512),
+        ]
+
+    assert backing.closed is False
+    assert raw.closed is True
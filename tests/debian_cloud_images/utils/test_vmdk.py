@@ -0,0 +1,63 @@
+import io
+import struct
+import zlib
+
+from debian_cloud_images.utils.files import ExtentFile
+from debian_cloud_images.utils.vmdk import VmdkStreamOptimized
+
+
+def read_vmdk(data):
+    """ Decode VMDK streamOptimized file via footer, grain directory and tables """
+    header = VmdkStreamOptimized.header_struct.unpack_from(data, 0)
+    assert header[0] == b'KDMV'
+    assert header[9] == VmdkStreamOptimized.gd_at_end
+
+    # Footer is followed by end-of-stream marker
+    assert data[-512:] == bytes(512)
+    footer = VmdkStreamOptimized.header_struct.unpack_from(data, len(data) - 1024)
+    assert footer[0] == b'KDMV'
+    assert struct.unpack_from('<QII', data, len(data) - 1536) == (1, 0, 3)
+
+    capacity, grain_sectors, gtes, gd_offset = footer[3], footer[4], footer[7], footer[9]
+    grains = -(-capacity // grain_sectors)
+    gts = -(-grains // gtes)
+
+    out = bytearray(capacity * 512)
+    allocated = []
+    gd = struct.unpack_from(f'<{gts}I', data, gd_offset * 512)
+    for gt_n, gt_offset in enumerate(gd):
+        gt = struct.unpack_from(f'<{gtes}I', data, gt_offset * 512)
+        for n, grain_offset in enumerate(gt):
+            if grain_offset:
+                lba, size = struct.unpack_from('<QI', data, grain_offset * 512)
+                grain = (gt_n * gtes + n)
+                assert lba == grain * grain_sectors
+                allocated.append(grain)
+                raw = zlib.decompress(data[grain_offset * 512 + 12:grain_offset * 512 + 12 + size])
+                out[lba * 512:lba * 512 + len(raw)] = raw
+
+    return bytes(out), allocated
+
+
+def test_VmdkStreamOptimized():
+    grain = 64 * 1024
+    backing = io.BytesIO(b''.join(bytes([i]) * 1000 for i in range(1, 200)))
+    raw = ExtentFile(1100 * grain + 100, [
+        ExtentFile.Extent(10, 3 * grain, backing, 0),
+        # Zero data must not produce grains
+        ExtentFile.Extent(10 * grain, grain, io.BytesIO(bytes(grain)), 0),
+        ExtentFile.Extent(600 * grain - 5, 10, backing, 100),
+        ExtentFile.Extent(1100 * grain, 100, backing, 0),
+    ])
+
+    raw.seek(0)
+    expected = raw.read()
+
+    stream = VmdkStreamOptimized(raw, window=2)
+    data = b''.join(stream)
+
+    assert len(data) % 512 == 0
+    assert data[512:512 + 21] == b'# Disk DescriptorFile'
+    decoded, allocated = read_vmdk(data)
+    assert decoded[:len(expected)] == expected
+    assert allocated == [0, 1, 2, 3, 599, 600, 1100]
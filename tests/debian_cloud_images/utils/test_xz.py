@@ -0,0 +1,118 @@
+import io
+import lzma
+import os
+import pytest
+import shutil
+import subprocess
+
+from debian_cloud_images.utils.xz import XzBlockCompressor, XzBlockFile
+
+
+check_no_xz = shutil.which('xz') is None
+skip_no_xz = pytest.mark.skipif(check_no_xz,
+                                reason='Need available xz')
+
+
+@pytest.fixture
+def data():
+    return b''.join(i.to_bytes(4, 'little') for i in range(256 * 1024))
+
+
+@skip_no_xz
+def test_XzBlockFile(tmp_path, data):
+    input_filename = tmp_path / 'in'
+    input_filename.write_bytes(data)
+    subprocess.check_call(('xz', '--block-size=100KiB', '--keep', input_filename.as_posix()))
+
+    with XzBlockFile.open(open(tmp_path / 'in.xz', 'rb'), workers=2) as f:
+        assert len(f.blocks) == 11
+        assert f.size == len(data)
+        assert f.read() == data
+
+        assert f.seek(300 * 1024 - 3) == 300 * 1024 - 3
+        assert f.read(10) == data[300 * 1024 - 3:300 * 1024 + 7]
+
+        assert f.seek(-5, os.SEEK_END) == len(data) - 5
+        assert f.read() == data[-5:]
+
+
+@skip_no_xz
+def test_XzBlockFile_cache_size(tmp_path, data):
+    input_filename = tmp_path / 'in'
+    input_filename.write_bytes(data)
+    subprocess.check_call(('xz', '--block-size=100KiB', '--keep', input_filename.as_posix()))
+
+    # Room for two blocks, only one of them read ahead
+    with XzBlockFile.open(open(tmp_path / 'in.xz', 'rb'), workers=8, cache_size=250 * 1024) as f:
+        decompress = f._decompress
+        calls = []
+        f._decompress = lambda n: calls.append(n) or decompress(n)
+
+        assert f.read(10) == data[:10]
+        assert sorted(calls) == [0, 1]
+        assert f.read() == data[10:]
+        assert sorted(calls) == list(range(11))
+
+
+def test_XzBlockFile_single(data):
+    f = io.BytesIO(lzma.compress(data))
+    assert XzBlockFile.open(f) is None
+
+
+def test_XzBlockFile_invalid():
+    f = io.BytesIO(b'invalid' * 10)
+    assert XzBlockFile.open(f) is None
+
+
+def test_XzBlockCompressor(data):
+    out = io.BytesIO()
+    with XzBlockCompressor(out.write, block_size=100 * 1024, preset=0, workers=2) as compressor:
+        compressor.put(data[:1000])
+        buf = compressor.get_buffer()
+        buf[:1000] = data[1000:2000]
+        compressor.put_buffer(buf, 1000)
+        compressor.put(data[2000:])
+
+    assert lzma.decompress(out.getvalue()) == data
+
+    with XzBlockFile.open(out, workers=2) as f:
+        assert len(f.blocks) == 11
+        assert f.seek(300 * 1024) == 300 * 1024
+        assert f.read(10) == data[300 * 1024:300 * 1024 + 10]
+
+
+def test_XzBlockCompressor_queue_size(data):
+    out = io.BytesIO()
+    # Room for the input of two blocks, even with many workers
+    with XzBlockCompressor(out.write, block_size=100 * 1024, preset=0, workers=8, queue_size=250 * 1024) as compressor:
+        submit = compressor._submit
+        in_flight = []
+
+        def _submit():
+            submit()
+            in_flight.append(compressor._XzBlockCompressor__pending_size)
+
+        compressor._submit = _submit
+        compressor.put(data)
+
+    assert max(in_flight) <= 250 * 1024
+    assert 200 * 1024 in in_flight
+    assert lzma.decompress(out.getvalue()) == data
+
+
+@skip_no_xz
+def test_XzBlockCompressor_xz(tmp_path, data):
+    output_filename = tmp_path / 'out.xz'
+    with output_filename.open('wb') as out:
+        with XzBlockCompressor(out.write, block_size=100 * 1024, preset=0) as compressor:
+            compressor.put(data)
+
+    subprocess.check_call(('xz', '--test', output_filename.as_posix()))
+
+
+def test_XzBlockCompressor_empty():
+    out = io.BytesIO()
+    with XzBlockCompressor(out.write):
+        pass
+
+    assert lzma.decompress(out.getvalue()) == b''